@@ -13,7 +13,7 @@ from six import assertRaisesRegex, string_types
 import yaml
 
 from ..nodes import GroupNode, PackageNode
-from ..tools.package import ParquetLib, Package
+from ..tools.package import ParquetLib, Package, PackageException
 from ..tools.compat import pathlib
 from ..tools import build, command, store
 from .utils import QuiltTestCase, patch
@@ -81,6 +81,33 @@ class BuildTest(QuiltTestCase):
         finally:
             Package.reset_parquet_lib()
 
+    def test_parquet_threads_env_var(self):
+        """
+        Test setting the number of Parquet threads using the env variable.
+        """
+        try:
+            with patch.dict(os.environ, {'QUILT_PARQUET_THREADS': '3'}):
+                Package.reset_parquet_threads()
+                assert Package.get_parquet_threads() == 3
+
+            with patch.dict(os.environ, {'QUILT_PARQUET_THREADS': 'lots'}):
+                Package.reset_parquet_threads()
+                with assertRaisesRegex(self, PackageException, 'QUILT_PARQUET_THREADS'):
+                    Package.get_parquet_threads()
+
+            # The default is limited to the CPUs we can actually use.
+            with patch.dict(os.environ, {'QUILT_PARQUET_THREADS': ''}), \
+                 patch('quilt.tools.package.cpu_count', lambda: 64), \
+                 patch.object(os, 'sched_getaffinity', lambda pid: set(range(64)), create=True), \
+                 patch('quilt.tools.package._cgroup_cpu_quota', lambda: 2):
+                Package.reset_parquet_threads()
+                assert Package.get_parquet_threads() == 2
+
+            Package.set_parquet_threads(0)
+            assert Package.get_parquet_threads() == 1
+        finally:
+            Package.reset_parquet_threads()
+
     # shared testing logic between pyarrow and default env
     def _test_dataframes(self, dataframes):
         csv = dataframes.csv()
@@ -0,0 +1,108 @@
+"""
+Tests for content-defined chunking.
+"""
+
+import os
+import random
+
+from six import BytesIO, assertRaisesRegex
+
+from ..tools.chunking import iter_chunks
+from ..tools.package import PackageException
+from ..tools.store import PackageStore
+from .utils import QuiltTestCase, BasicQuiltTestCase, patch
+
+AVG_SIZE = 1024
+MIN_SIZE = 256
+MAX_SIZE = 8 * 1024
+
+
+def _random_bytes(size, seed):
+    rand = random.Random(seed)
+    return bytes(bytearray(rand.getrandbits(8) for _ in range(size)))
+
+def _chunks(data):
+    return list(iter_chunks(BytesIO(data), AVG_SIZE, MIN_SIZE, MAX_SIZE))
+
+
+class ChunkingTest(BasicQuiltTestCase):
+    def test_chunk_sizes(self):
+        data = _random_bytes(200 * 1024, 1)
+        chunks = _chunks(data)
+
+        assert b''.join(chunks) == data
+        assert len(chunks) > 1
+        assert all(MIN_SIZE <= len(chunk) <= MAX_SIZE for chunk in chunks[:-1])
+        assert 0 < len(chunks[-1]) <= MAX_SIZE
+
+    def test_small_and_empty(self):
+        assert _chunks(b'') == []
+        assert _chunks(b'abc') == [b'abc']
+
+    def test_repetitive_data(self):
+        # No boundaries in uniform data, so chunks hit the maximum size.
+        data = b'\0' * (3 * MAX_SIZE + 10)
+        assert [len(chunk) for chunk in _chunks(data)] == [MAX_SIZE] * 3 + [10]
+
+    def test_append(self):
+        data = _random_bytes(200 * 1024, 2)
+        chunks = _chunks(data)
+        new_chunks = _chunks(data + _random_bytes(1000, 3))
+
+        # Only the last chunk can change.
+        assert new_chunks[:len(chunks) - 1] == chunks[:-1]
+
+    def test_insert(self):
+        data = _random_bytes(200 * 1024, 4)
+        middle = len(data) // 2
+        chunks = _chunks(data)
+        new_chunks = _chunks(data[:middle] + b'inserted' + data[middle:])
+
+        # Chunks away from the edit are unchanged.
+        unchanged = set(chunks) & set(new_chunks)
+        assert len(unchanged) >= len(chunks) - 3
+
+    def test_read_size(self):
+        # Boundaries don't depend on how the file is read.
+        data = _random_bytes(100 * 1024, 5)
+        with patch('quilt.tools.chunking.READ_SIZE', 1000):
+            chunks = _chunks(data)
+        assert chunks == _chunks(data)
+
+
+class ChunkedFileTest(QuiltTestCase):
+    @patch.dict(os.environ, {'QUILT_CHUNK_THRESHOLD': '1000'})
+    @patch('quilt.tools.chunking.AVG_CHUNK_SIZE', AVG_SIZE)
+    def test_save_chunked_file(self):
+        data = _random_bytes(50 * 1024, 6)
+        with open('data.bin', 'wb') as fd:
+            fd.write(data)
+        with open('README', 'wb') as fd:
+            fd.write(data)
+
+        store = PackageStore()
+        pkg = store.create_package(None, 'foo', 'bar')
+        pkg.save_file('data.bin', 'data', 'data.bin')
+        pkg.save_file('README', 'README', 'README')
+
+        contents = pkg.get_contents()
+        hashes = contents.children['data'].hashes
+        assert len(hashes) > 1
+        for objhash in hashes:
+            assert os.path.exists(store.object_path(objhash))
+        # The README is never chunked.
+        assert len(contents.children['README'].hashes) == 1
+
+        with open(pkg.file(hashes), 'rb') as fd:
+            assert fd.read() == data
+
+    def test_bad_chunk_threshold(self):
+        store = PackageStore()
+        pkg = store.create_package(None, 'foo', 'bar')
+        with open('data.bin', 'wb') as fd:
+            fd.write(b'data')
+
+        for threshold in ('1MB', '-1'):
+            with patch.dict(os.environ, {'QUILT_CHUNK_THRESHOLD': threshold}):
+                with assertRaisesRegex(self, PackageException, 'QUILT_CHUNK_THRESHOLD'):
+                    pkg.save_file('data.bin', 'data', 'data.bin')
@@ -194,32 +194,30 @@ class CommandTest(QuiltTestCase):
     def test_ambiguous_hash(self):
         registry_url = command.get_registry_url(None)
         ambiguous_token = "795a7b"
-        # There should be at least two results that start with the ambiguous_token, plus some non-ambiguous
-        # results in fake_data to test against.
-        fake_data = {'logs': [
-            {'author': 'user', 'created': 1490816524.0,
-             'hash': '885696c6e40613b3c601e95037caf4e43bda58c39f67ab5d5e56beefb3662ff4'},
-            {'author': 'user', 'created': 1490816507.0,
-             'hash': '795a7bc9e40613b3c601e95037caf4e43bda58c39f67ab5d5e56beefb3662ff4'},
-            {'author': 'user', 'created': 1490816473.0,
-             'hash': '795a7bc6e40613b3c601e95037caf4e43bda58c39f67ab5d5e56beefb3662ff4'},
-            {'author': 'user', 'created': 1490816524.0,
-             'hash': '2501a6c6e40a7b355901fc5037caf4e43bda58c39f67ab5d5e56beefb3662ff4'},
-        ]}
+        # The registry returns all of the hashes that start with the ambiguous_token.
+        fake_hashes = [
+            '795a7bc9e40613b3c601e95037caf4e43bda58c39f67ab5d5e56beefb3662ff4',
+            '795a7bc6e40613b3c601e95037caf4e43bda58c39f67ab5d5e56beefb3662ff4',
+        ]
         self.requests_mock.add(
             responses.GET,
-            registry_url + "/api/log/user/test/",
-            json=fake_data
+            registry_url + "/api/hash/user/test/" + ambiguous_token,
+            json=dict(hashes=fake_hashes)
         )
         # Ambiguous hashes in _match_hash's exception will be sorted -- sorted here to match.
-        fake_data_ambiguous = sorted(entry['hash'] for entry in fake_data['logs']
-                               if entry['hash'].startswith(ambiguous_token))
+        fake_data_ambiguous = sorted(fake_hashes)
         # this will match each ambiguous hash, in order, separated by anything.
         # ..it allows for formatting changes in the error, but requires the same order.
         fake_data_regexp = r'(.|\n)+'.join(fake_data_ambiguous)
         with assertRaisesRegex(self, command.CommandException, fake_data_regexp):
             command._match_hash('user/test', hash='795a7b')
 
+    def test_sort_by_size(self):
+        obj_sizes = {'a': 10, 'b': None, 'c': 300, 'd': 20}
+        queue = command._sort_by_size(obj_sizes, obj_sizes)
+        # Workers pop() from the end, so the largest fragment goes out first.
+        assert [queue.pop() for _ in range(len(obj_sizes))] == ['c', 'd', 'a', 'b']
+
     def test_push_invalid_package(self):
         with assertRaisesRegex(self, command.CommandException, "owner/package_name"):
             command.push(package="no_user")
@@ -444,6 +442,29 @@ class CommandTest(QuiltTestCase):
             )
         command.search("asdf")
 
+    def test_search_pages(self):
+        self.requests_mock.add(
+            responses.GET,
+            '%s/api/search/?q=asdf' % command.get_registry_url(None),
+            status=200,
+            json={
+                "packages": [dict(owner='foo', name='bar')],
+                "next_offset": 1,
+                }
+            )
+        self.requests_mock.add(
+            responses.GET,
+            '%s/api/search/?q=asdf&offset=1' % command.get_registry_url(None),
+            status=200,
+            json={
+                "packages": [dict(owner='foo', name='baz')],
+                "next_offset": None,
+                }
+            )
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            command.search("asdf")
+        assert stdout.getvalue().split() == ['foo/bar', 'foo/baz']
+
     @patch('quilt.tools.command._find_logged_in_team', lambda: "teamname")
     def test_search_team(self):
         self.requests_mock.add(
@@ -907,6 +928,27 @@ class CommandTest(QuiltTestCase):
 
         command.log("{owner}/{pkg}".format(owner=owner, pkg=package))
 
+    @patch('quilt.tools.command.LIST_PAGE_SIZE', 2)
+    def test_tag_list_pages(self):
+        tag_url = '%s/api/tag/foo/bar/' % command.get_registry_url(None)
+        self.requests_mock.add(
+            responses.GET,
+            tag_url + '?limit=2',
+            json=dict(tags=[dict(tag='a', hash='1'), dict(tag='b', hash='2')], next_cursor='cursor1'),
+            match_querystring=True
+        )
+        self.requests_mock.add(
+            responses.GET,
+            tag_url + '?limit=2&cursor=cursor1',
+            json=dict(tags=[dict(tag='c', hash='3')], next_cursor=None),
+            match_querystring=True
+        )
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            command.tag_list('foo/bar')
+
+        assert stdout.getvalue() == 'a: 1\nb: 2\nc: 3\n'
+
     def _mock_logs_list(self, owner, package, pkg_hash):
         logs_url = "%s/api/log/%s/%s/" % (command.get_registry_url(None), owner, package)
         resp = dict(logs=[dict(
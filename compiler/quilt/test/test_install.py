@@ -5,6 +5,7 @@ Tests for the install command.
 import hashlib
 import json
 import os
+import re
 import time
 import pytest
 
@@ -15,7 +16,7 @@ from six import assertRaisesRegex
 from six.moves import urllib
 
 from ..tools import command
-from ..tools.const import HASH_TYPE
+from ..tools.const import HASH_TYPE, PACKAGE_DIR_NAME
 from ..tools.core import (
     decode_node,
     encode_node,
@@ -30,7 +31,7 @@ from ..tools.package import Package
 from ..tools.store import PackageStore
 from ..tools.util import gzip_compress
 
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 class InstallTest(QuiltTestCase):
     """
@@ -96,6 +97,43 @@ class InstallTest(QuiltTestCase):
         command.install('qux:foo/bar')
         self.validate_file('foo', 'bar', contents_hash, contents, table_hash, table_data, team='qux')
 
+    def test_install_from_other_store(self):
+        """
+        Fragments that are already in another package store don't get downloaded,
+        unless the copy there doesn't match its hash.
+        """
+        table_data, table_hash = self.make_table_data()
+        file_data, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(table=table_hash, file=file_hash)
+
+        # A read-only store that has the table, and a corrupted copy of the file.
+        other_store_dir = os.path.join(self._test_dir, 'shared', PACKAGE_DIR_NAME)
+        other_store = PackageStore(other_store_dir)
+        other_store.create_dirs()
+        with open(other_store.object_path(table_hash), 'wb') as fd:
+            fd.write(table_data)
+        with open(other_store.object_path(file_hash), 'wb') as fd:
+            fd.write(file_data[:-1])
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [table_hash, file_hash])
+        self._mock_s3(file_hash, file_data)
+
+        with patch.dict(os.environ, {'QUILT_PACKAGE_DIRS': other_store_dir}):
+            command.install('foo/bar')
+
+        s3_calls = [call for call in self.requests_mock.calls if call.request.url.startswith('https://example.com/')]
+        assert len(s3_calls) == 1
+        self.validate_file('foo', 'bar', contents_hash, contents, table_hash, table_data)
+
+        # The other store still has its copy.
+        with open(other_store.object_path(table_hash), 'rb') as fd:
+            assert fd.read() == table_data
+
+        # The corrupted file got downloaded instead.
+        with open(PackageStore(self._store_dir).object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+
     def test_short_hashes(self):
         """
         Test various functions that use short hashes
@@ -104,13 +142,26 @@ class InstallTest(QuiltTestCase):
         file_data, file_hash = self.make_file_data()
         contents, contents_hash = self.make_contents(table=table_hash, file=file_hash)
 
-        self._mock_log('foo/bar', contents_hash)
+        self._mock_hash('foo/bar', contents_hash[0:6], [contents_hash])
         self._mock_tag('foo/bar', 'mytag', contents_hash[0:6], cmd=responses.PUT)
         command.tag_add('foo/bar', 'mytag', contents_hash[0:6])
 
         self._mock_version('foo/bar', '1.0', contents_hash[0:6], cmd=responses.PUT)
         command.version_add('foo/bar', '1.0', contents_hash[0:6], force=True)
 
+    def test_short_hashes_old_registry(self):
+        """
+        Registries without the hash endpoint get their logs searched instead
+        """
+        table_data, table_hash = self.make_table_data()
+        file_data, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(table=table_hash, file=file_hash)
+
+        self._mock_hash('foo/bar', contents_hash[0:6], None, status=404)
+        self._mock_log('foo/bar', contents_hash)
+        self._mock_tag('foo/bar', 'mytag', contents_hash[0:6], cmd=responses.PUT)
+        command.tag_add('foo/bar', 'mytag', contents_hash[0:6])
+
     def test_team_short_hashes(self):
         """
         Test various functions that use short hashes for team
@@ -119,7 +170,7 @@ class InstallTest(QuiltTestCase):
         file_data, file_hash = self.make_file_data()
         contents, contents_hash = self.make_contents(table=table_hash, file=file_hash)
 
-        self._mock_log('foo/bar', contents_hash, team='qux')
+        self._mock_hash('foo/bar', contents_hash[0:6], [contents_hash], team='qux')
         self._mock_tag('foo/bar', 'mytag', contents_hash[0:6], cmd=responses.PUT, team='qux')
         command.tag_add('qux:foo/bar', 'mytag', contents_hash[0:6])
 
@@ -177,52 +228,60 @@ class InstallTest(QuiltTestCase):
         """
         table_data1, table_hash1 = self.make_table_data('table1')
         contents1, contents_hash1 = self.make_contents(table1=table_hash1)
-        self._mock_tag('foo/bar', 'latest', contents_hash1)
-        self._mock_package('foo/bar', contents_hash1, '', contents1, [table_hash1])
         self._mock_s3(table_hash1, table_data1)
 
         table_data2, table_hash2 = self.make_table_data('table2')
         contents2, contents_hash2 = self.make_contents(table2=table_hash2)
-        self._mock_tag('baz/bat', 'nexttag', contents_hash2)
-        self._mock_package('baz/bat', contents_hash2, '', contents2, [table_hash2])
         self._mock_s3(table_hash2, table_data2)
 
         table_data3, table_hash3 = self.make_table_data('table3')
         contents3, contents_hash3 = self.make_contents(table3=table_hash3)
-        self._mock_version('usr1/pkga', 'v1', contents_hash3)
-        self._mock_package('usr1/pkga', contents_hash3, '', contents3, [table_hash3])
         self._mock_s3(table_hash3, table_data3)
 
         table_data4, table_hash4 = self.make_table_data('table4')
         contents4, contents_hash4 = self.make_contents(table4=table_hash4)
-        self._mock_tag('usr2/pkgb', 'latest', contents_hash4)
-        self._mock_package('usr2/pkgb', contents_hash4, '', contents4, [table_hash4])
         self._mock_s3(table_hash4, table_data4)
 
         table_data5, table_hash5 = self.make_table_data('table5')
         contents5, contents_hash5 = self.make_contents(table5=table_hash5)
-        self._mock_log('usr3/pkgc', contents_hash5)
-        self._mock_package('usr3/pkgc', contents_hash5, '', contents5, [table_hash5])
         self._mock_s3(table_hash5, table_data5)
 
         table_data6, table_hash6 = self.make_table_data('table6')
         contents6, contents_hash6 = self.make_contents(table6=table_hash6)
-        self._mock_tag('danWebster/sgRNAs', 'latest', contents_hash6)
-        self._mock_package('danWebster/sgRNAs', contents_hash6, 'libraries/brunello', contents6, [table_hash6])
         self._mock_s3(table_hash6, table_data6)
 
         table_data7, table_hash7 = self.make_table_data('table7')
         contents7, contents_hash7 = self.make_contents(table7=table_hash7)
-        self._mock_tag('usr/pkga', 'latest', contents_hash7, team='team')
-        self._mock_package('usr/pkga', contents_hash7, '', contents7, [table_hash7], team='team')
         self._mock_s3(table_hash7, table_data7)
 
         table_data8, table_hash8 = self.make_table_data('table8')
         contents8, contents_hash8 = self.make_contents(table8=table_hash8)
-        self._mock_tag('usr/pkgb', 'tag', contents_hash8, team='team')
-        self._mock_package('usr/pkgb', contents_hash8, 'path', contents8, [table_hash8], team='team')
         self._mock_s3(table_hash8, table_data8)
 
+        # One request per registry.
+        self._mock_install_batch([
+            dict(owner='foo', name='bar', tag='latest'),
+            dict(owner='baz', name='bat', tag='nexttag'),
+            dict(owner='usr1', name='pkga', version='v1'),
+            dict(owner='usr2', name='pkgb'),
+            dict(owner='usr3', name='pkgc', hash=contents_hash5[0:8]),
+            dict(owner='danWebster', name='sgRNAs', subpath='libraries/brunello'),
+        ], [
+            self._batch_result(contents_hash1, contents1, [table_hash1]),
+            self._batch_result(contents_hash2, contents2, [table_hash2]),
+            self._batch_result(contents_hash3, contents3, [table_hash3]),
+            self._batch_result(contents_hash4, contents4, [table_hash4]),
+            self._batch_result(contents_hash5, contents5, [table_hash5]),
+            self._batch_result(contents_hash6, contents6, [table_hash6]),
+        ])
+        self._mock_install_batch([
+            dict(owner='usr', name='pkga'),
+            dict(owner='usr', name='pkgb', tag='tag', subpath='path'),
+        ], [
+            self._batch_result(contents_hash7, contents7, [table_hash7]),
+            self._batch_result(contents_hash8, contents8, [table_hash8]),
+        ], team='team')
+
         # inline test of quilt.yml
         command.install('''
 packages:
@@ -258,13 +317,85 @@ packages:
     def test_install_dependencies_from_file(self):
         table_data, table_hash = self.make_table_data('table')
         contents, contents_hash = self.make_contents(table7=table_hash)
-        self._mock_tag('usr4/pkgd', 'latest', contents_hash)
-        self._mock_package('usr4/pkgd', contents_hash, '', contents, [table_hash])
+        self._mock_install_batch([
+            dict(owner='usr4', name='pkgd'),
+        ], [
+            self._batch_result(contents_hash, contents, [table_hash]),
+        ])
         self._mock_s3(table_hash, table_data)
         with open('tmp_quilt.yml', 'w') as fd:
             fd.write("packages:\n- usr4/pkgd")
         command.install('@tmp_quilt.yml')
 
+    def test_install_dependencies_shared_fragments(self):
+        table_data1, table_hash1 = self.make_table_data('table1')
+        table_data2, table_hash2 = self.make_table_data('table2')
+        table_data3, table_hash3 = self.make_table_data('table3')
+        contents1, contents_hash1 = self.make_contents(table1=table_hash1, table2=table_hash2)
+        contents2, contents_hash2 = self.make_contents(table2=table_hash2, table3=table_hash3)
+        sorted_hashes2 = sorted([table_hash2, table_hash3])
+
+        # The second package gets its URLs in two pages.
+        self._mock_install_batch([
+            dict(owner='foo', name='bar'),
+            dict(owner='baz', name='bat'),
+        ], [
+            self._batch_result(contents_hash1, contents1, [table_hash1, table_hash2]),
+            self._batch_result(contents_hash2, contents2, sorted_hashes2[:1], next_cursor=sorted_hashes2[0]),
+        ])
+        self._mock_package('baz/bat', contents_hash2, '', contents2, sorted_hashes2[1:],
+                           cursor=sorted_hashes2[0])
+
+        # Each fragment only gets downloaded once.
+        for table_hash, table_data in [(table_hash1, table_data1), (table_hash2, table_data2),
+                                       (table_hash3, table_data3)]:
+            self._mock_s3(table_hash, table_data)
+
+        command.install("packages:\n- foo/bar\n- baz/bat")
+
+        s3_calls = [call for call in self.requests_mock.calls if call.request.url.startswith('https://example.com/')]
+        assert len(s3_calls) == 3
+
+        self.validate_file('foo', 'bar', contents_hash1, contents1, table_hash1, table_data1)
+        self.validate_file('baz', 'bat', contents_hash2, contents2, table_hash3, table_data3)
+
+    def test_install_dependencies_old_registry(self):
+        table_data, table_hash = self.make_table_data('table')
+        contents, contents_hash = self.make_contents(table=table_hash)
+
+        # Registries without install_batch get one request per package.
+        self._mock_install_batch([dict(owner='foo', name='bar')], None, status=404)
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [table_hash])
+        self._mock_s3(table_hash, table_data)
+
+        command.install("packages:\n- foo/bar")
+        self.validate_file('foo', 'bar', contents_hash, contents, table_hash, table_data)
+
+    def test_install_dependencies_mixed_registries(self):
+        table_data1, table_hash1 = self.make_table_data('table1')
+        contents1, contents_hash1 = self.make_contents(table1=table_hash1)
+        table_data2, table_hash2 = self.make_table_data('table2')
+        contents2, contents_hash2 = self.make_contents(table2=table_hash2)
+
+        # The team registry can install in batches; the public one can't.
+        self._mock_install_batch([dict(owner='foo', name='bar')],
+                                 [self._batch_result(contents_hash1, contents1, [table_hash1])], team='qux')
+        self._mock_install_batch([dict(owner='baz', name='bat')], None, status=404)
+        self._mock_tag('baz/bat', 'latest', contents_hash2)
+        self._mock_package('baz/bat', contents_hash2, '', contents2, [table_hash2])
+        self._mock_s3(table_hash1, table_data1)
+        self._mock_s3(table_hash2, table_data2)
+
+        command.install("packages:\n- qux:foo/bar\n- baz/bat")
+
+        # Nothing gets downloaded twice.
+        s3_calls = [call for call in self.requests_mock.calls if call.request.url.startswith('https://example.com/')]
+        assert len(s3_calls) == 2
+
+        self.validate_file('foo', 'bar', contents_hash1, contents1, table_hash1, table_data1, team='qux')
+        self.validate_file('baz', 'bat', contents_hash2, contents2, table_hash2, table_data2)
+
     def test_bad_install_dependencies(self):
         """
         Install multiple packages via requirements file
@@ -289,23 +420,27 @@ packages:
     def test_quilt_yml_unknown_hash(self):
         table_data1, table_hash1 = self.make_table_data('table1')
         contents1, contents_hash1 = self.make_contents(table1=table_hash1)
-        self._mock_log('akarve/sales', contents_hash1)
+        self._mock_install_batch([dict(owner='akarve', name='sales', hash='123456')], [
+            self._batch_error('Invalid hash: 123456')
+        ])
         with assertRaisesRegex(self, command.CommandException, "Invalid hash"):
             command.install("packages:\n- akarve/sales:h:123456")
 
     def test_quilt_yml_unknown_tag(self):
         table_data1, table_hash1 = self.make_table_data('table1')
         contents1, contents_hash1 = self.make_contents(table1=table_hash1)
-        self._mock_tag('akarve/sales', 'unknown', contents_hash1,
-                       status=404, message='Tag unknown does not exist')
+        self._mock_install_batch([dict(owner='akarve', name='sales', tag='unknown')], [
+            self._batch_error('Tag unknown does not exist')
+        ])
         with assertRaisesRegex(self, command.CommandException, "Tag unknown does not exist"):
             command.install("packages:\n- akarve/sales:t:unknown")
 
     def test_quilt_yml_unknown_version(self):
         table_data1, table_hash1 = self.make_table_data('table1')
         contents1, contents_hash1 = self.make_contents(table1=table_hash1)
-        self._mock_version('akarve/sales', '99.99', contents_hash1,
-                           status=404, message='Version 99.99 does not exist')
+        self._mock_install_batch([dict(owner='akarve', name='sales', version='99.99')], [
+            self._batch_error('Version 99.99 does not exist')
+        ])
         with assertRaisesRegex(self, command.CommandException, "Version 99.99 does not exist"):
             command.install("packages:\n- akarve/sales:v:99.99")
 
@@ -320,9 +455,9 @@ packages:
     def test_quilt_yml_unknown_subpath(self):
         table_data1, table_hash1 = self.make_table_data('table1')
         contents1, contents_hash1 = self.make_contents(table1=table_hash1)
-        self._mock_tag('baz/bat', 'latest', contents_hash1)
-        self._mock_package('baz/bat', contents_hash1, 'badsubpath', contents1, [table_hash1],
-                           status=404, message='Invalid subpath')
+        self._mock_install_batch([dict(owner='baz', name='bat', subpath='badsubpath')], [
+            self._batch_error("Invalid subpath: 'badsubpath'")
+        ])
         with assertRaisesRegex(self, command.CommandException, "Invalid subpath"):
             command.install("packages:\n- baz/bat/badsubpath")
 
@@ -437,6 +572,71 @@ packages:
 
         command.install('foo/bar/group/table')
 
+    @patch('quilt.tools.command.RANGED_DOWNLOAD_PART_SIZE', 100)
+    @patch.dict('os.environ', {'QUILT_RANGED_DOWNLOAD_THRESHOLD': '1000'})
+    def test_ranged_download(self):
+        file_data = os.urandom(5000)
+        file_hash = hashlib.new(HASH_TYPE, file_data).hexdigest()
+        contents, contents_hash = self.make_contents(file=file_hash)
+        body = gzip_compress(file_data)
+        assert len(body) > 300
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash], sizes={file_hash: len(file_data)})
+
+        requested_ranges = []
+
+        def _range_callback(request):
+            match = re.match(r'^bytes=(\d+)-(\d+)$', request.headers['Range'])
+            start, end = int(match.group(1)), min(int(match.group(2)), len(body) - 1)
+            requested_ranges.append((start, end))
+            headers = {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(body))}
+            return (206, headers, body[start:end+1])
+
+        self.requests_mock.add_callback(responses.GET, 'https://example.com/%s' % file_hash, _range_callback)
+
+        command.install('foo/bar')
+
+        assert sorted(requested_ranges) == [
+            (start, min(start + 100, len(body)) - 1) for start in range(0, len(body), 100)
+        ]
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(objhash=file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+
+    @patch('quilt.tools.command.INSTALL_PAGE_SIZE', 2)
+    def test_paged_install(self):
+        file_data_list = []
+        file_hash_list = []
+        for i in range(5):
+            file_data, file_hash = self.make_file_data('file%d' % i)
+            file_data_list.append(file_data)
+            file_hash_list.append(file_hash)
+
+        contents = RootNode(dict(
+            ('file%d' % i, FileNode([file_hash], metadata={'q_path': 'file%d' % i}))
+            for i, file_hash in enumerate(file_hash_list)
+        ))
+        contents_hash = hash_contents(contents)
+
+        # The registry returns the URLs in pages, sorted by hash.
+        sorted_hashes = sorted(file_hash_list)
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, sorted_hashes[0:2],
+                           next_cursor=sorted_hashes[1])
+        self._mock_package('foo/bar', contents_hash, '', contents, sorted_hashes[2:4],
+                           cursor=sorted_hashes[1], next_cursor=sorted_hashes[3])
+        self._mock_package('foo/bar', contents_hash, '', contents, sorted_hashes[4:],
+                           cursor=sorted_hashes[3])
+        for file_data, file_hash in zip(file_data_list, file_hash_list):
+            self._mock_s3(file_hash, file_data)
+
+        command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        for file_data, file_hash in zip(file_data_list, file_hash_list):
+            with open(teststore.object_path(objhash=file_hash), 'rb') as fd:
+                assert fd.read() == file_data
 
     def _mock_log(self, package, pkg_hash, team=None):
         log_url = '%s/api/log/%s/' % (command.get_registry_url(team), package)
@@ -444,6 +644,12 @@ packages:
             {'created': int(time.time()), 'hash': pkg_hash, 'author': 'author'}
         ]}))
 
+    def _mock_hash(self, package, prefix, hashes, status=200, team=None):
+        hash_url = '%s/api/hash/%s/%s' % (command.get_registry_url(team), package, prefix)
+        self.requests_mock.add(responses.GET, hash_url, json.dumps(
+            dict(hashes=hashes) if status == 200 else dict(message="Not Found")
+        ), status=status)
+
     def _mock_tag(self, package, tag, pkg_hash, cmd=responses.GET,
                       status=200, message=None, team=None):
         tag_url = '%s/api/tag/%s/%s' % (command.get_registry_url(team), package, tag)
@@ -459,18 +665,52 @@ packages:
         ), status=status)
 
     def _mock_package(self, package, pkg_hash, subpath, contents, hashes,
-                      status=200, message=None, team=None):
+                      status=200, message=None, team=None, sizes=None, cursor=None, next_cursor=None):
+        params = dict(subpath=subpath, limit=command.INSTALL_PAGE_SIZE)
+        if cursor is not None:
+            params['cursor'] = cursor
         pkg_url = '%s/api/package/%s/%s?%s' % (
-            command.get_registry_url(team), package, pkg_hash, urllib.parse.urlencode(dict(subpath=subpath))
+            command.get_registry_url(team), package, pkg_hash, urllib.parse.urlencode(params)
         )
-        self.requests_mock.add(responses.GET, pkg_url, body=json.dumps(
-            dict(message=message) if message else
-            dict(
+        if message:
+            data = dict(message=message)
+        else:
+            data = dict(
+                next_cursor=next_cursor,
+                sizes=sizes or {h: None for h in hashes},
+                urls={h: 'https://example.com/%s' % h for h in hashes}
+            )
+            if cursor is None:
+                data['contents'] = contents
+        self.requests_mock.add(responses.GET, pkg_url, body=json.dumps(data, default=encode_node),
+                               match_querystring=True, status=status)
+
+    def _batch_result(self, pkg_hash, contents, hashes, next_cursor=None):
+        return dict(
+            hash=pkg_hash,
+            package=dict(
                 contents=contents,
+                next_cursor=next_cursor,
                 sizes={h: None for h in hashes},
                 urls={h: 'https://example.com/%s' % h for h in hashes}
             )
-        , default=encode_node), match_querystring=True, status=status)
+        )
+
+    def _batch_error(self, message, status=404):
+        return dict(error=dict(status=status, message=message))
+
+    def _mock_install_batch(self, packages, results, status=200, team=None):
+        batch_url = '%s/api/install_batch/' % command.get_registry_url(team)
+
+        def _callback(request):
+            assert json.loads(request.body) == dict(packages=packages, limit=command.INSTALL_PAGE_SIZE)
+            if status == 200:
+                body = dict(packages=results)
+            else:
+                body = dict(message="Not Found")
+            return (status, {}, json.dumps(body, default=encode_node))
+
+        self.requests_mock.add_callback(responses.POST, batch_url, callback=_callback)
 
     def _mock_s3(self, pkg_hash, contents):
         s3_url = 'https://example.com/%s' % pkg_hash
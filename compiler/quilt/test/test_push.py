@@ -2,15 +2,21 @@
 Tests for the push command.
 """
 
+import gzip
 import json
 import os
+import re
 
+import requests
 import responses
+from six import BytesIO
+from six.moves import urllib
+from tqdm import tqdm
 
 from quilt.tools import command, store
 from quilt.tools.core import find_object_hashes
 
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 
 class PushTest(QuiltTestCase):
@@ -59,10 +65,184 @@ class PushTest(QuiltTestCase):
         # Push it again; this time, we're verifying that there are no s3 uploads.
         command.push('foo/bar')
 
-    def _mock_put_package(self, package, pkg_hash, upload_urls):
+    def test_push_existing(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        contents = pkg_obj.get_contents()
+
+        all_hashes = set(find_object_hashes(contents))
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in all_hashes
+        }
+
+        # The registry already has all of the fragments, so there should be no HEADs or PUTs.
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls, existing=list(all_hashes))
+        self._mock_put_tag('foo/bar', 'latest')
+
+        command.push('foo/bar')
+
+        # Unless we're re-uploading.
+        for blob_hash in all_hashes:
+            self.requests_mock.add(responses.PUT, upload_urls[blob_hash]['put'])
+
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls, existing=list(all_hashes))
+        self._mock_put_tag('foo/bar', 'latest')
+
+        command.push('foo/bar', reupload=True)
+
+    def test_push_multipart(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        contents = pkg_obj.get_contents()
+
+        all_hashes = set(find_object_hashes(contents))
+        obj_sizes = {
+            blob_hash: os.path.getsize(pkg_obj.get_store().object_path(blob_hash))
+            for blob_hash in all_hashes
+        }
+        big_hash = max(all_hashes, key=lambda blob_hash: obj_sizes[blob_hash])
+
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in all_hashes
+        }
+
+        # Upload the biggest fragment in (lots of) small parts.
+        part_size = 100
+        num_parts = (obj_sizes[big_hash] + 1024) // part_size + 1
+        part_url = "https://example.com/part/foo/%s" % big_hash
+        upload_urls[big_hash]['multipart'] = True
+        multipart = dict(
+            part_size=part_size,
+            parts=['%s?partNumber=%d' % (part_url, i) for i in range(1, num_parts + 1)],
+            complete="https://example.com/complete/foo/%s" % big_hash,
+            abort="https://example.com/abort/foo/%s" % big_hash,
+        )
+
+        # The upload only gets started once the client needs it.
+        def _start_upload(request):
+            assert json.loads(request.body) == dict(size=obj_sizes[big_hash])
+            return (200, {}, json.dumps(multipart))
+
+        # A tiny S3 stand-in: it stores the parts, and puts them together on completion.
+        parts = {}
+        failed_parts = set()
+
+        def _upload_part(request):
+            part_number = int(urllib.parse.parse_qs(urllib.parse.urlparse(request.url).query)['partNumber'][0])
+            # Fail the first attempt of the second part.
+            if part_number == 2 and part_number not in failed_parts:
+                failed_parts.add(part_number)
+                raise requests.exceptions.ConnectionError("Timeout")
+            parts[part_number] = request.body.read()
+            return (200, {'ETag': '"etag%d"' % part_number}, '')
+
+        def _complete(request):
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            part_list = re.findall(r'<PartNumber>(\d+)</PartNumber><ETag>"etag(\d+)"</ETag>', body)
+            assert part_list and all(number == etag_number for number, etag_number in part_list)
+            numbers = [int(number) for number, _ in part_list]
+            assert numbers == list(range(1, len(parts) + 1))
+
+            compressed = BytesIO(b''.join(parts[number] for number in numbers))
+            with gzip.GzipFile(fileobj=compressed, mode='rb') as fd:
+                data = fd.read()
+            with open(pkg_obj.get_store().object_path(big_hash), 'rb') as fd:
+                assert data == fd.read()
+            return (200, {}, '<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+
+        for blob_hash in all_hashes:
+            self.requests_mock.add(responses.HEAD, upload_urls[blob_hash]['head'], status=404)
+            if blob_hash != big_hash:
+                self.requests_mock.add(responses.PUT, upload_urls[blob_hash]['put'])
+        self.requests_mock.add_callback(responses.PUT, part_url, callback=_upload_part)
+        self.requests_mock.add_callback(
+            responses.POST,
+            '%s/api/multipart_upload/foo/%s' % (command.get_registry_url(None), big_hash),
+            callback=_start_upload
+        )
+        self.requests_mock.add_callback(responses.POST, multipart['complete'], callback=_complete)
+
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        progress_bars = []
+
+        class _RecordingTqdm(tqdm):
+            def __init__(self, *args, **kwargs):
+                super(_RecordingTqdm, self).__init__(*args, **kwargs)
+                progress_bars.append(self)
+
+        with patch('quilt.tools.command.tqdm', _RecordingTqdm):
+            command.push('foo/bar')
+
+        assert len(parts) > 1
+        assert failed_parts == {2}
+
+        # Progress reported by the part threads adds up, without the failed attempt.
+        assert len(progress_bars) == 1
+        assert progress_bars[0].n == sum(obj_sizes.values())
+
+    def test_push_session(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        all_hashes = set(find_object_hashes(pkg_obj.get_contents()))
+        pkg_url = '%s/api/package/foo/bar/%s' % (command.get_registry_url(None), pkg_hash)
+
+        bodies = []
+
+        def _put_package(request):
+            with gzip.GzipFile(fileobj=BytesIO(request.body), mode='rb') as fd:
+                body = json.loads(fd.read().decode('utf-8'))
+            bodies.append(body)
+            if body.get('dry_run'):
+                return (200, {}, json.dumps(dict(
+                    push_session='token123',
+                    existing=list(all_hashes),
+                    upload_urls={blob_hash: {} for blob_hash in all_hashes}
+                )))
+            elif 'push_session' in body and len(bodies) > 2:
+                return (410, {}, json.dumps(dict(message="Push session not found or expired")))
+            return (200, {}, json.dumps(dict(package_url='https://example.com/')))
+
+        self.requests_mock.add_callback(responses.PUT, pkg_url, callback=_put_package)
+        self._mock_put_tag('foo/bar', 'latest')
+        self._mock_put_tag('foo/bar', 'latest')
+
+        # The contents only get sent with the dry run.
+        command.push('foo/bar')
+        assert 'contents' in bodies[0]
+        assert bodies[1] == dict(push_session='token123')
+
+        # If the session expired, the contents get sent again.
+        command.push('foo/bar')
+        assert bodies[3] == dict(push_session='token123')
+        assert 'contents' in bodies[4] and not bodies[4]['dry_run']
+
+    def _mock_put_package(self, package, pkg_hash, upload_urls, existing=None):
         pkg_url = '%s/api/package/%s/%s' % (command.get_registry_url(None), package, pkg_hash)
         # Dry run, then the real thing.
-        self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(upload_urls=upload_urls)))
+        self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(
+            existing=existing or [],
+            upload_urls=upload_urls
+        )))
         self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(package_url='https://example.com/')))
 
     def _mock_put_tag(self, package, tag):
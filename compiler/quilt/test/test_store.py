@@ -5,8 +5,14 @@ Tests for the package store.
 import os
 import shutil
 
+import pandas as pd
+
+from ..tools.core import PackageFormat
+from ..tools import hashing
+from ..tools.hashing import digest_file
+from ..tools.package import Package
 from ..tools.store import PackageStore, StoreException
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 class StoreTest(QuiltTestCase):
     def test_old_format(self):
@@ -31,3 +37,81 @@ class StoreTest(QuiltTestCase):
         # We now have a new version.
         with open(os.path.join(self._store_dir, '.format')) as fd:
             assert fd.read() == '1.3'
+
+    def test_save_file(self):
+        data = b'data' * 1000
+        with open('data.bin', 'wb') as fd:
+            fd.write(data)
+        filehash = digest_file('data.bin')
+
+        store = PackageStore()
+        pkg = store.create_package(None, 'foo', 'bar')
+        objpath = store.object_path(filehash)
+
+        # No copy-on-write support: the file gets copied.
+        with patch('quilt.tools.util.reflink_file', side_effect=OSError):
+            pkg.save_file('data.bin', 'data', 'data.bin')
+        assert pkg.get_contents().children['data'].hashes == [filehash]
+        assert not os.path.samefile('data.bin', objpath)
+        with open(objpath, 'rb') as fd:
+            assert fd.read() == data
+
+        # Unchanged files don't even get read again...
+        with patch('quilt.tools.util.reflink_file', side_effect=OSError), \
+             patch('quilt.tools.package.digest_copy') as digest_copy:
+            pkg.save_file('data.bin', 'data1', 'data.bin')
+        assert not digest_copy.called
+        assert pkg.get_contents().children['data1'].hashes == [filehash]
+
+        # ...but modified ones do.
+        stat = os.stat('data.bin')
+        os.utime('data.bin', (stat.st_atime, stat.st_mtime + 10))
+        with patch('quilt.tools.util.reflink_file', side_effect=OSError), \
+             patch('quilt.tools.package.digest_copy', wraps=hashing.digest_copy) as digest_copy:
+            pkg.save_file('data.bin', 'data1', 'data.bin')
+        assert digest_copy.called
+        assert pkg.get_contents().children['data1'].hashes == [filehash]
+
+        # Hard links are opt-in.
+        os.remove(objpath)
+        with patch.dict(os.environ, {'QUILT_HARDLINK_FILES': 'true'}):
+            pkg.save_file('data.bin', 'data2', 'data.bin')
+        assert pkg.get_contents().children['data2'].hashes == [filehash]
+        assert os.path.samefile('data.bin', objpath)
+
+        # Saving an existing object leaves nothing behind.
+        pkg.save_file('data.bin', 'data3', 'data.bin')
+        assert os.listdir(os.path.dirname(store.temporary_object_path(filehash))) == []
+
+    def test_save_df(self):
+        df = pd.DataFrame(dict(a=[1, 2, 3], b=['x', 'y', 'z']))
+
+        store = PackageStore()
+        pkg = store.create_package(None, 'foo', 'bar')
+        hashes = pkg.save_df(df, 'df', 'df.csv', 'csv', 'pandas', PackageFormat.PARQUET)
+
+        # The hash computed while writing matches the file's contents.
+        assert len(hashes) == 1
+        assert digest_file(store.object_path(hashes[0])) == hashes[0]
+        assert pkg.get_obj(pkg['df']).equals(df)
+
+    def test_read_group(self):
+        df1 = pd.DataFrame(dict(a=[1, 2, 3]))
+        df2 = pd.DataFrame(dict(a=[4, 5]))
+
+        store = PackageStore()
+        pkg = store.create_package(None, 'foo', 'bar')
+        pkg.save_df(df1, 'group/df1', 'df1.csv', 'csv', 'pandas', PackageFormat.PARQUET)
+        pkg.save_df(df2, 'group/df2', 'df2.csv', 'csv', 'pandas', PackageFormat.PARQUET)
+
+        # Reading the fragments concurrently gives the same result as reading them one by one.
+        try:
+            Package.set_parquet_threads(1)
+            serial = pkg.get_obj(pkg['group'])
+            Package.set_parquet_threads(4)
+            concurrent = pkg.get_obj(pkg['group'])
+        finally:
+            Package.reset_parquet_threads()
+
+        assert sorted(serial['a']) == [1, 2, 3, 4, 5]
+        assert concurrent.equals(serial)
@@ -0,0 +1,124 @@
+"""
+Content-defined chunking of large files, in the style of FastCDC.
+
+Chunk boundaries are picked using a gear hash of the last 32 bytes, so they only depend on
+the data around them: inserting or appending data to a file only changes the chunks near
+the edit, and all of the other chunks keep their hashes.
+"""
+import hashlib
+import struct
+
+import numpy as np
+
+from .const import HASH_TYPE
+
+AVG_CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes to hash at a time; the chunks left over are carried over to the next block.
+READ_SIZE = 16 * 1024 * 1024
+
+WINDOW_BITS = 5  # 32-byte window
+
+
+def _gear_table():
+    """
+    256 pseudo-random 32-bit values, one per byte. They are part of the chunk format:
+    changing them changes every chunk boundary.
+    """
+    return np.array([
+        struct.unpack('>I', hashlib.sha256(('quilt-gear-%d' % i).encode()).digest()[:4])[0]
+        for i in range(256)
+    ], dtype=np.uint32)
+
+GEAR = _gear_table()
+
+
+def _mask(bits):
+    """
+    Mask of the top `bits` bits. High bits of the gear hash depend on the whole window;
+    the low bits only depend on the last few bytes.
+    """
+    return np.uint32(((1 << bits) - 1) << (32 - bits))
+
+
+def _gear_hashes(data):
+    """
+    Returns the gear hash of the window ending at each byte of `data`.
+
+    Equivalent to rolling `h = (h << 1) + GEAR[byte]` over the data, but vectorized:
+    each step doubles the window by combining a hash with the one `width` bytes before it.
+    """
+    hashes = GEAR[np.frombuffer(data, dtype=np.uint8)]
+    for step in range(WINDOW_BITS):
+        width = 1 << step
+        shifted = hashes[:-width] << np.uint32(width)
+        hashes[width:] = shifted + hashes[width:]
+    return hashes
+
+
+def _first_candidate(candidates, low, high):
+    """
+    Returns the first candidate in [low, high), or None.
+    """
+    idx = np.searchsorted(candidates, low)
+    if idx < len(candidates) and candidates[idx] < high:
+        return int(candidates[idx])
+    return None
+
+
+def iter_chunks(fd, avg_size=None, min_size=None, max_size=None):
+    """
+    Reads a file object and yields its contents as content-defined chunks.
+
+    Uses FastCDC's normalized chunking: a stricter mask before `avg_size` and a looser one
+    after it, so that chunk sizes cluster around the average. `avg_size` should be a power of 2.
+    """
+    avg_size = AVG_CHUNK_SIZE if avg_size is None else avg_size
+    min_size = avg_size // 4 if min_size is None else min_size
+    max_size = avg_size * 8 if max_size is None else max_size
+    assert min_size > 1 << WINDOW_BITS, "Chunks must be longer than the hash window"
+    assert min_size <= avg_size <= max_size
+
+    bits = int(avg_size).bit_length() - 1
+    mask_small = _mask(bits + 2)
+    mask_large = _mask(bits - 2)
+
+    buf = b''
+    eof = False
+    while not eof:
+        block = fd.read(max(READ_SIZE, max_size))
+        eof = not block
+        buf += block
+
+        # Every chunk starts at least `min_size` bytes after its start, so hashes near
+        # the beginning of the buffer never need the data before it.
+        hashes = _gear_hashes(buf)
+        small = np.flatnonzero((hashes & mask_small) == 0)
+        large = np.flatnonzero((hashes & mask_large) == 0)
+        del hashes
+
+        start = 0
+        while start < len(buf):
+            remaining = len(buf) - start
+            if remaining < max_size and not eof:
+                # Might not have the whole chunk yet.
+                break
+
+            end = start + min(remaining, max_size)
+            cut = None
+            if remaining > min_size:
+                cut = _first_candidate(small, start + min_size - 1, min(start + avg_size - 1, end - 1))
+                if cut is None:
+                    cut = _first_candidate(large, start + avg_size - 1, end - 1)
+            cut = end if cut is None else cut + 1
+
+            yield buf[start:cut]
+            start = cut
+
+        buf = buf[start:]
+
+
+def digest_chunk(chunk):
+    hval = hashlib.new(HASH_TYPE)
+    hval.update(chunk)
+    return hval.hexdigest()
@@ -19,7 +19,7 @@ import stat
 import subprocess
 import sys
 import tempfile
-from threading import Thread, Lock
+from threading import Condition, Thread, Lock
 import time
 import yaml
 
@@ -40,7 +40,7 @@ from .core import (hash_contents, find_object_hashes, PackageFormat, TableNode,
                    decode_node, encode_node, LATEST_TAG)
 from .hashing import digest_file
 from .store import PackageStore, StoreException
-from .util import (BASE_DIR, FileWithReadProgress, gzip_compress,
+from .util import (BASE_DIR, FileSlice, FileWithReadProgress, gzip_compress,
                    is_nodename, PackageInfo, parse_package as parse_package_util,
                    parse_package_extended as parse_package_extended_util)
 from ..imports import _from_core_node
@@ -65,6 +65,7 @@ GIT_URL_RE = re.compile(r'(?P<url>http[s]?://[\w./~_-]+\.git)(?:@(?P<branch>[\w_
 CHUNK_SIZE = 4096
 
 PARALLEL_UPLOADS = 20
+PARALLEL_PART_UPLOADS = 8
 PARALLEL_DOWNLOADS = 20
 
 S3_CONNECT_TIMEOUT = 30
@@ -72,6 +73,19 @@ S3_READ_TIMEOUT = 30
 S3_TIMEOUT_RETRIES = 3
 CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
 
+# Fragments at least this big (before compression) get downloaded as several concurrent byte ranges.
+# Can be overridden with the QUILT_RANGED_DOWNLOAD_THRESHOLD environment variable.
+RANGED_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024
+RANGED_DOWNLOAD_PART_SIZE = 32 * 1024 * 1024
+PARALLEL_RANGES = 8
+
+# Number of fragment URLs to request at a time during install.
+INSTALL_PAGE_SIZE = 1000
+# Number of packages to resolve at a time when installing from a requirements file.
+INSTALL_BATCH_SIZE = 100
+# Number of logs, versions, etc. to request at a time.
+LIST_PAGE_SIZE = 1000
+
 LOG_TIMEOUT = 3  # 3 seconds
 
 VERSION = pkg_resources.require('quilt')[0].version
@@ -316,6 +330,21 @@ def _open_url(url):
     except Exception as ex:     # pylint:disable=W0703
         print("Failed to launch the browser: %s" % ex)
 
+def _iter_pages(session, url, key):
+    """
+    Yields the items of a paginated registry list, getting the pages as needed.
+    """
+    params = dict(limit=LIST_PAGE_SIZE)
+    while True:
+        data = session.get(url, params=params).json()
+        for item in data[key]:
+            yield item
+        # Older registries return everything at once.
+        cursor = data.get('next_cursor')
+        if cursor is None:
+            break
+        params['cursor'] = cursor
+
 def _match_hash(package, hash):
     team, owner, pkg = parse_package(package)
     session = _get_session(team)
@@ -331,16 +360,30 @@ def _match_hash(package, hash):
     if len(hash) == 64:
         return hash
 
-    response = session.get(
-        "{url}/api/log/{owner}/{pkg}/".format(
-            url=get_registry_url(team),
-            owner=owner,
-            pkg=pkg
+    try:
+        response = session.get(
+            "{url}/api/hash/{owner}/{pkg}/{prefix}".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg,
+                prefix=hash
+            )
         )
-    )
-
-    matches = set(entry['hash'] for entry in response.json()['logs']
-                  if entry['hash'].startswith(hash))
+        matches = set(response.json()['hashes'])
+    except HTTPResponseException as ex:
+        if ex.response.status_code != requests.codes.not_found:
+            raise
+        # Older registries can't match hashes; search the whole log instead.
+        logs = _iter_pages(
+            session,
+            "{url}/api/log/{owner}/{pkg}/".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg
+            ),
+            'logs'
+        )
+        matches = set(entry['hash'] for entry in logs if entry['hash'].startswith(hash))
 
     if len(matches) == 1:
         return matches.pop()
@@ -352,6 +395,15 @@ def _match_hash(package, hash):
             .format(package=package, hash=hash, ambiguous=ambiguous))
     raise CommandException("Invalid hash for package {package}: {hash}".format(package=package, hash=hash))
 
+def _sort_by_size(obj_hashes, obj_sizes):
+    """
+    Returns the hashes ordered so that `pop()` yields the largest fragment first.
+
+    Transferring the largest fragments first keeps one thread from being stuck with a huge
+    fragment at the very end, while the small ones fill in the gaps. Unknown sizes count as 0.
+    """
+    return sorted(obj_hashes, key=lambda obj_hash: (obj_sizes.get(obj_hash) or 0, obj_hash))
+
 def _find_logged_in_team():
     """
     Find a team name in the auth credentials.
@@ -645,22 +697,116 @@ def log(package):
     team, owner, pkg = parse_package(package)
     session = _get_session(team)
 
-    response = session.get(
+    logs = list(_iter_pages(
+        session,
         "{url}/api/log/{owner}/{pkg}/".format(
             url=get_registry_url(team),
             owner=owner,
             pkg=pkg
-        )
-    )
+        ),
+        'logs'
+    ))
 
     format_str = "%-64s %-19s %s"
 
     print(format_str % ("Hash", "Pushed", "Author"))
-    for entry in reversed(response.json()['logs']):
+    for entry in reversed(logs):
         ugly = datetime.fromtimestamp(entry['created'])
         nice = ugly.strftime("%Y-%m-%d %H:%M:%S")
         print(format_str % (entry['hash'], nice, entry['author']))
 
+def _abort_multipart_upload(s3_session, multipart):
+    """
+    Aborts a multipart upload started by the registry, so S3 doesn't keep its parts around.
+    Errors are ignored: an unfinished upload doesn't affect the object.
+    """
+    try:
+        s3_session.delete(multipart['abort'])
+    except requests.exceptions.RequestException:
+        pass
+
+def _upload_parts(multipart, temp_file, compressed_size, progress_cb, lock):
+    """
+    Uploads a gzip'ed fragment using a multipart upload started by the registry.
+
+    Parts are uploaded by up to `PARALLEL_PART_UPLOADS` threads, and each part is retried
+    on its own. If a part still fails, the upload is aborted and the error is re-raised.
+    """
+    part_size = multipart['part_size']
+    num_parts = max(-(-compressed_size // part_size), 1)
+    if num_parts > len(multipart['parts']):
+        with _create_s3_session() as s3_session:
+            _abort_multipart_upload(s3_session, multipart)
+        raise CommandException("Compressed fragment is too big for the multipart upload.")
+
+    part_queue = list(reversed(range(num_parts)))
+    etags = [None] * num_parts
+    errors = []
+    file_lock = Lock()
+
+    def _part_thread():
+        with _create_s3_session() as s3_session:
+            while True:
+                with lock:
+                    if not part_queue or errors:
+                        break
+                    idx = part_queue.pop()
+
+                offset = idx * part_size
+                length = min(part_size, compressed_size - offset)
+                for attempt in range(S3_TIMEOUT_RETRIES):
+                    part = FileSlice(temp_file, offset, length, file_lock)
+                    # Bytes reported by this attempt; the body can get rewound and read again.
+                    reported = [0]
+
+                    def _part_progress_cb(count, reported=reported):
+                        reported[0] += count
+                        progress_cb(count)
+
+                    try:
+                        with FileWithReadProgress(part, _part_progress_cb) as fd:
+                            response = s3_session.put(multipart['parts'][idx], data=fd)
+                        response.raise_for_status()
+                        etags[idx] = response.headers['ETag']
+                        break
+                    except requests.exceptions.RequestException as ex:
+                        # Undo the progress of the failed attempt.
+                        progress_cb(-reported[0])
+                        if attempt < S3_TIMEOUT_RETRIES - 1:
+                            with lock:
+                                tqdm.write("Upload of part %d failed; retrying..." % (idx + 1))
+                        else:
+                            with lock:
+                                errors.append(ex)
+
+    threads = [
+        Thread(target=_part_thread, name="part-upload-worker-%d" % i)
+        for i in range(min(PARALLEL_PART_UPLOADS, num_parts))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with _create_s3_session() as s3_session:
+        if errors:
+            _abort_multipart_upload(s3_session, multipart)
+            raise errors[0]
+
+        body = ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (idx + 1, etag)
+            for idx, etag in enumerate(etags)
+        )
+        response = s3_session.post(
+            multipart['complete'],
+            data='<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % body
+        )
+        response.raise_for_status()
+        # S3 can report an error after it has already sent a 200.
+        if '<Error>' in response.text:
+            raise requests.exceptions.HTTPError("Failed to complete the upload", response=response)
+
 def push(package, is_public=False, is_team=False, reupload=False):
     """
     Push a Quilt data package to the server
@@ -675,15 +821,21 @@ def push(package, is_public=False, is_team=False, reupload=False):
 
     pkghash = pkgobj.get_hash()
 
-    def _push_package(dry_run=False, sizes=dict()):
-        data = json.dumps(dict(
-            dry_run=dry_run,
-            is_public=is_public,
-            is_team=is_team,
-            contents=pkgobj.get_contents(),
-            description="",  # TODO
-            sizes=sizes
-        ), default=encode_node)
+    def _push_package(dry_run=False, sizes=dict(), push_session=None):
+        if push_session is not None:
+            # The registry kept the contents from the dry run.
+            data = json.dumps(dict(
+                push_session=push_session
+            ))
+        else:
+            data = json.dumps(dict(
+                dry_run=dry_run,
+                is_public=is_public,
+                is_team=is_team,
+                contents=pkgobj.get_contents(),
+                description="",  # TODO
+                sizes=sizes
+            ), default=encode_node)
 
         compressed_data = gzip_compress(data.encode('utf-8'))
 
@@ -700,16 +852,22 @@ def push(package, is_public=False, is_team=False, reupload=False):
             }
         )
 
+    obj_sizes = {
+        obj_hash: os.path.getsize(pkgobj.get_store().object_path(obj_hash))
+        for obj_hash in set(find_object_hashes(pkgobj.get_contents()))
+    }
+
     print("Fetching upload URLs from the registry...")
-    resp = _push_package(dry_run=True)
+    # Sizes let the registry decide which fragments to upload in parts.
+    resp = _push_package(dry_run=True, sizes=obj_sizes)
     upload_urls = resp.json()['upload_urls']
+    # Fragments the registry already has; older registries don't return them.
+    existing = set(resp.json().get('existing', []))
+    # Lets us skip sending the contents again; older registries don't return it.
+    push_session = resp.json().get('push_session')
 
-    obj_queue = sorted(set(find_object_hashes(pkgobj.get_contents())), reverse=True)
+    obj_queue = _sort_by_size(obj_sizes, obj_sizes)
     total = len(obj_queue)
-
-    obj_sizes = {
-        obj_hash: os.path.getsize(pkgobj.get_store().object_path(obj_hash)) for obj_hash in obj_queue
-    }
     total_bytes = sum(itervalues(obj_sizes))
 
     uploaded = []
@@ -719,6 +877,8 @@ def push(package, is_public=False, is_team=False, reupload=False):
         'Content-Encoding': 'gzip'
     }
 
+    if existing and not reupload:
+        print("%d fragments are already uploaded." % len(existing))
     print("Uploading %d fragments (%d bytes before compression)..." % (total, total_bytes))
 
     with tqdm(total=total_bytes, unit='B', unit_scale=True) as progress:
@@ -735,7 +895,7 @@ def push(package, is_public=False, is_team=False, reupload=False):
 
                         original_size = os.path.getsize(pkgobj.get_store().object_path(obj_hash))
 
-                        if reupload or not s3_session.head(obj_urls['head']).ok:
+                        if reupload or (obj_hash not in existing and not s3_session.head(obj_urls['head']).ok):
                             # Create a temporary gzip'ed file.
                             with pkgobj.tempfile(obj_hash) as temp_file:
                                 temp_file.seek(0, 2)
@@ -748,23 +908,42 @@ def push(package, is_public=False, is_team=False, reupload=False):
                                     original_last_update = 0
 
                                 def _progress_cb(count):
-                                    Context.compressed_read += count
-                                    original_read = Context.compressed_read * original_size // compressed_size
+                                    # Parts of a multipart upload report progress from several threads.
                                     with lock:
+                                        Context.compressed_read += count
+                                        original_read = Context.compressed_read * original_size // compressed_size
                                         progress.update(original_read - Context.original_last_update)
-                                    Context.original_last_update = original_read
-
-                                with FileWithReadProgress(temp_file, _progress_cb) as fd:
-                                    url = obj_urls['put']
-                                    response = s3_session.put(url, data=fd, headers=headers)
-                                    response.raise_for_status()
+                                        Context.original_last_update = original_read
+
+                                if obj_urls.get('multipart'):
+                                    # The registry starts the upload only once we need it.
+                                    multipart = session.post(
+                                        "{url}/api/multipart_upload/{owner}/{hash}".format(
+                                            url=get_registry_url(team),
+                                            owner=owner,
+                                            hash=obj_hash
+                                        ),
+                                        data=json.dumps(dict(
+                                            size=original_size
+                                        ))
+                                    ).json()
+                                    _upload_parts(multipart, temp_file, compressed_size, _progress_cb, lock)
+                                else:
+                                    with FileWithReadProgress(temp_file, _progress_cb) as fd:
+                                        url = obj_urls['put']
+                                        response = s3_session.put(url, data=fd, headers=headers)
+                                        response.raise_for_status()
                         else:
                             with lock:
-                                tqdm.write("Fragment %s already uploaded; skipping." % obj_hash)
+                                if obj_hash not in existing:
+                                    tqdm.write("Fragment %s already uploaded; skipping." % obj_hash)
                                 progress.update(original_size)
 
                         with lock:
                             uploaded.append(obj_hash)
+                    except CommandException as ex:
+                        with lock:
+                            tqdm.write("Upload failed for %s: %s" % (obj_hash, ex))
                     except requests.exceptions.RequestException as ex:
                         message = "Upload failed for %s:\n" % obj_hash
                         if ex.response is not None:
@@ -791,7 +970,13 @@ def push(package, is_public=False, is_team=False, reupload=False):
         raise CommandException("Failed to upload fragments")
 
     print("Uploading package metadata...")
-    resp = _push_package(sizes=obj_sizes)
+    try:
+        resp = _push_package(sizes=obj_sizes, push_session=push_session)
+    except HTTPResponseException as ex:
+        if push_session is None or ex.response.status_code != requests.codes.gone:
+            raise
+        # The session expired during a long upload; send everything.
+        resp = _push_package(sizes=obj_sizes)
     package_url = resp.json()['package_url']
 
     print("Updating the 'latest' tag...")
@@ -816,15 +1001,17 @@ def version_list(package):
     team, owner, pkg = parse_package(package)
     session = _get_session(team)
 
-    response = session.get(
+    versions = _iter_pages(
+        session,
         "{url}/api/version/{owner}/{pkg}/".format(
             url=get_registry_url(team),
             owner=owner,
             pkg=pkg
-        )
+        ),
+        'versions'
     )
 
-    for version in response.json()['versions']:
+    for version in versions:
         print("%s: %s" % (version['version'], version['hash']))
 
 def version_add(package, version, pkghash, force=False):
@@ -869,15 +1056,17 @@ def tag_list(package):
     team, owner, pkg = parse_package(package)
     session = _get_session(team)
 
-    response = session.get(
+    tags = _iter_pages(
+        session,
         "{url}/api/tag/{owner}/{pkg}/".format(
             url=get_registry_url(team),
             owner=owner,
             pkg=pkg
-        )
+        ),
+        'tags'
     )
 
-    for tag in response.json()['tags']:
+    for tag in tags:
         print("%s: %s" % (tag['tag'], tag['hash']))
 
 def tag_add(package, tag, pkghash):
@@ -932,10 +1121,499 @@ def install_via_requirements(requirements_str, force=False):
             raise CommandException("Requirements file not found: {filename}".format(filename=path))
     else:
         yaml_data = yaml.load(requirements_str)
-    for pkginfo in yaml_data['packages']:
-        info = parse_package_extended(pkginfo)
+    infos = [parse_package_extended(pkginfo) for pkginfo in yaml_data['packages']]
+    _install_batch(infos, force=force)
+
+def _install_batch_request(info):
+    request = dict(owner=info.user, name=info.name)
+    if info.hash is not None:
+        request['hash'] = info.hash
+    elif info.version is not None:
+        request['version'] = info.version
+    elif info.tag is not None:
+        request['tag'] = info.tag
+    if info.subpath:
+        request['subpath'] = '/'.join(info.subpath)
+    return request
+
+def _install_batch(infos, force=False):
+    """
+    Installs several packages at once: resolves all of them with one request per registry
+    (per INSTALL_BATCH_SIZE packages), downloads all of their fragments using a single pool of threads,
+    and saves the packages once all of the fragments are there.
+    """
+    store = PackageStore()
+
+    # Registries in the order they first appear.
+    teams = []
+    for info in infos:
+        _check_team_id(info.team)
+        if info.team not in teams:
+            teams.append(info.team)
+
+    print("Downloading package metadata...")
+
+    results = [None] * len(infos)
+    # Packages from registries that can't install in batches.
+    serial = []
+    for team in teams:
+        session = _get_session(team)
+        indexes = [idx for idx, info in enumerate(infos) if info.team == team]
+        for start in range(0, len(indexes), INSTALL_BATCH_SIZE):
+            batch = indexes[start:start+INSTALL_BATCH_SIZE]
+            try:
+                response = session.post(
+                    "{url}/api/install_batch/".format(url=get_registry_url(team)),
+                    data=json.dumps(dict(
+                        packages=[_install_batch_request(infos[idx]) for idx in batch],
+                        limit=INSTALL_PAGE_SIZE
+                    ))
+                )
+            except HTTPResponseException as ex:
+                if ex.response.status_code != requests.codes.not_found:
+                    raise
+                # Older registries can't do this; their packages get installed one at a time.
+                serial.extend(idx for idx in indexes if results[idx] is None)
+                break
+
+            for idx, result in zip(batch, response.json(object_hook=decode_node)['packages']):
+                error = result.get('error')
+                if error is not None:
+                    raise CommandException("{package}: {message}".format(
+                        package=infos[idx].full_name, message=error['message']))
+                results[idx] = (session, result)
+
+    obj_urls = {}
+    obj_sizes = {}
+    page_sources = []
+    required = set()
+    pkgobjs = []
+
+    for info, batch_result in zip(infos, results):
+        if batch_result is None:
+            continue
+        session, result = batch_result
+        pkghash = result['hash']
+        dataset = result['package']
+        contents = dataset['contents']
+
+        # Verify contents hash
+        if pkghash != hash_contents(contents):
+            raise CommandException("Mismatched hash for {package}. Try again.".format(package=info.full_name))
+
+        if store.get_package(info.team, info.user, info.name) is not None and not force:
+            print("{package} already installed.".format(package=info.full_name))
+            overwrite = input("Overwrite? (y/n) ")
+            if overwrite.lower() != 'y':
+                continue
+
+        pkgobj = store.install_package(info.team, info.user, info.name, contents)
+        pkgobjs.append(pkgobj)
+
+        subnode = contents
+        for component in info.subpath:
+            subnode = subnode.children[component]
+        required.update(find_object_hashes(subnode))
+
+        # Packages often share fragments; only download them once.
+        for obj_hash, url in iteritems(dataset['urls']):
+            if obj_hash not in obj_urls:
+                obj_urls[obj_hash] = url
+                obj_sizes[obj_hash] = dataset['sizes'].get(obj_hash)
+
+        # Older registries return all of the URLs at once.
+        next_cursor = dataset.get('next_cursor')
+        if next_cursor is not None:
+            package_url = "{url}/api/package/{owner}/{pkg}/{hash}".format(
+                url=get_registry_url(info.team),
+                owner=info.user,
+                pkg=info.name,
+                hash=pkghash
+            )
+            page_sources.append((session, package_url, dict(subpath='/'.join(info.subpath)), next_cursor))
+
+    if pkgobjs:
+        # Some objects might be missing a size; ignore those for now.
+        total_bytes = sum(size or 0 for size in itervalues(obj_sizes))
+        print("Downloading %d fragments (%d bytes before compression)..." % (len(required), total_bytes))
+
+        downloaded = _download_fragments(store, obj_urls, obj_sizes, page_sources)
+
+        if not required.issubset(downloaded):
+            raise CommandException("Failed to download fragments")
+
+        # Only save the packages once all of them are complete.
+        for pkgobj in pkgobjs:
+            pkgobj.save_contents()
+
+    for idx in serial:
+        info = infos[idx]
         install(info.full_name, info.hash, info.version, info.tag, force=force)
 
+def _get_ranged_download_threshold():
+    threshold = os.environ.get('QUILT_RANGED_DOWNLOAD_THRESHOLD')
+    if threshold is None:
+        return RANGED_DOWNLOAD_THRESHOLD
+    try:
+        return int(threshold)
+    except ValueError:
+        raise CommandException("QUILT_RANGED_DOWNLOAD_THRESHOLD must be a number of bytes.")
+
+def _download_range(s3_session, url, obj_hash, path, start, end, on_progress, lock):
+    """
+    Downloads bytes `start` through `end` (inclusive) of a fragment into the same offsets of `path`,
+    resuming from the last received byte after a connection error. `end` may lie past the end
+    of the fragment.
+
+    Returns the total (compressed) size of the fragment, or None if the download failed.
+    """
+    offset = start
+    total_size = None
+    with open(path, 'r+b') as output_file:
+        for attempt in range(S3_TIMEOUT_RETRIES):
+            if offset > end:
+                return total_size
+            try:
+                response = s3_session.get(
+                    url,
+                    headers={
+                        'Range': 'bytes=%d-%d' % (offset, end)
+                    },
+                    stream=True,
+                    timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
+                )
+
+                if not response.ok:
+                    message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
+                        obj_hash, response.request.url, response.status_code, response.text
+                    )
+                    with lock:
+                        tqdm.write(message)
+                    return None
+
+                # See the comment in `_download_stream`.
+                response.raw.headers.pop('Content-Encoding', None)
+
+                content_range = response.headers.get('Content-Range', '')
+                match = CONTENT_RANGE_RE.match(content_range)
+                if not match or not int(match.group(1)) == offset:
+                    with lock:
+                        tqdm.write("Unexpected Content-Range: %s" % content_range)
+                    return None
+
+                total_size = int(match.group(3))
+                end = min(end, total_size - 1)
+
+                output_file.seek(offset)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    output_file.write(chunk)
+                    offset += len(chunk)
+                    on_progress(len(chunk), total_size)
+
+                return total_size
+            except requests.exceptions.ConnectionError as ex:
+                if attempt < S3_TIMEOUT_RETRIES - 1:
+                    with lock:
+                        tqdm.write("Download for %s timed out; retrying..." % obj_hash)
+                else:
+                    with lock:
+                        tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
+                    return None
+
+    return None
+
+def _download_ranged(url, obj_hash, temp_path_gz, original_size, progress, lock):
+    """
+    Downloads a large fragment as `RANGED_DOWNLOAD_PART_SIZE` byte ranges, fetched by up to
+    `PARALLEL_RANGES` threads and written directly into their place in a preallocated `temp_path_gz`.
+
+    Unlike `_download_stream`, this does not resume a partial download left by an earlier install.
+
+    Returns True on success; failures are reported through `tqdm.write`.
+    """
+    compressed_read = [0]
+    original_read = [0]
+
+    def _on_progress(length, compressed_size):
+        with lock:
+            compressed_read[0] += length
+            original_last_update = original_read[0]
+            original_read[0] = compressed_read[0] * original_size // compressed_size
+            progress.update(original_read[0] - original_last_update)
+
+    # Presigned GET URLs can't be used for HEAD requests, so the first range also tells us the size.
+    open(temp_path_gz, 'wb').close()
+    with _create_s3_session() as s3_session:
+        compressed_size = _download_range(s3_session, url, obj_hash, temp_path_gz,
+                                          0, RANGED_DOWNLOAD_PART_SIZE - 1, _on_progress, lock)
+    if compressed_size is None:
+        return False
+
+    with open(temp_path_gz, 'r+b') as output_file:
+        output_file.truncate(compressed_size)
+
+    range_queue = [
+        (start, min(start + RANGED_DOWNLOAD_PART_SIZE, compressed_size) - 1)
+        for start in range(RANGED_DOWNLOAD_PART_SIZE, compressed_size, RANGED_DOWNLOAD_PART_SIZE)
+    ]
+    range_queue.reverse()
+    failed = []
+
+    def _range_thread():
+        with _create_s3_session() as s3_session:
+            while True:
+                with lock:
+                    if not range_queue or failed:
+                        break
+                    start, end = range_queue.pop()
+
+                if _download_range(s3_session, url, obj_hash, temp_path_gz,
+                                   start, end, _on_progress, lock) is None:
+                    with lock:
+                        failed.append((start, end))
+
+    threads = [
+        Thread(target=_range_thread, name="range-download-worker-%d" % i)
+        for i in range(min(PARALLEL_RANGES, len(range_queue)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if failed:
+        os.remove(temp_path_gz)
+        return False
+    return True
+
+def _download_stream(s3_session, url, obj_hash, temp_path_gz, original_size, progress, lock):
+    """
+    Downloads a fragment over a single connection, appending to (and so resuming) `temp_path_gz`.
+
+    Returns True on success; failures are reported through `tqdm.write`.
+    """
+    with open(temp_path_gz, 'ab') as output_file:
+        for attempt in range(S3_TIMEOUT_RETRIES):
+            try:
+                starting_length = output_file.tell()
+                response = s3_session.get(
+                    url,
+                    headers={
+                        'Range': 'bytes=%d-' % starting_length
+                    },
+                    stream=True,
+                    timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
+                )
+
+                # RANGE_NOT_SATISFIABLE means, we already have the whole file.
+                if response.status_code == requests.codes.RANGE_NOT_SATISFIABLE:
+                    with lock:
+                        progress.update(original_size)
+                else:
+                    if not response.ok:
+                        message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
+                            obj_hash, response.request.url, response.status_code, response.text
+                        )
+                        with lock:
+                            tqdm.write(message)
+                        return False
+
+                    # Fragments have the 'Content-Encoding: gzip' header set to make requests ungzip
+                    # them automatically - but that turned out to be a bad idea because it makes
+                    # resuming downloads impossible.
+                    # HACK: For now, just delete the header. Eventually, update the data in S3.
+                    response.raw.headers.pop('Content-Encoding', None)
+
+                    # Make sure we're getting the expected range.
+                    content_range = response.headers.get('Content-Range', '')
+                    match = CONTENT_RANGE_RE.match(content_range)
+                    if not match or not int(match.group(1)) == starting_length:
+                        with lock:
+                            tqdm.write("Unexpected Content-Range: %s" % content_range)
+                        return False
+
+                    compressed_size = int(match.group(3))
+
+                    # We may have started with a partially-downloaded file, so update the progress bar.
+                    compressed_read = starting_length
+                    original_read = compressed_read * original_size // compressed_size
+                    with lock:
+                        progress.update(original_read)
+                    original_last_update = original_read
+
+                    # Do the actual download.
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        output_file.write(chunk)
+                        compressed_read += len(chunk)
+                        original_read = compressed_read * original_size // compressed_size
+                        with lock:
+                            progress.update(original_read - original_last_update)
+                        original_last_update = original_read
+
+                return True  # Done!
+            except requests.exceptions.ConnectionError as ex:
+                if attempt < S3_TIMEOUT_RETRIES - 1:
+                    with lock:
+                        tqdm.write("Download for %s timed out; retrying..." % obj_hash)
+                else:
+                    with lock:
+                        tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
+                    return False
+
+    return False
+
+def _download_fragments(store, obj_urls, obj_sizes, page_sources):
+    """
+    Downloads fragments into the store using a pool of PARALLEL_DOWNLOADS threads;
+    fragments that are already in the store are skipped, and ones in the other
+    package stores (QUILT_PACKAGE_DIRS) get linked or copied from there.
+
+    `obj_urls` and `obj_sizes` are the signed URLs and sizes we already have.
+    `page_sources` is a list of `(session, package_url, params, cursor)` of packages
+    whose remaining pages of URLs get fetched while the first ones are downloading.
+    Fragments that show up more than once only get downloaded once.
+
+    Returns the set of hashes of the downloaded fragments.
+    """
+    obj_queue = [(obj_hash, obj_urls[obj_hash]) for obj_hash in _sort_by_size(obj_urls, obj_sizes)]
+    queued = set(obj_urls)
+    # Some objects might be missing a size; ignore those for now.
+    total_bytes = sum(size or 0 for size in itervalues(obj_sizes))
+
+    ranged_threshold = _get_ranged_download_threshold()
+
+    downloaded = set()
+    # Number and size of fragments found in other package stores.
+    reused = [0, 0]
+    lock = Lock()
+    # Signalled whenever a new page of URLs arrives, or there are no more pages.
+    page_cond = Condition(lock)
+    fetching = [bool(page_sources)]
+
+    with tqdm(total=total_bytes, unit='B', unit_scale=True) as progress:
+        def _fetch_pages():
+            # Get the rest of the URLs while the first pages are downloading.
+            try:
+                for session, package_url, params, cursor in page_sources:
+                    while cursor is not None:
+                        page = session.get(
+                            package_url,
+                            params=dict(
+                                params,
+                                limit=INSTALL_PAGE_SIZE,
+                                cursor=cursor
+                            )
+                        ).json()
+                        with lock:
+                            page_urls = {
+                                obj_hash: url for obj_hash, url in iteritems(page['urls'])
+                                if obj_hash not in queued
+                            }
+                            page_sizes = {obj_hash: page['sizes'].get(obj_hash) for obj_hash in page_urls}
+                            queued.update(page_urls)
+                            obj_sizes.update(page_sizes)
+                            # Workers pop from the end, so finish the current page first.
+                            obj_queue[:0] = [
+                                (obj_hash, page_urls[obj_hash]) for obj_hash in _sort_by_size(page_urls, page_sizes)
+                            ]
+                            progress.total += sum(size or 0 for size in itervalues(page_sizes))
+                            progress.refresh()
+                            page_cond.notify_all()
+                        cursor = page['next_cursor']
+            except Exception as ex:  # pylint:disable=broad-except
+                with lock:
+                    tqdm.write("Failed to get fragment URLs: %s" % ex)
+            finally:
+                with lock:
+                    fetching[0] = False
+                    page_cond.notify_all()
+
+        def _worker_thread():
+            with _create_s3_session() as s3_session:
+                while True:
+                    with lock:
+                        while not obj_queue and fetching[0]:
+                            page_cond.wait()
+                        if not obj_queue:
+                            break
+                        obj_hash, url = obj_queue.pop()
+                        original_size = obj_sizes.get(obj_hash) or 0  # If the size is unknown, just treat it as 0.
+
+                    local_filename = store.object_path(obj_hash)
+                    if os.path.exists(local_filename):
+                        with lock:
+                            progress.update(original_size)
+                            downloaded.add(obj_hash)
+                        continue
+
+                    # Reuse the fragment if another package store already has it.
+                    try:
+                        imported = store.import_object(obj_hash) is not None
+                    except (IOError, OSError) as ex:
+                        with lock:
+                            tqdm.write("Failed to reuse fragment %s: %s" % (obj_hash, ex))
+                        imported = False
+                    if imported:
+                        with lock:
+                            progress.update(original_size)
+                            downloaded.add(obj_hash)
+                            reused[0] += 1
+                            reused[1] += original_size
+                        continue
+
+                    temp_path_gz = store.temporary_object_path(obj_hash + '.gz')
+                    if obj_sizes.get(obj_hash) is not None and obj_sizes[obj_hash] >= ranged_threshold:
+                        success = _download_ranged(url, obj_hash, temp_path_gz, original_size, progress, lock)
+                    else:
+                        success = _download_stream(s3_session, url, obj_hash, temp_path_gz, original_size,
+                                                   progress, lock)
+
+                    if not success:
+                        # We've already printed an error, so not much to do - just move on to the next object.
+                        continue
+
+                    # Ungzip the downloaded fragment.
+                    temp_path = store.temporary_object_path(obj_hash)
+                    try:
+                        with gzip.open(temp_path_gz, 'rb') as f_in, open(temp_path, 'wb') as f_out:
+                            copyfileobj(f_in, f_out)
+                    finally:
+                        # Delete the file unconditionally - in case it's corrupted and cannot be ungzipped.
+                        os.remove(temp_path_gz)
+
+                    # Check the hash of the result.
+                    file_hash = digest_file(temp_path)
+                    if file_hash != obj_hash:
+                        os.remove(temp_path)
+                        with lock:
+                            tqdm.write("Fragment hashes do not match: expected %s, got %s." %
+                                       (obj_hash, file_hash))
+                            continue
+
+                    move(temp_path, local_filename)
+
+                    # Success.
+                    with lock:
+                        downloaded.add(obj_hash)
+
+        threads = [
+            Thread(target=_worker_thread, name="download-worker-%d" % i)
+            for i in range(PARALLEL_DOWNLOADS)
+        ]
+        if page_sources:
+            threads.append(Thread(target=_fetch_pages, name="page-fetcher"))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if reused[0]:
+        print("Reused %d fragments (%d bytes before compression) from other package stores." % tuple(reused))
+
+    return downloaded
+
 def install(package, hash=None, version=None, tag=None, force=False):
     """
     Download a Quilt data package from the server and install locally.
@@ -1000,15 +1678,17 @@ def install(package, hash=None, version=None, tag=None, force=False):
 
     assert pkghash is not None
 
+    package_url = "{url}/api/package/{owner}/{pkg}/{hash}".format(
+        url=get_registry_url(team),
+        owner=owner,
+        pkg=pkg,
+        hash=pkghash
+    )
     response = session.get(
-        "{url}/api/package/{owner}/{pkg}/{hash}".format(
-            url=get_registry_url(team),
-            owner=owner,
-            pkg=pkg,
-            hash=pkghash
-        ),
+        package_url,
         params=dict(
-            subpath='/'.join(subpath)
+            subpath='/'.join(subpath),
+            limit=INSTALL_PAGE_SIZE
         )
     )
     assert response.ok # other responses handled by _handle_response
@@ -1023,6 +1703,8 @@ def install(package, hash=None, version=None, tag=None, force=False):
     response_urls = dataset['urls']
     response_contents = dataset['contents']
     obj_sizes = dataset['sizes']
+    # Older registries return all of the URLs at once.
+    next_cursor = dataset.get('next_cursor')
 
     # Verify contents hash
     if pkghash != hash_contents(response_contents):
@@ -1030,142 +1712,20 @@ def install(package, hash=None, version=None, tag=None, force=False):
 
     pkgobj = store.install_package(team, owner, pkg, response_contents)
 
-    obj_queue = sorted(iteritems(response_urls), reverse=True)
-    total = len(obj_queue)
+    subnode = response_contents
+    for component in subpath:
+        subnode = subnode.children[component]
+    total = len(set(find_object_hashes(subnode)))
+
     # Some objects might be missing a size; ignore those for now.
     total_bytes = sum(size or 0 for size in itervalues(obj_sizes))
 
-    downloaded = []
-    lock = Lock()
-
     print("Downloading %d fragments (%d bytes before compression)..." % (total, total_bytes))
 
-    with tqdm(total=total_bytes, unit='B', unit_scale=True) as progress:
-        def _worker_thread():
-            with _create_s3_session() as s3_session:
-                while True:
-                    with lock:
-                        if not obj_queue:
-                            break
-                        obj_hash, url = obj_queue.pop()
-                        original_size = obj_sizes[obj_hash] or 0  # If the size is unknown, just treat it as 0.
-
-                    local_filename = store.object_path(obj_hash)
-                    if os.path.exists(local_filename):
-                        with lock:
-                            progress.update(original_size)
-                            downloaded.append(obj_hash)
-                        continue
-
-                    success = False
-
-                    temp_path_gz = store.temporary_object_path(obj_hash + '.gz')
-                    with open(temp_path_gz, 'ab') as output_file:
-                        for attempt in range(S3_TIMEOUT_RETRIES):
-                            try:
-                                starting_length = output_file.tell()
-                                response = s3_session.get(
-                                    url,
-                                    headers={
-                                        'Range': 'bytes=%d-' % starting_length
-                                    },
-                                    stream=True,
-                                    timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
-                                )
-
-                                # RANGE_NOT_SATISFIABLE means, we already have the whole file.
-                                if response.status_code == requests.codes.RANGE_NOT_SATISFIABLE:
-                                    with lock:
-                                        progress.update(original_size)
-                                else:
-                                    if not response.ok:
-                                        message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
-                                            obj_hash, response.request.url, response.status_code, response.text
-                                        )
-                                        with lock:
-                                            tqdm.write(message)
-                                        break
-
-                                    # Fragments have the 'Content-Encoding: gzip' header set to make requests ungzip
-                                    # them automatically - but that turned out to be a bad idea because it makes
-                                    # resuming downloads impossible.
-                                    # HACK: For now, just delete the header. Eventually, update the data in S3.
-                                    response.raw.headers.pop('Content-Encoding', None)
-
-                                    # Make sure we're getting the expected range.
-                                    content_range = response.headers.get('Content-Range', '')
-                                    match = CONTENT_RANGE_RE.match(content_range)
-                                    if not match or not int(match.group(1)) == starting_length:
-                                        with lock:
-                                            tqdm.write("Unexpected Content-Range: %s" % content_range)
-                                        break
-
-                                    compressed_size = int(match.group(3))
-
-                                    # We may have started with a partially-downloaded file, so update the progress bar.
-                                    compressed_read = starting_length
-                                    original_read = compressed_read * original_size // compressed_size
-                                    with lock:
-                                        progress.update(original_read)
-                                    original_last_update = original_read
-
-                                    # Do the actual download.
-                                    for chunk in response.iter_content(CHUNK_SIZE):
-                                        output_file.write(chunk)
-                                        compressed_read += len(chunk)
-                                        original_read = compressed_read * original_size // compressed_size
-                                        with lock:
-                                            progress.update(original_read - original_last_update)
-                                        original_last_update = original_read
-
-                                success = True
-                                break  # Done!
-                            except requests.exceptions.ConnectionError as ex:
-                                if attempt < S3_TIMEOUT_RETRIES - 1:
-                                    with lock:
-                                        tqdm.write("Download for %s timed out; retrying..." % obj_hash)
-                                else:
-                                    with lock:
-                                        tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
-                                    break
-
-                    if not success:
-                        # We've already printed an error, so not much to do - just move on to the next object.
-                        continue
-
-                    # Ungzip the downloaded fragment.
-                    temp_path = store.temporary_object_path(obj_hash)
-                    try:
-                        with gzip.open(temp_path_gz, 'rb') as f_in, open(temp_path, 'wb') as f_out:
-                            copyfileobj(f_in, f_out)
-                    finally:
-                        # Delete the file unconditionally - in case it's corrupted and cannot be ungzipped.
-                        os.remove(temp_path_gz)
-
-                    # Check the hash of the result.
-                    file_hash = digest_file(temp_path)
-                    if file_hash != obj_hash:
-                        os.remove(temp_path)
-                        with lock:
-                            tqdm.write("Fragment hashes do not match: expected %s, got %s." %
-                                       (obj_hash, file_hash))
-                            continue
-
-                    move(temp_path, local_filename)
-
-                    # Success.
-                    with lock:
-                        downloaded.append(obj_hash)
-
-        threads = [
-            Thread(target=_worker_thread, name="download-worker-%d" % i)
-            for i in range(PARALLEL_DOWNLOADS)
-        ]
-        for thread in threads:
-            thread.daemon = True
-            thread.start()
-        for thread in threads:
-            thread.join()
+    page_sources = []
+    if next_cursor is not None:
+        page_sources.append((session, package_url, dict(subpath='/'.join(subpath)), next_cursor))
+    downloaded = _download_fragments(store, response_urls, obj_sizes, page_sources)
 
     if len(downloaded) != total:
         raise CommandException("Failed to download fragments")
@@ -1278,6 +1838,22 @@ def delete(package):
     session.delete("%s/api/package/%s/%s/" % (get_registry_url(team), owner, pkg))
     print("Deleted.")
 
+def _search_packages(session, team, query):
+    """
+    Returns all of the packages matching the query, following the registry's pages.
+    """
+    params = dict(q=query)
+    packages = []
+    while True:
+        response = session.get("%s/api/search/" % get_registry_url(team), params=params)
+        data = response.json()
+        packages.extend(data['packages'])
+        # Older registries return all of the results at once.
+        next_offset = data.get('next_offset')
+        if next_offset is None:
+            return packages
+        params = dict(q=query, offset=next_offset)
+
 def search(query, team=None):
     """
     Search for packages
@@ -1287,9 +1863,8 @@ def search(query, team=None):
 
     if team is not None:
         session = _get_session(team)
-        response = session.get("%s/api/search/" % get_registry_url(team), params=dict(q=query))
         print("* Packages in team %s" % team)
-        packages = response.json()['packages']
+        packages = _search_packages(session, team, query)
         for pkg in packages:
             print(("%s:" % team) + ("%(owner)s/%(name)s" % pkg))
         if len(packages) == 0:
@@ -1297,8 +1872,7 @@ def search(query, team=None):
         print("* Packages in public cloud")
 
     public_session = _get_session(None)
-    response = public_session.get("%s/api/search/" % get_registry_url(None), params=dict(q=query))
-    packages = response.json()['packages']
+    packages = _search_packages(public_session, None, query)
     for pkg in packages:
         print("%(owner)s/%(name)s" % pkg)
     if len(packages) == 0:
@@ -1457,14 +2031,16 @@ def audit(user_or_package):
         raise CommandException("Not logged in as a team user")
 
     session = _get_session(team)
-    response = session.get(
+    events = _iter_pages(
+        session,
         "{url}/api/audit/{user_or_package}/".format(
             url=get_registry_url(team),
             user_or_package=user_or_package
-        )
+        ),
+        'events'
     )
 
-    return response.json().get('events')
+    return list(events)
 
 def _cli_audit(user_or_package):
     events = audit(user_or_package)
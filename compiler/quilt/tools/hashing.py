@@ -1,4 +1,5 @@
 import hashlib
+from shutil import copyfileobj
 
 from .const import HASH_TYPE
 
@@ -26,7 +27,46 @@ def digest_file(fname):
             hval.update(chunk)
     return hval.hexdigest()
 
+def digest_copy(src, dest):
+    """
+    Copies `src` to `dest`, and returns the digest of the data; reads it only once.
+    """
+    with open(src, 'rb') as fd_in, open(dest, 'wb') as fd_out:
+        writer = HashingWriter(fd_out)
+        copyfileobj(fd_in, writer)
+    return writer.hexdigest()
+
 def digest_string(value):
     hval = hashlib.new(HASH_TYPE)
     hval.update(value.encode('utf8'))
     return hval.hexdigest()
+
+class HashingWriter(object):
+    """
+    Write-only file object that hashes the data on its way to the underlying file.
+    """
+    def __init__(self, fd):
+        self._fd = fd
+        self._hash = hashlib.new(HASH_TYPE)
+        self._size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self._size += len(data)
+        return self._fd.write(data)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+    @property
+    def closed(self):
+        return self._fd.closed
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
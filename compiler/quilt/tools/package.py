@@ -1,25 +1,62 @@
 from enum import Enum
 import gzip
+import hashlib
 import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
-from shutil import copyfile, copyfileobj, move, rmtree
+from shutil import copyfileobj, move, rmtree
 import tempfile
 
 import pandas as pd
 
 from .compat import pathlib
-from .const import TargetType
+from .chunking import digest_chunk, iter_chunks
+from .const import HASH_TYPE, TargetType
 from .core import (decode_node, encode_node, hash_contents,
                    FileNode, RootNode, GroupNode, TableNode,
-                   PackageFormat)
-from .hashing import digest_file
-from .util import is_nodename
+                   PackageFormat, README)
+from .hashing import digest_copy, digest_file, digest_string, HashingWriter
+from .util import is_nodename, link_file
 
 
 ZLIB_LEVEL = 2
 CHUNK_SIZE = 4096
 
 
+def _cgroup_cpu_quota():
+    """
+    Returns the CPU limit of the Linux cgroup (e.g., `docker run --cpus`), or None.
+    """
+    for path, parse in [
+            # cgroup v2: "<quota> <period>", or "max <period>" if there is no limit.
+            ('/sys/fs/cgroup/cpu.max', lambda text: text.split()),
+            # cgroup v1: the quota is -1 if there is no limit.
+            ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', lambda text: [text, None]),
+    ]:
+        try:
+            with open(path) as fd:
+                quota, period = parse(fd.read())
+            if period is None:
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as fd:
+                    period = fd.read()
+            quota, period = int(quota), int(period)
+        except (IOError, OSError, ValueError):
+            continue
+        if quota > 0 and period > 0:
+            return -(-quota // period)
+    return None
+
+def _available_cpus():
+    # Respect CPU affinity (cpusets), where supported, and container CPU limits.
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = cpu_count()
+    quota = _cgroup_cpu_quota()
+    return min(cpus, quota) if quota is not None else cpus
+
+
 class ParquetLib(Enum):
     SPARK = 'pyspark'
     ARROW = 'pyarrow'
@@ -40,6 +77,7 @@ class Package(object):
     LATEST = 'latest'
 
     __parquet_lib = None
+    __parquet_threads = None
 
     @classmethod
     def get_parquet_lib(cls):
@@ -60,6 +98,63 @@ class Package(object):
     def set_parquet_lib(cls, parqlib):
         cls.__parquet_lib = ParquetLib(parqlib)
 
+    @classmethod
+    def get_parquet_threads(cls):
+        """
+        Number of threads used to read Parquet files and convert them to DataFrames.
+        Defaults to QUILT_PARQUET_THREADS, or the number of CPUs this process may run on.
+        """
+        if cls.__parquet_threads is None:
+            threads = os.environ.get('QUILT_PARQUET_THREADS')
+            if threads:
+                try:
+                    threads = int(threads)
+                except ValueError:
+                    raise PackageException("QUILT_PARQUET_THREADS must be a number of threads.")
+            else:
+                threads = _available_cpus()
+            cls.__parquet_threads = max(threads, 1)
+        return cls.__parquet_threads
+
+    @classmethod
+    def reset_parquet_threads(cls):
+        cls.__parquet_threads = None
+
+    @classmethod
+    def set_parquet_threads(cls, nthreads):
+        cls.__parquet_threads = max(int(nthreads), 1)
+
+    @classmethod
+    def get_chunk_threshold(cls):
+        """
+        Files at least this big get split into content-defined chunks by `save_file`.
+        Chunking is off unless QUILT_CHUNK_THRESHOLD is set.
+
+        Packages with chunked files can only be read by clients that support them; older ones
+        fail on the files with more than one hash. Reading a chunked file also puts it back
+        together in the store's cache, which takes as much space again as the chunks.
+        """
+        threshold = os.environ.get('QUILT_CHUNK_THRESHOLD')
+        if not threshold:
+            return None
+        message = "QUILT_CHUNK_THRESHOLD must be a positive number of bytes."
+        try:
+            threshold = int(threshold)
+        except ValueError:
+            raise PackageException(message)
+        if threshold <= 0:
+            raise PackageException(message)
+        return threshold
+
+    @classmethod
+    def get_hardlink_files(cls):
+        """
+        Whether `save_file` may hard-link source files into the store instead of copying them.
+        Off unless QUILT_HARDLINK_FILES is "true": the objects would change if the source files
+        get modified in place.
+        """
+        return os.environ.get('QUILT_HARDLINK_FILES', '').strip().lower() == 'true'
+
     def __init__(self, store, user, package, path, contents=None, pkghash=None):
         self._store = store
         self._user = user
@@ -146,11 +241,25 @@ class Package(object):
     def file(self, hash_list):
         """
         Returns the path to an object file that matches the given hash.
+
+        Chunked files are put back together in the store's cache the first time they are read.
         """
         assert isinstance(hash_list, list)
-        assert len(hash_list) == 1, "File objects must be contained in one file."
-        filehash = hash_list[0]
-        return self._store.object_path(filehash)
+        if len(hash_list) == 1:
+            return self._store.object_path(hash_list[0])
+
+        key = hashlib.new(HASH_TYPE)
+        for filehash in hash_list:
+            key.update(filehash.encode('utf-8'))
+        path = self._store.cache_path(key.hexdigest())
+        if not os.path.exists(path):
+            tmppath = self._store.temporary_object_path(key.hexdigest())
+            with open(tmppath, 'wb') as output_file:
+                for filehash in hash_list:
+                    with open(self._store.object_path(filehash), 'rb') as chunk_file:
+                        copyfileobj(chunk_file, output_file, CHUNK_SIZE)
+            move(tmppath, path)
+        return path
 
     def _read_hdf5(self, hash_list):
         assert len(hash_list) == 1, "Multi-file DFs not supported in HDF5."
@@ -159,12 +268,26 @@ class Package(object):
             return store.get(self.DF_NAME)
 
     def _read_parquet_arrow(self, hash_list):
+        from pyarrow import concat_tables
         from pyarrow.parquet import ParquetDataset
 
         objfiles = [self._store.object_path(h) for h in hash_list]
         dataset = ParquetDataset(objfiles)
-        table = dataset.read(nthreads=4)
-        dataframe = table.to_pandas()
+        nthreads = self.get_parquet_threads()
+        pieces = dataset.pieces
+        if len(pieces) > 1 and nthreads > 1:
+            # Read the fragments concurrently (pyarrow releases the GIL), splitting the threads between them.
+            piece_threads = max(nthreads // len(pieces), 1)
+            pool = ThreadPool(min(nthreads, len(pieces)))
+            try:
+                tables = pool.map(lambda piece: piece.read(nthreads=piece_threads), pieces)
+            finally:
+                pool.close()
+                pool.join()
+            table = concat_tables(tables)
+        else:
+            table = dataset.read(nthreads=nthreads)
+        dataframe = table.to_pandas(nthreads=nthreads)
         return dataframe
 
     def _read_parquet_spark(self, hash_list):
@@ -237,6 +360,7 @@ class Package(object):
         enumformat = PackageFormat(fmt)
         buildfile = name.lstrip('/').replace('/', '.')
         storepath = self._store.temporary_object_path(buildfile)
+        filehash = None
 
         # Serialize DataFrame to chosen format
         if enumformat is PackageFormat.PARQUET:
@@ -247,7 +371,11 @@ class Package(object):
                 import pyarrow as pa
                 from pyarrow import parquet
                 table = pa.Table.from_pandas(dataframe)
-                parquet.write_table(table, storepath)
+                # Hash the file as it's being written, rather than reading it back afterwards.
+                with open(storepath, 'wb') as fd:
+                    writer = HashingWriter(fd)
+                    parquet.write_table(table, writer)
+                filehash = writer.hexdigest()
             elif parqlib is ParquetLib.SPARK:
                 from pyspark import sql as sparksql
                 assert isinstance(dataframe, sparksql.DataFrame)
@@ -259,6 +387,7 @@ class Package(object):
 
         # Move serialized DataFrame to object store
         if os.path.isdir(storepath): # Pyspark
+            # Spark writes the files itself, so they have to be read back to hash them.
             hashes = []
             files = [ofile for ofile in os.listdir(storepath) if ofile.endswith(".parquet")]
             for obj in files:
@@ -270,7 +399,6 @@ class Package(object):
             rmtree(storepath)
             return hashes
         else:
-            filehash = digest_file(storepath)
             self._add_to_contents(buildfile, [filehash], ext, path, target, fmt)
             move(storepath, self._store.object_path(filehash))
             return [filehash]
@@ -279,17 +407,90 @@ class Package(object):
         """
         Save a (raw) file to the store.
         """
-        filehash = digest_file(srcfile)
         fullname = name.lstrip('/').replace('/', '.')
+        threshold = self.get_chunk_threshold()
+        # The registry expects the README to be a single object.
+        if threshold is not None and fullname != README and os.path.getsize(srcfile) >= threshold:
+            hashes = self._save_chunks(srcfile)
+            self._add_to_contents(fullname, hashes, '', path, 'file', None)
+            return
+
+        # Files that haven't changed since they were last saved don't need to be read at all.
+        filehash = self._get_source_hash(srcfile)
+        if filehash is not None and os.path.exists(self._store.object_path(filehash)):
+            self._add_to_contents(fullname, [filehash], '', path, 'file', None)
+            return
+
+        stat = os.stat(srcfile)
+        tmppath = self._store.temporary_object_path(fullname)
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+        # If the filesystem allows it, link or clone the file into the store: no data gets copied,
+        # and the hash can be computed from the clone. Otherwise, hash the file while copying it,
+        # so it only gets read once.
+        if link_file(srcfile, tmppath, hardlink=self.get_hardlink_files()):
+            filehash = digest_file(tmppath)
+        else:
+            filehash = digest_copy(srcfile, tmppath)
+        self._set_source_hash(srcfile, stat, filehash)
+
         self._add_to_contents(fullname, [filehash], '', path, 'file', None)
         objpath = self._store.object_path(filehash)
-        if not os.path.exists(objpath):
-            # Copy the file to a temporary location first, then move, to make sure we don't end up with
-            # truncated contents if the build gets interrupted.
-            tmppath = self._store.temporary_object_path(filehash)
-            copyfile(srcfile, tmppath)
+        if os.path.exists(objpath):
+            os.remove(tmppath)
+        else:
             move(tmppath, objpath)
 
+    def _source_cache_path(self, srcfile):
+        return self._store.cache_path(digest_string("file:%s" % os.path.abspath(srcfile)))
+
+    def _get_source_hash(self, srcfile):
+        """
+        Returns the hash of `srcfile` saved by `_set_source_hash`, if the file's size
+        and modification time are still the same; otherwise, None.
+        """
+        try:
+            with open(self._source_cache_path(srcfile), 'r') as entry:
+                cache_entry = json.load(entry)
+        except (IOError, OSError, ValueError):
+            return None
+
+        stat = os.stat(srcfile)
+        if cache_entry.get('size') != stat.st_size or cache_entry.get('mtime') != stat.st_mtime:
+            return None
+        return cache_entry.get('hash')
+
+    def _set_source_hash(self, srcfile, stat, filehash):
+        """
+        Remembers the hash of `srcfile`, as of the given `os.stat` result.
+        """
+        cache_entry = dict(
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            hash=filehash
+        )
+        with open(self._source_cache_path(srcfile), 'w') as entry:
+            json.dump(cache_entry, entry)
+
+    def _save_chunks(self, srcfile):
+        """
+        Splits a file into content-defined chunks and saves the ones that aren't
+        in the store yet. Returns the list of chunk hashes.
+        """
+        hashes = []
+        with open(srcfile, 'rb') as input_file:
+            for chunk in iter_chunks(input_file):
+                chunkhash = digest_chunk(chunk)
+                objpath = self._store.object_path(chunkhash)
+                if not os.path.exists(objpath):
+                    tmppath = self._store.temporary_object_path(chunkhash)
+                    with open(tmppath, 'wb') as chunk_file:
+                        chunk_file.write(chunk)
+                    move(tmppath, objpath)
+                hashes.append(chunkhash)
+        return hashes
+
     def save_group(self, name):
         """
         Save a group to the store.
@@ -8,8 +8,9 @@ from shutil import rmtree
 
 from .const import DEFAULT_TEAM, PACKAGE_DIR_NAME
 from .core import FileNode, RootNode, TableNode
+from .hashing import digest_copy, digest_file
 from .package import Package, PackageException
-from .util import BASE_DIR, sub_dirs, sub_files, is_nodename
+from .util import BASE_DIR, link_file, sub_dirs, sub_files, is_nodename
 
 CHUNK_SIZE = 4096
 
@@ -278,6 +279,33 @@ class PackageStore(object):
         """
         return os.path.join(self._path, self.OBJ_DIR, objhash)
 
+    def import_object(self, objhash):
+        """
+        Looks for an object missing from this store in the other package directories
+        (see `find_store_dirs`), and if it's there, clones or copies it into this store.
+        It only gets hard-linked if QUILT_HARDLINK_FILES is set (see `Package.get_hardlink_files`).
+        Returns the path it was found at, or None.
+        """
+        local_path = self.object_path(objhash)
+        for store_dir in self.find_store_dirs():
+            if os.path.abspath(store_dir) == os.path.abspath(self._path):
+                continue
+            path = os.path.join(store_dir, self.OBJ_DIR, objhash)
+            if os.path.isfile(path):
+                # Use a temporary name first, so a partial copy never looks like an object.
+                temp_path = self.temporary_object_path(objhash)
+                if link_file(path, temp_path, hardlink=Package.get_hardlink_files()):
+                    filehash = digest_file(temp_path)
+                else:
+                    filehash = digest_copy(path, temp_path)
+                # The other store's copy could be truncated or modified.
+                if filehash != objhash:
+                    os.remove(temp_path)
+                    continue
+                os.rename(temp_path, local_path)
+                return path
+        return None
+
     def temporary_object_path(self, name):
         """
         Returns the path to a temporary object, before we know its hash.
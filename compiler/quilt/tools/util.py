@@ -15,6 +15,9 @@ APP_NAME = "QuiltCli"
 APP_AUTHOR = "QuiltData"
 BASE_DIR = user_data_dir(APP_NAME, APP_AUTHOR)
 CONFIG_DIR = user_config_dir(APP_NAME, APP_AUTHOR)
+CHUNK_SIZE = 4096
+# Linux ioctl that makes a copy-on-write clone of a file (btrfs, XFS).
+FICLONE = 0x40049409
 PYTHON_IDENTIFIER_RE = re.compile(r'^[a-zA-Z_]\w*$')
 EXTENDED_PACKAGE_RE = re.compile(
     r'^((?:\w+:)?\w+/[\w/]+)(?::h(?:ash)?:(.+)|:v(?:ersion)?:(.+)|:t(?:ag)?:(.+))?$'
@@ -102,6 +105,64 @@ class FileWithReadProgress(Iterator):
         self.close()
 
 
+class FileSlice(Iterator):
+    """
+    Acts like a file with mode='rb' containing `length` bytes of `fd` starting at `offset`.
+
+    Several slices of the same file can be read from different threads:
+    each read seeks the underlying file while holding `lock`.
+    """
+    def __init__(self, fd, offset, length, lock):
+        self._fd = fd
+        self._offset = offset
+        self._length = length
+        self._lock = lock
+        self._pos = 0
+
+    def read(self, size=-1):
+        """Read bytes from the slice."""
+        remaining = self._length - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        with self._lock:
+            self._fd.seek(self._offset + self._pos)
+            buf = self._fd.read(size)
+        self._pos += len(buf)
+        return buf
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Read the next chunk of the slice."""
+        buf = self.read(CHUNK_SIZE)
+        if not buf:
+            raise StopIteration
+        return buf
+
+    def tell(self):
+        """Get the position within the slice."""
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        """Set the new position within the slice."""
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._length
+        self._pos = min(max(offset, 0), self._length)
+
+    def close(self):
+        """Nothing to do; the underlying file is owned by the caller."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback): # pylint:disable=W0622
+        self.close()
+
+
 def file_to_str(fname):
     """
     Read a file into a string
@@ -146,6 +207,42 @@ def sub_files(path, invisible=False):
     return files
 
 
+def reflink_file(src, dest):
+    """
+    Makes `dest` a copy-on-write clone of `src`. Raises an IOError or OSError
+    (or ImportError on Windows) if the filesystem doesn't support it.
+    """
+    import fcntl  # Not available on Windows.
+    try:
+        with open(src, 'rb') as fd_in, open(dest, 'wb') as fd_out:
+            fcntl.ioctl(fd_out.fileno(), FICLONE, fd_in.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+
+
+def link_file(src, dest, hardlink=False):
+    """
+    Makes `dest` a copy-on-write clone of `src` if the filesystem supports it - or, if
+    `hardlink` is set, a hard link when both are on the same filesystem. Hard links are
+    opt-in, since changing either file in place would change both.
+    Returns 'hardlink' or 'reflink', or None if the caller needs to copy the file.
+    """
+    if hardlink:
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except (AttributeError, OSError):
+            pass
+
+    try:
+        reflink_file(src, dest)
+        return 'reflink'
+    except (ImportError, IOError, OSError):
+        return None
+
+
 def is_identifier(string):
     """Check if string could be a valid python identifier
 
@@ -0,0 +1,25 @@
+"""Add the instance hash prefix index
+
+Revision ID: 0c6b8f2a4e17
+Revises: 7d2e5c1f9a04
+Create Date: 2018-03-22 14:08:51.093316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0c6b8f2a4e17'
+down_revision = '7d2e5c1f9a04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_instance_hash_prefix', 'instance', ['package_id', 'hash'], unique=False,
+                    postgresql_ops={'hash': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('idx_instance_hash_prefix', table_name='instance')
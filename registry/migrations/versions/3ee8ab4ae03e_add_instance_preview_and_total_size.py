@@ -0,0 +1,26 @@
+"""Add instance preview and total size
+
+Revision ID: 3ee8ab4ae03e
+Revises: 9576b2ed4073
+Create Date: 2018-03-12 14:52:08.116492
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '3ee8ab4ae03e'
+down_revision = '9576b2ed4073'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('instance', sa.Column('preview', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+    op.add_column('instance', sa.Column('total_size', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('instance', 'total_size')
+    op.drop_column('instance', 'preview')
@@ -0,0 +1,54 @@
+"""Add event count tables
+
+Revision ID: 5b4f8a6cb3d1
+Revises: e3a1e9f0b6c4
+Create Date: 2018-03-19 16:05:31.224817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5b4f8a6cb3d1'
+down_revision = 'e3a1e9f0b6c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('package_event_count',
+    sa.Column('package_owner', sa.String(length=64), nullable=False),
+    sa.Column('package_name', sa.String(length=64), nullable=False),
+    sa.Column('type', sa.SmallInteger(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('latest', postgresql.TIMESTAMP(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('package_owner', 'package_name', 'type')
+    )
+    op.create_table('user_event_count',
+    sa.Column('user', sa.String(length=64), nullable=False),
+    sa.Column('type', sa.SmallInteger(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('user', 'type')
+    )
+
+    # Count the existing events.
+    op.execute('''
+        INSERT INTO package_event_count (package_owner, package_name, type, count, latest)
+        SELECT package_owner, package_name, type, count(*), max(created)
+        FROM event
+        WHERE package_owner IS NOT NULL AND package_name IS NOT NULL
+        GROUP BY package_owner, package_name, type
+    ''')
+    op.execute('''
+        INSERT INTO user_event_count ("user", type, count)
+        SELECT "user", type, count(*)
+        FROM event
+        WHERE "user" IS NOT NULL
+        GROUP BY "user", type
+    ''')
+
+
+def downgrade():
+    op.drop_table('user_event_count')
+    op.drop_table('package_event_count')
@@ -0,0 +1,37 @@
+"""Add the push session table
+
+Revision ID: 7d2e5c1f9a04
+Revises: 5b4f8a6cb3d1
+Create Date: 2018-03-21 11:42:08.519204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '7d2e5c1f9a04'
+down_revision = '5b4f8a6cb3d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('push_session',
+    sa.Column('token', sa.String(length=64), nullable=False),
+    sa.Column('created', postgresql.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('owner', sa.String(length=64), nullable=False),
+    sa.Column('package_name', sa.String(length=64), nullable=False),
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('is_public', sa.Boolean(), nullable=False),
+    sa.Column('is_team', sa.Boolean(), nullable=False),
+    sa.Column('contents', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('sizes', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.PrimaryKeyConstraint('token')
+    )
+    op.create_index(op.f('ix_push_session_created'), 'push_session', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_push_session_created'), table_name='push_session')
+    op.drop_table('push_session')
@@ -0,0 +1,58 @@
+"""Add the package search table
+
+Revision ID: e3a1e9f0b6c4
+Revises: 3ee8ab4ae03e
+Create Date: 2018-03-14 11:27:45.903218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1e9f0b6c4'
+down_revision = '3ee8ab4ae03e'
+branch_labels = None
+depends_on = None
+
+# Same as quilt_server.const.FTS_LANGUAGE at the time of the migration.
+FTS_LANGUAGE = 'english'
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    op.create_table('package_search',
+    sa.Column('package_id', sa.BigInteger(), nullable=False),
+    sa.Column('instance_id', sa.BigInteger(), nullable=False),
+    sa.Column('owner_name', sa.String(length=129), nullable=False),
+    sa.Column('tsv', postgresql.TSVECTOR(), nullable=False),
+    sa.Column('readme', sa.TEXT(), nullable=True),
+    sa.ForeignKeyConstraint(['instance_id'], ['instance.id'], ),
+    sa.ForeignKeyConstraint(['package_id'], ['package.id'], ),
+    sa.PrimaryKeyConstraint('package_id')
+    )
+    op.create_index('idx_search_owner_name', 'package_search', ['owner_name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'owner_name': 'gin_trgm_ops'})
+    op.create_index('idx_search_tsv', 'package_search', ['tsv'], unique=False, postgresql_using='gin')
+
+    # Index the "latest" instances of the existing packages.
+    op.execute(sa.text('''
+        INSERT INTO package_search (package_id, instance_id, owner_name, tsv, readme)
+        SELECT package.id, instance.id, lower(package.owner || '/' || package.name),
+               setweight(to_tsvector(:language, package.owner), 'A') ||
+               setweight(to_tsvector(:language, package.name), 'A') ||
+               coalesce(s3_blob.preview_tsv, ''),
+               substr(s3_blob.preview, 1, 1024)
+        FROM tag
+        JOIN package ON tag.package_id = package.id
+        JOIN instance ON tag.instance_id = instance.id
+        LEFT JOIN s3_blob ON instance.readme_blob_id = s3_blob.id
+        WHERE tag.tag = 'latest'
+    ''').bindparams(language=FTS_LANGUAGE))
+
+
+def downgrade():
+    op.drop_index('idx_search_tsv', table_name='package_search')
+    op.drop_index('idx_search_owner_name', table_name='package_search')
+    op.drop_table('package_search')
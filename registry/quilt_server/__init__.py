@@ -19,9 +19,13 @@ from . import middleware
 from .core import decode_node, encode_node
 
 app = Flask(__name__.split('.')[0])
-app.wsgi_app = middleware.RequestEncodingMiddleware(app.wsgi_app)
 app.config.from_object('quilt_server.config')
 app.config.from_envvar('QUILT_SERVER_CONFIG')
+app.wsgi_app = middleware.RequestEncodingMiddleware(app.wsgi_app)
+app.wsgi_app = middleware.ResponseCompressionMiddleware(
+    app.wsgi_app,
+    min_size=app.config['RESPONSE_COMPRESSION_MIN_SIZE']
+)
 
 class QuiltSQLAlchemy(SQLAlchemy):
     def apply_driver_hacks(self, app, info, options):
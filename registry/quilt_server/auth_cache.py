@@ -0,0 +1,121 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Cache for the results of validating auth tokens with the OAuth user API.
+
+Lookups go through a per-process LRU cache first, then an optional shared backend (Redis).
+Invalid tokens are cached too, for a shorter time. Keys are hashes of the Authorization
+header, so the tokens themselves are never stored.
+"""
+
+import hashlib
+import json
+from threading import Lock
+
+from .cache import LocalCache
+
+KEY_PREFIX = 'quilt:auth:'
+
+# Cached value for tokens that the auth service rejected.
+INVALID = dict(invalid=True)
+
+
+class RedisCache(object):
+    """
+    Shared cache stored in Redis; values are JSON strings.
+    """
+    def __init__(self, url):
+        import redis  # Optional dependency; only needed if AUTH_CACHE_REDIS_URL is set.
+        self._client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(KEY_PREFIX + key)
+        return json.loads(value.decode()) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(KEY_PREFIX + key, json.dumps(value), ex=max(int(ttl), 1))
+
+    def clear(self):
+        for key in self._client.scan_iter(KEY_PREFIX + '*'):
+            self._client.delete(key)
+
+
+class TokenCache(object):
+    """
+    Two-level cache of token validation results, with hit/miss counters.
+
+    Values are dicts with the user info, or `INVALID`.
+    """
+    def __init__(self, ttl, negative_ttl, max_size, shared=None):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._local = LocalCache(max_size)
+        self._shared = shared
+        self._stats_lock = Lock()
+        self._stats = dict(local_hits=0, shared_hits=0, misses=0, shared_errors=0)
+
+    @classmethod
+    def _key(cls, auth_header):
+        return hashlib.sha256(auth_header.encode()).hexdigest()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get(self, auth_header):
+        """
+        Returns the cached value for the header, or None.
+        """
+        key = self._key(auth_header)
+
+        value = self._local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        if self._shared is not None:
+            try:
+                value = self._shared.get(key)
+            except Exception:  # pylint:disable=broad-except
+                # The shared cache is an optimization; never fail a request because of it.
+                self._count('shared_errors')
+                value = None
+            if value is not None:
+                self._count('shared_hits')
+                # The local cache may keep it for a bit longer than the shared one; that's fine.
+                self._local.set(key, value, self._ttl_for(value))
+                return value
+
+        self._count('misses')
+        return None
+
+    def set(self, auth_header, value):
+        key = self._key(auth_header)
+        ttl = self._ttl_for(value)
+        self._local.set(key, value, ttl)
+        if self._shared is not None:
+            try:
+                self._shared.set(key, value, ttl)
+            except Exception:  # pylint:disable=broad-except
+                self._count('shared_errors')
+
+    def _ttl_for(self, value):
+        return self._negative_ttl if value == INVALID else self._ttl
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """
+        Drops all cached values and resets the counters.
+        """
+        self._local.clear()
+        if self._shared is not None:
+            self._shared.clear()
+        with self._stats_lock:
+            for name in self._stats:
+                self._stats[name] = 0
@@ -0,0 +1,42 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+In-process caching helpers.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LocalCache(object):
+    """
+    In-process LRU cache with a per-entry TTL.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -16,6 +16,38 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ECHO = False  # Turn it on for debugging.
 
 PACKAGE_URL_EXPIRATION = 60*60*24 # 24 hours
+# Number of signed S3 URLs to keep per process. They get reused for half of their lifetime,
+# which is shorter than PACKAGE_URL_EXPIRATION if the AWS credentials expire sooner.
+# Each one takes about 1KB, so this is ~10MB per worker; big packages are expected to miss.
+PRESIGNED_URL_CACHE_SIZE = 10000
+
+# Objects at least this big get pushed as S3 multipart uploads. Clients abort the uploads
+# that fail, but not if they crash, so the bucket needs a lifecycle rule that aborts
+# incomplete multipart uploads (AbortIncompleteMultipartUpload), e.g. after 7 days.
+MULTIPART_UPLOAD_THRESHOLD = 256 * 1024 * 1024
+MULTIPART_UPLOAD_PART_SIZE = 64 * 1024 * 1024
+
+# Contents validated by a push dry run are kept this long, for the push that follows it.
+# Clients whose uploads take longer send the contents again.
+PUSH_SESSION_EXPIRATION = 60*60*2 # 2 hours
+# How often the uwsgi spooler deletes expired push sessions.
+PUSH_SESSION_CLEANUP_INTERVAL = 60*10 # 10 minutes
+
+# Cache results of validating auth tokens, so most requests don't need to call the auth service.
+# Invalid tokens are cached for a shorter time. Set AUTH_CACHE_REDIS_URL to share the cache
+# between processes.
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_NEGATIVE_TTL = 10
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_REDIS_URL = os.getenv('AUTH_CACHE_REDIS_URL')
+
+# Responses smaller than this don't get compressed. Streaming responses get flushed about this often.
+# zstd and brotli get used if the zstandard or brotli packages are installed; gzip always works.
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+
+# Package events get written in batches of this many, or at least this often (in seconds).
+EVENT_BATCH_SIZE = 100
+EVENT_FLUSH_INTERVAL = 10
 
 JSON_USE_ENCODE_METHODS = True  # Support the __json__ method in Node
 
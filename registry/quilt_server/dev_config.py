@@ -56,6 +56,9 @@ PACKAGE_BUCKET_NAME = 'package'
 
 SQLALCHEMY_ECHO = True
 
+# Write events right away.
+EVENT_BATCH_SIZE = 1
+
 MIXPANEL_PROJECT_TOKEN = os.getenv('MIXPANEL_PROJECT_TOKEN', '')
 DEPLOYMENT_ID = socket.gethostname()
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
@@ -0,0 +1,154 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Recording of package events (push, install, etc).
+
+Events are buffered in each process and written in batches by a spooled task,
+so requests don't need to insert them - or commit anything at all, in case of installs and previews.
+Under uwsgi, a timer also flushes every worker's buffer every EVENT_FLUSH_INTERVAL seconds,
+so events don't sit in idle workers.
+"""
+
+import atexit
+from collections import defaultdict
+from datetime import datetime, timezone
+import json
+from threading import Lock
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from . import app, db
+from .analytics import spool
+from .models import Event, PackageEventCount, UserEventCount
+
+try:
+    import uwsgi
+    from uwsgidecorators import timer
+except ImportError:
+    # Running using Flask in dev; events get flushed as requests come in, and at exit.
+    uwsgi = timer = None
+
+EVENT_BATCH_SIZE = app.config['EVENT_BATCH_SIZE']
+EVENT_FLUSH_INTERVAL = app.config['EVENT_FLUSH_INTERVAL']
+
+_pending = []
+_pending_lock = Lock()
+_last_flush = time.time()
+
+
+@spool
+def _write_events_task(args):
+    """
+    Inserts a batch of events. Runs in a uwsgi spooler process.
+    """
+    # Batches can be bigger than the 64KB allowed for spooler arguments, so they're in the body.
+    rows = json.loads(args['body'].decode())
+    for row in rows:
+        row['created'] = datetime.fromtimestamp(row['created'], timezone.utc)
+
+    with db.engine.begin() as conn:
+        conn.execute(Event.__table__.insert(), rows)
+        _update_counts(conn, rows)
+
+
+def _update_counts(conn, rows):
+    """
+    Adds the events to the per-user and per-package counts.
+    """
+    user_counts = defaultdict(int)
+    package_counts = defaultdict(lambda: dict(count=0, latest=None))
+    for row in rows:
+        if row['user'] is not None:
+            user_counts[(row['user'], row['type'])] += 1
+        counts = package_counts[(row['package_owner'], row['package_name'], row['type'])]
+        counts['count'] += 1
+        counts['latest'] = max(counts['latest'] or row['created'], row['created'])
+
+    # Sort the keys, so concurrent updates lock the rows in the same order.
+    if user_counts:
+        table = UserEventCount.__table__
+        stmt = postgresql.insert(table).values([
+            dict(user=user, type=event_type, count=count)
+            for (user, event_type), count in sorted(user_counts.items())
+        ])
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.user, table.c.type],
+            set_=dict(count=table.c.count + stmt.excluded.count)
+        ))
+
+    if package_counts:
+        table = PackageEventCount.__table__
+        stmt = postgresql.insert(table).values([
+            dict(package_owner=owner, package_name=name, type=event_type, **counts)
+            for (owner, name, event_type), counts in sorted(package_counts.items())
+        ])
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.package_owner, table.c.package_name, table.c.type],
+            set_=dict(
+                count=table.c.count + stmt.excluded.count,
+                latest=sa.func.greatest(table.c.latest, stmt.excluded.latest)
+            )
+        ))
+
+
+def record_event(event_type, user, package_owner, package_name, package_hash=None, extra=None):
+    """
+    Queues an event to be written to the database.
+    """
+    row = dict(
+        # Use the time of the request, not of the insert.
+        created=time.time(),
+        type=int(event_type),
+        user=user,
+        package_owner=package_owner,
+        package_name=package_name,
+        package_hash=package_hash,
+        extra=extra,
+    )
+
+    with _pending_lock:
+        _pending.append(row)
+        if len(_pending) < EVENT_BATCH_SIZE and time.time() - _last_flush < EVENT_FLUSH_INTERVAL:
+            return
+        rows = _take_pending()
+
+    _write_events(rows)
+
+
+def flush_events():
+    """
+    Writes all of the pending events.
+    """
+    with _pending_lock:
+        rows = _take_pending()
+    if rows:
+        _write_events(rows)
+
+
+def _take_pending():
+    global _last_flush
+    rows = list(_pending)
+    del _pending[:]
+    _last_flush = time.time()
+    return rows
+
+
+def _write_events(rows):
+    _write_events_task.spool(body=json.dumps(rows).encode())
+
+
+def _flush_timer(signum):
+    """
+    Writes the events of an idle worker.
+    """
+    flush_events()
+
+
+if timer is not None:
+    timer(EVENT_FLUSH_INTERVAL, target='workers')(_flush_timer)
+    # Python's atexit handlers don't run when uwsgi reloads or recycles workers.
+    uwsgi.atexit = flush_events
+else:
+    atexit.register(flush_events)
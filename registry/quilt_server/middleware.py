@@ -5,10 +5,13 @@ Middleware: handling gzip encoding, etc.
 """
 
 import gzip
+from itertools import chain
 import zlib
 
+from werkzeug.datastructures import Headers
 from werkzeug.exceptions import BadRequest
-from werkzeug.wsgi import get_input_stream
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator, get_input_stream
 
 class RequestEncodingMiddleware(object):
     def __init__(self, app):
@@ -32,3 +35,164 @@ class RequestEncodingMiddleware(object):
             # gzip raises OSError on invalid input... blah.
             error = "Failed to decode input: %s" % ex
             return BadRequest(error)(environ, start_response)
+
+
+def _gzip_compressor(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+        compressor.flush
+    )
+
+def _zstd_compressor(level):
+    import zstandard  # Optional dependency.
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush
+    )
+
+def _brotli_compressor(level):
+    import brotli  # Optional dependency.
+    compressor = brotli.Compressor(quality=level)
+    return (
+        compressor.process,
+        compressor.flush,
+        compressor.finish
+    )
+
+# Encodings in the order we prefer them, with their compressors and compression levels.
+# Each compressor is a (compress, flush, finish) tuple.
+RESPONSE_ENCODINGS = [
+    ('zstd', 'zstandard', _zstd_compressor, 3),
+    ('br', 'brotli', _brotli_compressor, 5),
+    ('gzip', None, _gzip_compressor, 6),
+]
+
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/javascript',
+    'application/xml',
+}
+
+def _available_encodings():
+    encodings = []
+    for encoding, module, compressor, level in RESPONSE_ENCODINGS:
+        if module is not None:
+            try:
+                __import__(module)
+            except ImportError:
+                continue
+        encodings.append((encoding, compressor, level))
+    return encodings
+
+class ResponseCompressionMiddleware(object):
+    """
+    Compresses responses using the best encoding from the client's Accept-Encoding.
+
+    Responses with a Content-Length below `min_size` are sent as is. Responses without a length,
+    i.e., streaming ones, are compressed on the fly, and flushed every `min_size` bytes or so,
+    so the client can start processing them right away.
+    """
+    def __init__(self, app, min_size):
+        self.app = app
+        self.min_size = min_size
+        self.encodings = _available_encodings()
+
+    def _choose_encoding(self, environ):
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if not accept or environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        best = accept.best_match([encoding for encoding, _, _ in self.encodings])
+        if best is None or accept[best] <= 0:
+            return None
+        for encoding, compressor, level in self.encodings:
+            if encoding == best:
+                return encoding, compressor, level
+        return None
+
+    def _should_compress(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if not 200 <= code < 300 or code == 204:
+            return False
+        if 'Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        content_type = headers.get('Content-Type', '').split(';', 1)[0].strip()
+        return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+    def __call__(self, environ, start_response):
+        choice = self._choose_encoding(environ)
+        if choice is None:
+            return self.app(environ, start_response)
+        encoding, compressor, level = choice
+
+        response = []
+        written = []
+
+        def _start_response(status, headers, exc_info=None):
+            response[:] = [status, Headers(headers), exc_info]
+            # Legacy apps can write some of the body before returning the rest;
+            # keep it, and send it ahead of the returned body.
+            return written.append
+
+        app_iter = self.app(environ, _start_response)
+        close = getattr(app_iter, 'close', None)
+
+        # Apps can also call start_response lazily, when the body starts;
+        # read the body up to that point.
+        body_iter = iter(app_iter)
+        head = []
+        while not response:
+            try:
+                head.append(next(body_iter))
+            except StopIteration:
+                if close is not None:
+                    close()
+                raise RuntimeError("start_response was never called")
+        status, headers, exc_info = response
+
+        if written or head:
+            app_iter = ClosingIterator(chain(written, head, body_iter), close)
+
+        if not self._should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers.add('Vary', 'Accept-Encoding')
+
+        length = headers.get('Content-Length', type=int)
+        if length is not None:
+            if length < self.min_size:
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return app_iter
+
+            # The whole body is already in memory, so compress all of it at once.
+            compress, _, finish = compressor(level)
+            try:
+                body = b''.join(compress(chunk) for chunk in app_iter) + finish()
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+
+        headers['Content-Encoding'] = encoding
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return ClosingIterator(self._compress_stream(app_iter, compressor(level)), getattr(app_iter, 'close', None))
+
+    def _compress_stream(self, app_iter, compressor):
+        compress, flush, finish = compressor
+        pending = 0
+        for chunk in app_iter:
+            data = compress(chunk)
+            pending += len(chunk)
+            if pending >= self.min_size:
+                data += flush()
+                pending = 0
+            if data:
+                yield data
+        yield finish()
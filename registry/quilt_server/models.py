@@ -7,6 +7,7 @@ DB Tables.
 from enum import IntEnum
 from packaging.version import Version as PackagingVersion
 
+from sqlalchemy import DDL, event
 from sqlalchemy.orm import deferred
 from sqlalchemy.dialects import postgresql
 
@@ -38,6 +39,9 @@ class Package(db.Model):
     invitation = db.relationship(
         'Invitation', back_populates='package', cascade='save-update, merge, delete')
 
+    search = db.relationship(
+        'PackageSearch', back_populates='package', uselist=False, cascade='save-update, merge, delete')
+
     def sort_key(self):
         return (self.owner, self.name)
 
@@ -68,6 +72,10 @@ class Instance(db.Model):
 
     readme_blob_id = db.Column(db.BigInteger, db.ForeignKey('s3_blob.id'), index=True)
 
+    # Summary for package_preview, saved at push time. NULL for packages pushed before it existed.
+    preview = deferred(db.Column(postgresql.JSONB))
+    total_size = db.Column(db.BigInteger)
+
     package = db.relationship('Package', back_populates='instances')
     versions = db.relationship('Version', back_populates='instance')
     tags = db.relationship('Tag', back_populates='instance')
@@ -76,6 +84,10 @@ class Instance(db.Model):
     readme_blob = db.relationship('S3Blob', uselist=False)
 
 db.Index('idx_hash', Instance.package_id, Instance.hash, unique=True)
+# For looking up instances by hash prefixes: `hash LIKE 'abc%'` can't use idx_hash
+# in databases with a non-C collation.
+db.Index('idx_instance_hash_prefix', Instance.package_id, Instance.hash,
+         postgresql_ops={'hash': 'varchar_pattern_ops'})
 
 
 class S3Blob(db.Model):
@@ -154,6 +166,51 @@ class Invitation(db.Model):
     package = db.relationship('Package', back_populates='invitation')
 
 
+class PackageSearch(db.Model):
+    """
+    Search document for the "latest" instance of a package; kept up to date by `tag_put`
+    and `tag_delete`, so searches don't need to build it for every package.
+    """
+    package_id = db.Column(db.BigInteger, db.ForeignKey('package.id'), primary_key=True)
+    instance_id = db.Column(db.BigInteger, db.ForeignKey('instance.id'), nullable=False)
+
+    # Lowercase "owner/name", for substring matching.
+    owner_name = db.Column(db.String(129), nullable=False)
+    # Owner and name with weight A, README with the default weight.
+    tsv = db.Column(postgresql.TSVECTOR, nullable=False)
+    # Beginning of the README.
+    readme = db.Column(db.TEXT)
+
+    package = db.relationship('Package', back_populates='search')
+    instance = db.relationship('Instance')
+
+event.listen(
+    PackageSearch.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+)
+db.Index('idx_search_tsv', PackageSearch.tsv, postgresql_using='gin')
+db.Index('idx_search_owner_name', PackageSearch.owner_name,
+         postgresql_using='gin', postgresql_ops={'owner_name': 'gin_trgm_ops'})
+
+
+class PushSession(db.Model):
+    """
+    Contents validated by a `package_put` dry run, so the push that follows it
+    can send the token instead of the whole manifest again.
+    """
+    token = db.Column(db.String(64), primary_key=True)
+    created = db.Column(postgresql.TIMESTAMP(True), server_default=db.func.now(), nullable=False, index=True)
+    owner = db.Column(USERNAME_TYPE, nullable=False)
+    package_name = db.Column(db.String(64), nullable=False)
+    hash = db.Column(db.String(64), nullable=False)
+    is_public = db.Column(db.Boolean, nullable=False)
+    is_team = db.Column(db.Boolean, nullable=False)
+    contents = db.Column(postgresql.JSONB, nullable=False)
+    # Sizes of all the objects; values are null for clients that didn't send them.
+    sizes = db.Column(postgresql.JSONB, nullable=False)
+
+
 class Customer(db.Model):
     id = db.Column(USERNAME_TYPE, primary_key=True)
     stripe_customer_id = db.Column(STRIPE_ID_TYPE)
@@ -178,3 +235,24 @@ class Event(db.Model):
     extra = db.Column(postgresql.JSONB)
 
 db.Index('idx_package', Event.package_owner, Event.package_name)
+
+
+class UserEventCount(db.Model):
+    """
+    Number of events of each type per user; updated whenever events are written.
+    """
+    user = db.Column(USERNAME_TYPE, primary_key=True)
+    type = db.Column(db.SmallInteger, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False)
+
+
+class PackageEventCount(db.Model):
+    """
+    Number of events of each type per package, and the time of the latest one;
+    updated whenever events are written.
+    """
+    package_owner = db.Column(USERNAME_TYPE, primary_key=True)
+    package_name = db.Column(db.String(64), primary_key=True)
+    type = db.Column(db.SmallInteger, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False)
+    latest = db.Column(postgresql.TIMESTAMP(True), nullable=False)
@@ -0,0 +1,93 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Local signing of S3 URLs.
+"""
+
+import hashlib
+import hmac
+import time
+from urllib.parse import quote, urlsplit
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+SERVICE = 's3'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+class S3UrlSigner(object):
+    """
+    Signs path-style S3 URLs using SigV4 query string authentication.
+
+    boto derives the signing key again for every URL it signs. The signer derives it once,
+    from the credentials and the time when it was created, so each URL only takes a hash
+    and one HMAC. Create a new signer for each request, so that it picks up refreshed
+    credentials.
+    """
+    def __init__(self, credentials, region, endpoint_url, expires_in):
+        assert credentials is not None, "No AWS credentials"
+
+        now = time.time()
+        frozen = credentials.get_frozen_credentials()
+
+        # URLs stop working when temporary credentials expire, no matter what they say.
+        self.lifetime = expires_in
+        expiry_time = getattr(credentials, '_expiry_time', None)
+        if expiry_time is not None:
+            self.lifetime = max(min(expires_in, int(expiry_time.timestamp() - now)), 0)
+
+        url = urlsplit(endpoint_url)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        if url.port is not None and url.port != DEFAULT_PORTS.get(url.scheme):
+            self._host += ':%d' % url.port
+        self._path_prefix = url.path.rstrip('/')
+
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+        date = amz_date[:8]
+        scope = '%s/%s/%s/aws4_request' % (date, region, SERVICE)
+
+        signing_key = _hmac(('AWS4' + frozen.secret_key).encode('utf-8'), date)
+        for part in (region, SERVICE, 'aws4_request'):
+            signing_key = _hmac(signing_key, part)
+        self._signing_key = signing_key
+
+        params = {
+            'X-Amz-Algorithm': ALGORITHM,
+            'X-Amz-Credential': '%s/%s' % (frozen.access_key, scope),
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires_in),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        if frozen.token:
+            params['X-Amz-Security-Token'] = frozen.token
+        self._query = '&'.join(
+            '%s=%s' % (quote(name, safe='-_.~'), quote(value, safe='-_.~'))
+            for name, value in sorted(params.items())
+        )
+        self._string_to_sign_prefix = '%s\n%s\n%s\n' % (ALGORITHM, amz_date, scope)
+
+    def sign_path(self, http_method, path):
+        """
+        Returns a signed URL for the given (unquoted) path on the endpoint.
+        """
+        canonical_uri = self._path_prefix + quote(path, safe='/~')
+        canonical_request = '%s\n%s\n%s\nhost:%s\n\nhost\nUNSIGNED-PAYLOAD' % (
+            http_method, canonical_uri, self._query, self._host
+        )
+        string_to_sign = self._string_to_sign_prefix + hashlib.sha256(
+            canonical_request.encode('utf-8')
+        ).hexdigest()
+        signature = hmac.new(self._signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return '%s://%s%s?%s&X-Amz-Signature=%s' % (
+            self._scheme, self._host, canonical_uri, self._query, signature
+        )
+
+    def sign(self, http_method, bucket, key):
+        """
+        Returns a signed URL for an object.
+        """
+        return self.sign_path(http_method, '/%s/%s' % (bucket, key))
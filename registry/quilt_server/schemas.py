@@ -4,10 +4,16 @@
 Definition of the package schema, helper functions, etc.
 """
 
+import json
+import re
+
+from jsonschema import ValidationError
+
 from .core import (RootNode, GroupNode, TableNode, FileNode,
                    PackageFormat)
 
 SHA256_PATTERN = r'[0-9a-f]{64}'
+SHA256_RE = re.compile(SHA256_PATTERN)
 
 PACKAGE_SCHEMA = {
     'type': 'object',
@@ -109,6 +115,125 @@ PACKAGE_SCHEMA = {
     'additionalProperties': False
 }
 
+PACKAGE_FORMATS = frozenset(fmt.value for fmt in PackageFormat)
+
+class PackageDecoder(object):
+    """
+    JSON object hook that checks the `package_put` request body against PACKAGE_SCHEMA
+    while it's being parsed, builds the nodes, and collects the object hashes - so the body
+    only needs to be parsed once, and not checked with jsonschema.
+
+    Raises `ValidationError` for invalid bodies.
+    """
+    BODY_KEYS = {
+        'dry_run': bool,
+        'is_public': bool,
+        'is_team': bool,
+        'public': bool,  # DEPRECATED
+        'description': str,
+        'contents': RootNode,
+        'sizes': dict,
+        'push_session': str,
+    }
+
+    def __init__(self):
+        self.object_hashes = set()
+        # Nodes that are not (yet) children of a group. After parsing, only the root should be left;
+        # otherwise, there were nodes in places where they don't belong, e.g., metadata.
+        self._detached = {}
+
+    def __call__(self, value):
+        type_str = value.get('type')
+        if type_str is None:
+            return value
+        elif type_str in (FileNode.json_type, TableNode.json_type):
+            node = self._decode_leaf(type_str, value)
+        elif type_str in (GroupNode.json_type, RootNode.json_type):
+            node = self._decode_group(type_str, value)
+        else:
+            raise ValidationError("Invalid node type: %r" % type_str)
+        self._detached[id(node)] = node
+        return node
+
+    def _decode_leaf(self, type_str, value):
+        hashes = value.get('hashes')
+        if not isinstance(hashes, list):
+            raise ValidationError("%s node is missing hashes" % type_str)
+        for objhash in hashes:
+            if not isinstance(objhash, str) or not SHA256_RE.fullmatch(objhash):
+                raise ValidationError("Invalid hash: %r" % objhash)
+
+        metadata = value.get('metadata', {})
+        if not isinstance(metadata, dict):
+            raise ValidationError("Metadata must be an object")
+
+        if type_str == FileNode.json_type:
+            extra = set(value) - {'type', 'hashes', 'metadata'}
+            node = FileNode(hashes, metadata)
+        else:
+            extra = set(value) - {'type', 'hashes', 'format', 'metadata'}
+            fmt = value.get('format')
+            if fmt not in PACKAGE_FORMATS:
+                raise ValidationError("Invalid table format: %r" % fmt)
+            node = TableNode(hashes, fmt, metadata)
+        if extra:
+            raise ValidationError("Unexpected %s node properties: %s" % (type_str, ', '.join(sorted(extra))))
+
+        self.object_hashes.update(hashes)
+        return node
+
+    def _decode_group(self, type_str, value):
+        children = value.get('children')
+        if not isinstance(children, dict):
+            raise ValidationError("%s node is missing children" % type_str)
+        extra = set(value) - {'type', 'children'}
+        if extra:
+            raise ValidationError("Unexpected %s node properties: %s" % (type_str, ', '.join(sorted(extra))))
+
+        for name, child in children.items():
+            if isinstance(child, RootNode) or self._detached.pop(id(child), None) is not child:
+                raise ValidationError("Invalid child node: %r" % name)
+
+        node_cls = RootNode if type_str == RootNode.json_type else GroupNode
+        return node_cls(children)
+
+    def decode(self, data):
+        """
+        Parses and checks the request body.
+        """
+        try:
+            body = json.loads(data, object_hook=self)
+        except ValueError as ex:
+            raise ValidationError("Invalid JSON: %s" % ex)
+
+        if not isinstance(body, dict):
+            raise ValidationError("Request body must be an object")
+        # A push that follows a dry run can send the session token instead of the contents.
+        if 'push_session' in body:
+            required = ['push_session']
+            if 'contents' in body:
+                raise ValidationError("'contents' and 'push_session' are mutually exclusive")
+        else:
+            required = ['description', 'contents']
+        for key in required:
+            if key not in body:
+                raise ValidationError("%r is a required property" % key)
+        for key, value in body.items():
+            expected_type = self.BODY_KEYS.get(key)
+            if expected_type is None:
+                raise ValidationError("Unexpected property: %r" % key)
+            if not isinstance(value, expected_type):
+                raise ValidationError("Invalid value for %r" % key)
+
+        for blob_hash, size in body.get('sizes', {}).items():
+            if not isinstance(size, int) or isinstance(size, bool):
+                raise ValidationError("Invalid size for %s: %r" % (blob_hash, size))
+
+        if list(self._detached.values()) != ([body['contents']] if 'contents' in body else []):
+            raise ValidationError("Unexpected package nodes outside of the contents")
+
+        return body
+
 LOG_SCHEMA = {
     'type': 'array',
     'items': {
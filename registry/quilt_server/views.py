@@ -10,38 +10,56 @@ We disable this behavior because it can cause lots of unexpected queries with
 major performance implications. See `expire_on_commit=False` in `__init__.py`.
 """
 
+import base64
+import binascii
+import bisect
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from functools import reduce, wraps
 import gzip
 import json
+import os
 import time
 from urllib.parse import urlencode
 
 import boto3
 from botocore.exceptions import ClientError
-from flask import abort, g, redirect, render_template, request, Response
+from flask import abort, g, redirect, render_template, request, Response, stream_with_context
 from flask_cors import CORS
 from flask_json import as_json, jsonify
 import httpagentparser
 from jsonschema import Draft4Validator, ValidationError
 from oauthlib.oauth2 import OAuth2Error
+from packaging.version import Version as PackagingVersion
 import re
 import requests
 from requests_oauthlib import OAuth2Session
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import undefer
 import stripe
 
 from . import app, db
-from .analytics import MIXPANEL_EVENT, mp
+from .analytics import MIXPANEL_EVENT, mp, spool
+from .auth_cache import INVALID, RedisCache, TokenCache
+from .cache import LocalCache
 from .const import FTS_LANGUAGE, PaymentPlan, PUBLIC, TEAM, VALID_NAME_RE, VALID_EMAIL_RE
-from .core import (decode_node, find_object_hashes, hash_contents,
+from .core import (encode_node, find_object_hashes, hash_contents,
                    FileNode, GroupNode, RootNode, LATEST_TAG, README)
+from .events import record_event
 from .models import (Access, Customer, Event, Instance, InstanceBlobAssoc, Invitation, Log, Package,
-                     S3Blob, Tag, Version)
-from .schemas import LOG_SCHEMA, PACKAGE_SCHEMA, USERNAME_EMAIL_SCHEMA, USERNAME_SCHEMA
+                     PackageEventCount, PackageSearch, PushSession, S3Blob, Tag, UserEventCount,
+                     Version)
+from .presign import S3UrlSigner
+from .schemas import (LOG_SCHEMA, SHA256_PATTERN, USERNAME_EMAIL_SCHEMA, USERNAME_SCHEMA,
+                      PackageDecoder)
+
+try:
+    from uwsgidecorators import timer
+except ImportError:
+    # Running using Flask in dev; expired push sessions are ignored, but never deleted.
+    timer = None
 
 QUILT_CDN = 'https://cdn.quiltdata.com/'
 
@@ -68,6 +86,10 @@ INVITE_SEND_URL = app.config['INVITE_SEND_URL']
 
 PACKAGE_BUCKET_NAME = app.config['PACKAGE_BUCKET_NAME']
 PACKAGE_URL_EXPIRATION = app.config['PACKAGE_URL_EXPIRATION']
+MULTIPART_UPLOAD_THRESHOLD = app.config['MULTIPART_UPLOAD_THRESHOLD']
+MULTIPART_UPLOAD_PART_SIZE = app.config['MULTIPART_UPLOAD_PART_SIZE']
+PUSH_SESSION_EXPIRATION = app.config['PUSH_SESSION_EXPIRATION']
+PUSH_SESSION_CLEANUP_INTERVAL = app.config['PUSH_SESSION_CLEANUP_INTERVAL']
 
 TEAM_ID = app.config['TEAM_ID']
 ALLOW_ANONYMOUS_ACCESS = app.config['ALLOW_ANONYMOUS_ACCESS']
@@ -78,6 +100,16 @@ ENABLE_USER_ENDPOINTS = app.config['ENABLE_USER_ENDPOINTS']
 S3_HEAD_OBJECT = 'head_object'
 S3_GET_OBJECT = 'get_object'
 S3_PUT_OBJECT = 'put_object'
+S3_HTTP_METHODS = {
+    S3_HEAD_OBJECT: 'HEAD',
+    S3_GET_OBJECT: 'GET',
+    S3_PUT_OBJECT: 'PUT',
+}
+S3_UPLOAD_PART = 'upload_part'
+S3_COMPLETE_MULTIPART_UPLOAD = 'complete_multipart_upload'
+S3_ABORT_MULTIPART_UPLOAD = 'abort_multipart_upload'
+
+S3_MAX_PARTS = 10000
 
 OBJ_DIR = 'objs'
 
@@ -88,17 +120,48 @@ MAX_METADATA_SIZE = 100 * 1024 * 1024
 PREVIEW_MAX_CHILDREN = 10
 PREVIEW_MAX_DEPTH = 4
 
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_PAGE_SIZE = 1000
+README_SNIPPET_LEN = 1024
+# Use the "rank / (rank + 1)" normalization; makes it look sort of like percentage.
+RANK_NORMALIZATION = 32
+
 MAX_PREVIEW_SIZE = 640 * 1024  # 640KB ought to be enough for anybody...
 
-s3_client = boto3.client(
-    's3',
-    endpoint_url=app.config.get('S3_ENDPOINT'),
+# Hex digits only, so they're safe to use in LIKE patterns.
+HASH_PREFIX_RE = re.compile(r'[0-9a-f]{1,64}')
+# Ambiguous hash prefixes return at most this many hashes.
+MAX_HASH_MATCHES = 100
+
+# Number of blobs per chunk of a streamed response.
+RESPONSE_BATCH_SIZE = 1000
+# Packages per install_batch request, and blobs per package in its response.
+MAX_INSTALL_BATCH_SIZE = 100
+INSTALL_BATCH_PAGE_SIZE = 1000
+# Number of blobs per INSERT when pushing a new instance.
+BLOB_INSERT_BATCH_SIZE = 5000
+
+# The session gives us the client's credentials, for signing URLs without boto.
+s3_session = boto3.Session(
     aws_access_key_id=app.config.get('AWS_ACCESS_KEY_ID'),
     aws_secret_access_key=app.config.get('AWS_SECRET_ACCESS_KEY')
 )
+s3_client = s3_session.client(
+    's3',
+    endpoint_url=app.config.get('S3_ENDPOINT')
+)
+
+presigned_url_cache = LocalCache(app.config['PRESIGNED_URL_CACHE_SIZE'])
 
 auth_session = requests.Session()
 
+token_cache = TokenCache(
+    ttl=app.config['AUTH_CACHE_TTL'],
+    negative_ttl=app.config['AUTH_CACHE_NEGATIVE_TTL'],
+    max_size=app.config['AUTH_CACHE_SIZE'],
+    shared=RedisCache(app.config['AUTH_CACHE_REDIS_URL']) if app.config['AUTH_CACHE_REDIS_URL'] else None
+)
+
 stripe.api_key = app.config['STRIPE_SECRET_KEY']
 HAVE_PAYMENTS = bool(stripe.api_key)
 
@@ -304,6 +367,36 @@ def handle_api_exception(error):
     response.status_code = error.status_code
     return response
 
+def _validate_token(auth):
+    """
+    Asks the auth service who the Authorization header belongs to.
+
+    Returns a dict with the user info, or `INVALID` if the auth service rejected it.
+    Other errors aren't cached, so they raise an `ApiException` instead.
+    """
+    headers = {
+        AUTHORIZATION_HEADER: auth
+    }
+    try:
+        resp = auth_session.get(OAUTH_USER_API, headers=headers)
+        resp.raise_for_status()
+
+        data = resp.json()
+        # TODO(dima): Generalize this.
+        user = data.get('current_user', data.get('login'))
+        assert user
+        email = data['email']
+        is_admin = data.get('is_staff', False)
+
+        return dict(user=user, email=email, is_admin=is_admin)
+    except requests.HTTPError as ex:
+        if resp.status_code == requests.codes.unauthorized:
+            return INVALID
+        else:
+            raise ApiException(requests.codes.server_error, "Server error")
+    except (ConnectionError, requests.RequestException) as ex:
+        raise ApiException(requests.codes.server_error, "Server error")
+
 def api(require_login=True, schema=None, enabled=True, require_admin=False):
     """
     Decorator for API requests.
@@ -342,31 +435,19 @@ def api(require_login=True, schema=None, enabled=True, require_admin=False):
                 if require_login or not ALLOW_ANONYMOUS_ACCESS:
                     raise ApiException(requests.codes.unauthorized, "Not logged in")
             else:
-                headers = {
-                    AUTHORIZATION_HEADER: auth
-                }
-                try:
-                    resp = auth_session.get(OAUTH_USER_API, headers=headers)
-                    resp.raise_for_status()
-
-                    data = resp.json()
-                    # TODO(dima): Generalize this.
-                    user = data.get('current_user', data.get('login'))
-                    assert user
-                    email = data['email']
-                    is_admin = data.get('is_staff', False)
-
-                    g.auth = Auth(user=user, email=email, is_logged_in=True, is_admin=is_admin)
-                except requests.HTTPError as ex:
-                    if resp.status_code == requests.codes.unauthorized:
-                        raise ApiException(
-                            requests.codes.unauthorized,
-                            "Invalid credentials"
-                        )
-                    else:
-                        raise ApiException(requests.codes.server_error, "Server error")
-                except (ConnectionError, requests.RequestException) as ex:
-                    raise ApiException(requests.codes.server_error, "Server error")
+                user_info = token_cache.get(auth)
+                if user_info is None:
+                    user_info = _validate_token(auth)
+                    token_cache.set(auth, user_info)
+
+                if user_info == INVALID:
+                    raise ApiException(
+                        requests.codes.unauthorized,
+                        "Invalid credentials"
+                    )
+
+                g.auth = Auth(user=user_info['user'], email=user_info['email'],
+                              is_logged_in=True, is_admin=user_info['is_admin'])
 
             if require_admin and not g.auth.is_admin:
                 raise ApiException(
@@ -408,11 +489,12 @@ def _get_package(auth, owner, package_name):
         raise PackageNotFoundException(owner, package_name, auth.is_logged_in)
     return package
 
-def _get_instance(auth, owner, package_name, package_hash):
+def _get_instance(auth, owner, package_name, package_hash, load_contents=True):
+    query = Instance.query.filter_by(hash=package_hash)
+    if load_contents:
+        query = query.options(undefer('contents'))  # Contents is deferred by default.
     instance = (
-        Instance.query
-        .filter_by(hash=package_hash)
-        .options(undefer('contents'))  # Contents is deferred by default.
+        query
         .join(Instance.package)
         .filter_by(owner=owner, name=package_name)
         .join(Package.access)
@@ -456,14 +538,99 @@ def _mp_track(**kwargs):
 
     mp.track(distinct_id, MIXPANEL_EVENT, all_args)
 
+def _delete_expired_push_sessions(signum):
+    """
+    Deletes the push sessions nobody used. Runs in the uwsgi spooler every
+    PUSH_SESSION_CLEANUP_INTERVAL seconds, so pushes don't have to.
+    """
+    table = PushSession.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(
+            table.c.created < sa.func.now() - timedelta(seconds=PUSH_SESSION_EXPIRATION)
+        ))
+
+if timer is not None:
+    timer(PUSH_SESSION_CLEANUP_INTERVAL, target='spooler')(_delete_expired_push_sessions)
+
+def _generate_presigned_urls(method, owner, blob_hashes):
+    """
+    Returns a dict of signed URLs for the given blobs.
+
+    The signing key is derived once per call, and each URL is signed locally with an HMAC.
+    Signed URLs are reused for half of their lifetime - PACKAGE_URL_EXPIRATION, or less if
+    the credentials expire sooner - so clients always get URLs that are valid for at least
+    half as long as new ones.
+    """
+    signer = S3UrlSigner(
+        s3_session.get_credentials(),
+        # Same as boto's default; S3 endpoints other than AWS don't have regions.
+        s3_client.meta.region_name or 'us-east-1',
+        s3_client.meta.endpoint_url,
+        PACKAGE_URL_EXPIRATION
+    )
+    http_method = S3_HTTP_METHODS[method]
+    ttl = signer.lifetime // 2
+    urls = {}
+    for blob_hash in blob_hashes:
+        key = (method, owner, blob_hash)
+        url = presigned_url_cache.get(key)
+        if url is None:
+            url = signer.sign(http_method, PACKAGE_BUCKET_NAME, '%s/%s/%s' % (OBJ_DIR, owner, blob_hash))
+            presigned_url_cache.set(key, url, ttl)
+        urls[blob_hash] = url
+    return urls
+
 def _generate_presigned_url(method, owner, blob_hash):
-    return s3_client.generate_presigned_url(
-        method,
-        Params=dict(
-            Bucket=PACKAGE_BUCKET_NAME,
-            Key='%s/%s/%s' % (OBJ_DIR, owner, blob_hash)
+    return _generate_presigned_urls(method, owner, [blob_hash])[blob_hash]
+
+def _create_multipart_upload(owner, blob_hash, size):
+    """
+    Starts a multipart upload for a blob of `size` bytes (before compression), and returns
+    the part size and signed URLs for all of the parts, and for completing or aborting the upload.
+
+    The client gzips the blob, so we only have an upper bound on the number of parts;
+    it only needs to use as many as the compressed blob requires.
+    """
+    key = '%s/%s/%s' % (OBJ_DIR, owner, blob_hash)
+
+    # Allow for deflate's worst case of stored blocks, plus the gzip header.
+    max_size = size + size // 1000 + 1024
+    part_size = max(MULTIPART_UPLOAD_PART_SIZE, -(-max_size // S3_MAX_PARTS))
+    num_parts = -(-max_size // part_size)
+
+    upload = s3_client.create_multipart_upload(
+        Bucket=PACKAGE_BUCKET_NAME,
+        Key=key,
+        ContentEncoding='gzip'
+    )
+    params = dict(
+        Bucket=PACKAGE_BUCKET_NAME,
+        Key=key,
+        UploadId=upload['UploadId']
+    )
+
+    return dict(
+        part_size=part_size,
+        parts=[
+            s3_client.generate_presigned_url(
+                S3_UPLOAD_PART,
+                Params=dict(params, PartNumber=part_number),
+                ExpiresIn=PACKAGE_URL_EXPIRATION
+            )
+            for part_number in range(1, num_parts + 1)
+        ],
+        complete=s3_client.generate_presigned_url(
+            S3_COMPLETE_MULTIPART_UPLOAD,
+            Params=params,
+            ExpiresIn=PACKAGE_URL_EXPIRATION,
+            HttpMethod='POST'
         ),
-        ExpiresIn=PACKAGE_URL_EXPIRATION
+        abort=s3_client.generate_presigned_url(
+            S3_ABORT_MULTIPART_UPLOAD,
+            Params=params,
+            ExpiresIn=PACKAGE_URL_EXPIRATION,
+            HttpMethod='DELETE'
+        )
     )
 
 def _get_or_create_customer():
@@ -557,41 +724,75 @@ def download_object_preview_impl(owner, obj_hash):
 
     return data.decode(errors='ignore')  # Data may be truncated in the middle of a UTF-8 character.
 
-def download_object_preview(owner, obj_hash):
+def _track_download_exception(owner, blob_hash, ex):
+    # Like `_mp_track`, but with no request to get the user and client from.
+    mp.track(owner, MIXPANEL_EVENT, dict(
+        type="download_exception",
+        obj_owner=owner,
+        obj_hash=blob_hash,
+        error=str(ex),
+        time=time.time(),
+        deployment_id=DEPLOYMENT_ID,
+    ))
+
+@spool
+def _readme_preview_task(args):
+    """
+    Downloads a README and saves its preview, then updates the search documents that use it.
+    Runs in a uwsgi spooler process, so pushes don't wait for S3.
+    """
+    owner = args['owner']
+    blob_hash = args['blob_hash']
+
+    blob_table = S3Blob.__table__
+    blob_filter = sa.and_(blob_table.c.owner == owner, blob_table.c.hash == blob_hash)
+
+    # Several pushes could've queued the same README.
+    if db.engine.execute(
+            sa.select([blob_table.c.preview.isnot(None)]).where(blob_filter)
+    ).scalar():
+        return
+
     try:
-        return download_object_preview_impl(owner, obj_hash)
+        preview = download_object_preview_impl(owner, blob_hash)
     except ClientError as ex:
-        _mp_track(
-            type="download_exception",
-            obj_owner=owner,
-            obj_hash=obj_hash,
-            error=str(ex),
-        )
+        _track_download_exception(owner, blob_hash, ex)
         if ex.response['ResponseMetadata']['HTTPStatusCode'] == requests.codes.not_found:
-            # The client somehow failed to upload the README.
-            raise ApiException(
-                requests.codes.forbidden,
-                "Failed to download the README; make sure it has been uploaded correctly."
-            )
-        else:
-            # Something unexpected happened.
-            raise
+            # The client somehow failed to upload the README; the package just has no preview.
+            return
+        # Something unexpected happened; let the spooler retry.
+        raise
     except OSError as ex:
         # Failed to ungzip: either the contents is not actually gzipped,
         # or the response was truncated because it was too big.
-        _mp_track(
-            type="download_exception",
-            obj_owner=owner,
-            obj_hash=obj_hash,
-            error=str(ex),
+        _track_download_exception(owner, blob_hash, ex)
+        return
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            blob_table.update()
+            .where(blob_filter)
+            .values(
+                preview=preview,
+                preview_tsv=sa.func.to_tsvector(FTS_LANGUAGE, preview)
+            )
         )
-        raise ApiException(
-            requests.codes.forbidden,
-            "Failed to ungzip the README; make sure it has been uploaded correctly."
+
+        search_table = PackageSearch.__table__
+        conn.execute(
+            search_table.update()
+            .where(search_table.c.package_id == Package.id)
+            .where(search_table.c.instance_id == Instance.id)
+            .where(Instance.readme_blob_id == blob_table.c.id)
+            .where(blob_filter)
+            .values(
+                tsv=_search_tsv(Package.owner, Package.name, blob_table.c.preview_tsv),
+                readme=sa.func.substr(blob_table.c.preview, 1, README_SNIPPET_LEN)
+            )
         )
 
 @app.route('/api/package/<owner>/<package_name>/<package_hash>', methods=['PUT'])
-@api(schema=PACKAGE_SCHEMA)
+@api()
 @as_json
 def package_put(owner, package_name, package_hash):
     # TODO: Write access for collaborators.
@@ -602,36 +803,66 @@ def package_put(owner, package_name, package_hash):
     if not VALID_NAME_RE.match(package_name):
         raise ApiException(requests.codes.bad_request, "Invalid package name")
 
-    # TODO: Description.
-    data = json.loads(request.data.decode('utf-8'), object_hook=decode_node)
-    dry_run = data.get('dry_run', False)
-    public = data.get('is_public', data.get('public', False))
-    team = data.get('is_team', False)
-    contents = data['contents']
-    sizes = data.get('sizes', {})
+    # Parse and validate the body in one pass; it can be huge.
+    decoder = PackageDecoder()
+    try:
+        data = decoder.decode(request.get_data().decode('utf-8'))
+    except UnicodeDecodeError:
+        raise ApiException(requests.codes.bad_request, "Request body must be UTF-8")
+    except ValidationError as ex:
+        raise ApiException(requests.codes.bad_request, ex.message)
+
+    push_session_token = data.get('push_session')
+    if push_session_token is not None:
+        # The contents were already checked by the dry run; use them instead of re-parsing.
+        push_session = (
+            PushSession.query
+            .with_for_update()
+            .filter_by(token=push_session_token, owner=owner, package_name=package_name,
+                       hash=package_hash)
+            .filter(PushSession.created > sa.func.now() - timedelta(seconds=PUSH_SESSION_EXPIRATION))
+            .one_or_none()
+        )
+        if push_session is None:
+            raise ApiException(requests.codes.gone, "Push session not found or expired")
+        # It can only be used once.
+        db.session.delete(push_session)
+
+        dry_run = False
+        public = push_session.is_public
+        team = push_session.is_team
+        contents = push_session.contents
+        sizes = push_session.sizes
+        all_hashes = set(sizes)
+    else:
+        # TODO: Description.
+        dry_run = data.get('dry_run', False)
+        public = data.get('is_public', data.get('public', False))
+        team = data.get('is_team', False)
+        contents = data['contents']
+        sizes = data.get('sizes', {})
+
+        if hash_contents(contents) != package_hash:
+            raise ApiException(requests.codes.bad_request, "Wrong contents hash")
+
+        all_hashes = decoder.object_hashes
+
+        # Old clients don't send sizes. But if sizes are present, make sure they match the hashes.
+        if sizes and set(sizes) != all_hashes:
+            raise ApiException(requests.codes.bad_request, "Sizes don't match the hashes")
 
     if public and not ALLOW_ANONYMOUS_ACCESS:
         raise ApiException(requests.codes.forbidden, "Public access not allowed")
     if team and not ALLOW_TEAM_ACCESS:
         raise ApiException(requests.codes.forbidden, "Team access not allowed")
 
-    if hash_contents(contents) != package_hash:
-        raise ApiException(requests.codes.bad_request, "Wrong contents hash")
-
-    all_hashes = set(find_object_hashes(contents))
-
-    # Old clients don't send sizes. But if sizes are present, make sure they match the hashes.
-    if sizes and set(sizes) != all_hashes:
-        raise ApiException(requests.codes.bad_request, "Sizes don't match the hashes")
-
     # Insert a package if it doesn't already exist.
     # TODO: Separate endpoint for just creating a package with no versions?
-    package = (
-        Package.query
-        .with_for_update()
-        .filter_by(owner=owner, name=package_name)
-        .one_or_none()
-    )
+    # The dry run doesn't change anything, so it doesn't need to lock the row.
+    package_query = Package.query.filter_by(owner=owner, name=package_name)
+    if not dry_run:
+        package_query = package_query.with_for_update()
+    package = package_query.one_or_none()
 
     if package is None:
         # Check for case-insensitive matches, and reject the push.
@@ -708,91 +939,121 @@ def package_put(owner, package_name, package_hash):
                     dict(team=app.config['TEAM_ID'], user=owner, pkg=package_name)
                 )
 
-    # Insert an instance if it doesn't already exist.
-    instance = (
-        Instance.query
-        .with_for_update()
-        .filter_by(package=package, hash=package_hash)
-        .one_or_none()
-    )
-
     # No more error checking at this point, so return from dry-run early.
     if dry_run:
+        # Blobs we already have don't need to be uploaded again, so let the client skip them
+        # without checking S3.
+        existing_hashes = set(
+            blob_hash for blob_hash, in (
+                db.session.query(S3Blob.hash)
+                .filter(sa.and_(
+                    S3Blob.owner == owner,
+                    S3Blob.hash.in_(all_hashes)
+                ))
+            )
+        ) if all_hashes else set()
+
         db.session.rollback()
 
+        # Save the checked contents, so the push that follows doesn't need to send them again.
+        # Clients that repeat the dry run get the same session back, instead of another copy
+        # of the contents; the hash covers them.
+        push_session = (
+            PushSession.query
+            .with_for_update()
+            .filter_by(owner=owner, package_name=package_name, hash=package_hash)
+            .filter(PushSession.created > sa.func.now() - timedelta(seconds=PUSH_SESSION_EXPIRATION))
+            .first()
+        )
+        if push_session is None:
+            push_session = PushSession(
+                token=binascii.hexlify(os.urandom(32)).decode(),
+                owner=owner,
+                package_name=package_name,
+                hash=package_hash,
+                contents=contents
+            )
+            db.session.add(push_session)
+        else:
+            push_session.created = sa.func.now()
+        push_session.is_public = public
+        push_session.is_team = team
+        push_session.sizes = {blob_hash: sizes.get(blob_hash) for blob_hash in all_hashes}
+        push_session_token = push_session.token
+        db.session.commit()
+
+        # Clients that send sizes can upload large blobs in parts. The uploads get started
+        # by `multipart_upload_post` once the client actually needs them; otherwise, clients
+        # that give up or repeat the dry run would leave unfinished uploads behind.
+        multipart_hashes = set(
+            blob_hash for blob_hash, size in sizes.items()
+            if (size is not None and size >= MULTIPART_UPLOAD_THRESHOLD and
+                blob_hash not in existing_hashes)
+        )
+
         # List of signed URLs is potentially huge, so stream it.
 
         def _generate():
-            yield '{"upload_urls":{'
+            yield '{"push_session":%s,"existing":%s,"upload_urls":{' % (
+                json.dumps(push_session_token), json.dumps(list(existing_hashes))
+            )
             for idx, blob_hash in enumerate(all_hashes):
                 comma = ('' if idx == 0 else ',')
                 value = dict(
                     head=_generate_presigned_url(S3_HEAD_OBJECT, owner, blob_hash),
                     put=_generate_presigned_url(S3_PUT_OBJECT, owner, blob_hash)
                 )
+                if blob_hash in multipart_hashes:
+                    value['multipart'] = True
                 yield '%s%s:%s' % (comma, json.dumps(blob_hash), json.dumps(value))
             yield '}}'
 
-        return Response(_generate(), content_type='application/json')
+        return _json_stream_response(_generate())
+
+    # Insert an instance if it doesn't already exist.
+    instance = (
+        Instance.query
+        .with_for_update()
+        .filter_by(package=package, hash=package_hash)
+        .one_or_none()
+    )
 
     if instance is None:
         readme_hash = None
-        readme_preview = None
+        need_readme_preview = False
 
         readme = contents.children.get(README)
         if isinstance(readme, FileNode):
             assert len(readme.hashes) == 1
             readme_hash = readme.hashes[0]
 
-            # Download the README if necessary. We want to do this early, before we call
-            # with_for_update() on S3Blob, since it's potentially expensive.
-            have_readme = (
+            # Download the README after the commit, if we don't have it yet.
+            need_readme_preview = (
                 db.session.query(sa.func.count(S3Blob.id))
                 .filter_by(owner=owner, hash=readme_hash)
                 .filter(S3Blob.preview.isnot(None))
-            ).one()[0] == 1
-
-            if not have_readme:
-                readme_preview = download_object_preview(owner, readme_hash)
+            ).one()[0] == 0
 
         instance = Instance(
             package=package,
             contents=contents,
             hash=package_hash,
             created_by=g.auth.user,
-            updated_by=g.auth.user
+            updated_by=g.auth.user,
+            # Save the summary for package_preview.
+            preview=_generate_preview(contents)
         )
+        db.session.add(instance)
+        db.session.flush()  # Get the instance ID.
 
-        # Add all the hashes that don't exist yet.
+        blobs = _add_instance_blobs(instance, owner, all_hashes, sizes)
+        instance.total_size = sum(size or 0 for _, size in blobs.values())
 
-        blobs = (
-            S3Blob.query
-            .with_for_update()
-            .filter(
-                sa.and_(
-                    S3Blob.owner == owner,
-                    S3Blob.hash.in_(all_hashes)
-                )
-            )
-            .all()
-        ) if all_hashes else []
-
-        blob_by_hash = { blob.hash: blob for blob in blobs }
-
-        for blob_hash in all_hashes:
-            blob_size = sizes.get(blob_hash)
-            blob = blob_by_hash.get(blob_hash)
-            if blob is None:
-                blob = S3Blob(owner=owner, hash=blob_hash, size=blob_size)
-            if blob_hash == readme_hash:
-                if readme_preview is not None:
-                    # If we've just downloaded the README, save it in the blob.
-                    # Otherwise, it was already set.
-                    blob.preview = readme_preview
-                    blob.preview_tsv = sa.func.to_tsvector(FTS_LANGUAGE, readme_preview)
-                instance.readme_blob = blob
-            instance.blobs.append(blob)
+        if readme_hash is not None:
+            instance.readme_blob_id = blobs[readme_hash][0]
     else:
+        need_readme_preview = False
+
         # Just update the contents dictionary.
         # Nothing else could've changed without invalidating the hash.
         instance.contents = contents
@@ -808,10 +1069,15 @@ def package_put(owner, package_name, package_hash):
     )
     db.session.add(log)
 
-    # Insert an event.
-    event = Event(
+    db.session.commit()
+
+    if need_readme_preview:
+        # Previews and search results show the README once the task is done.
+        _readme_preview_task.spool(owner=owner, blob_hash=readme_hash)
+
+    record_event(
+        Event.Type.PUSH,
         user=g.auth.user,
-        type=Event.Type.PUSH,
         package_owner=owner,
         package_name=package_name,
         package_hash=package_hash,
@@ -819,9 +1085,6 @@ def package_put(owner, package_name, package_hash):
             public=public
         )
     )
-    db.session.add(event)
-
-    db.session.commit()
 
     _mp_track(
         type="push",
@@ -834,15 +1097,329 @@ def package_put(owner, package_name, package_hash):
         package_url='%s/package/%s/%s' % (CATALOG_URL, owner, package_name)
     )
 
+def _add_instance_blobs(instance, owner, blob_hashes, sizes):
+    """
+    Creates the blobs that don't exist yet and links all of them to the instance,
+    using bulk inserts rather than one ORM object per row.
+
+    Returns a dict of blob hash to (blob ID, size).
+    """
+    table = S3Blob.__table__
+    blobs = {}
+
+    # Sort the hashes, so concurrent pushes insert the rows in the same order.
+    hash_list = sorted(blob_hashes)
+    for idx in range(0, len(hash_list), BLOB_INSERT_BATCH_SIZE):
+        batch = hash_list[idx:idx+BLOB_INSERT_BATCH_SIZE]
+        # Only returns the rows that got inserted.
+        inserted = db.session.execute(
+            postgresql.insert(table)
+            .values([dict(owner=owner, hash=blob_hash, size=sizes.get(blob_hash)) for blob_hash in batch])
+            .on_conflict_do_nothing(index_elements=[table.c.owner, table.c.hash])
+            .returning(table.c.hash, table.c.id, table.c.size)
+        )
+        blobs.update((blob_hash, (blob_id, size)) for blob_hash, blob_id, size in inserted)
+
+        existing = [blob_hash for blob_hash in batch if blob_hash not in blobs]
+        if existing:
+            blobs.update(
+                (blob_hash, (blob_id, size)) for blob_hash, blob_id, size in (
+                    db.session.query(S3Blob.hash, S3Blob.id, S3Blob.size)
+                    .filter(sa.and_(
+                        S3Blob.owner == owner,
+                        S3Blob.hash.in_(existing)
+                    ))
+                )
+            )
+
+    if blobs:
+        db.session.execute(InstanceBlobAssoc.insert().values([
+            dict(instance_id=instance.id, blob_id=blob_id) for blob_id, _ in blobs.values()
+        ]))
+
+    return blobs
+
+def _json_stream_response(chunks):
+    """
+    Streams the JSON strings produced by `chunks`.
+    ResponseCompressionMiddleware compresses them if the client supports it.
+    """
+    return Response(stream_with_context(chunks), content_type='application/json')
+
+MULTIPART_UPLOAD_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'size': {
+            'type': 'integer',
+            'minimum': 0
+        }
+    },
+    'required': ['size']
+}
+
+@app.route('/api/multipart_upload/<owner>/<blob_hash>', methods=['POST'])
+@api(schema=MULTIPART_UPLOAD_SCHEMA)
+@as_json
+def multipart_upload_post(owner, blob_hash):
+    """
+    Starts a multipart upload of a blob that a push dry run asked the client to upload in parts.
+
+    Uploads that are started but never completed or aborted (e.g., the client crashed) are
+    only cleaned up by the bucket's lifecycle rule; see MULTIPART_UPLOAD_THRESHOLD.
+    """
+    if g.auth.user != owner:
+        raise ApiException(requests.codes.forbidden,
+                           "Only the package owner can push packages.")
+
+    if not re.match(SHA256_PATTERN + '$', blob_hash):
+        raise ApiException(requests.codes.bad_request, "Invalid hash")
+
+    data = request.get_json()
+    return _create_multipart_upload(owner, blob_hash, data['size'])
+
 @app.route('/api/package/<owner>/<package_name>/<package_hash>', methods=['GET'])
 @api(require_login=False)
 @as_json
 def package_get(owner, package_name, package_hash):
     subpath = request.args.get('subpath')
+    components = subpath.split('/') if subpath else []
+
+    # Clients that send a limit get the URLs in pages: the first page has the contents,
+    # and the following ones, requested with `cursor`, have just the URLs and sizes.
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    if limit is not None and limit <= 0:
+        raise ApiException(requests.codes.bad_request, "Invalid limit")
+
+    if cursor is None:
+        instance = _get_instance(g.auth, owner, package_name, package_hash)
+
+        assert isinstance(instance.contents, RootNode)
+
+        subnode = instance.contents
+        for component in components:
+            try:
+                subnode = subnode.children[component]
+            except (AttributeError, KeyError):
+                raise ApiException(requests.codes.not_found, "Invalid subpath: %r" % component)
+    else:
+        instance = _get_instance(g.auth, owner, package_name, package_hash, load_contents=False)
+        subnode = None
+
+        if components:
+            # Only load the subtree we need.
+            path = [key for component in components for key in ('children', component)]
+            subnode = (
+                db.session.query(Instance.contents[path])
+                .filter(Instance.id == instance.id)
+                .scalar()
+            )
+            if subnode is None:
+                raise ApiException(requests.codes.not_found, "Invalid subpath: %r" % subpath)
+
+    sizes = None
+    if subnode is not None:
+        hash_list = sorted(set(find_object_hashes(subnode)))
+        start = bisect.bisect_right(hash_list, cursor) if cursor is not None else 0
+        end = start + limit if limit is not None else len(hash_list)
+        next_cursor = hash_list[end - 1] if end < len(hash_list) else None
+        hash_list = hash_list[start:end]
+    else:
+        # Following pages of a whole package: get the next hashes from the instance's blobs,
+        # without loading the contents.
+        blobs = (
+            db.session.query(S3Blob.hash, S3Blob.size)
+            .join(InstanceBlobAssoc, InstanceBlobAssoc.c.blob_id == S3Blob.id)
+            .filter(InstanceBlobAssoc.c.instance_id == instance.id)
+            .filter(S3Blob.hash > cursor)
+            .order_by(S3Blob.hash)
+            .limit(limit + 1 if limit is not None else None)
+            .all()
+        )
+        if limit is not None and len(blobs) > limit:
+            blobs = blobs[:limit]
+            next_cursor = blobs[-1].hash
+        else:
+            next_cursor = None
+        hash_list = [blob.hash for blob in blobs]
+        sizes = {blob.hash: blob.size for blob in blobs}
+
+    if cursor is None:
+        record_event(
+            Event.Type.INSTALL,
+            user=g.auth.user,
+            package_owner=owner,
+            package_name=package_name,
+            package_hash=package_hash,
+            extra=dict(
+                subpath=subpath
+            )
+        )
+
+        _mp_track(
+            type="install",
+            package_owner=owner,
+            package_name=package_name,
+            subpath=subpath,
+        )
 
-    instance = _get_instance(g.auth, owner, package_name, package_hash)
+    # The URLs and sizes are potentially huge, so stream them in batches
+    # instead of building the whole response in memory.
+    return _json_stream_response(
+        _generate_package_page(owner, instance, hash_list, next_cursor, include_contents=cursor is None,
+                               sizes=sizes)
+    )
 
-    assert isinstance(instance.contents, RootNode)
+def _generate_package_page(owner, instance, hash_list, next_cursor, include_contents, sizes=None):
+    """
+    Generates the JSON object for a page of `package_get`: the contents (for the first page),
+    and the signed URLs and sizes of the blobs in `hash_list`.
+    The sizes get looked up unless the caller already has them.
+    """
+    if include_contents:
+        yield '{"contents":%s,"created_by":%s,"created_at":%s,"updated_by":%s,"updated_at":%s,' % (
+            json.dumps(instance.contents, default=encode_node),
+            json.dumps(instance.created_by),
+            json.dumps(instance.created_at.timestamp()),
+            json.dumps(instance.updated_by),
+            json.dumps(instance.updated_at.timestamp()),
+        )
+    else:
+        yield '{'
+
+    yield '"next_cursor":%s' % json.dumps(next_cursor)
+
+    yield ',"urls":{'
+    for idx in range(0, len(hash_list), RESPONSE_BATCH_SIZE):
+        batch = hash_list[idx:idx+RESPONSE_BATCH_SIZE]
+        urls = _generate_presigned_urls(S3_GET_OBJECT, owner, batch)
+        yield ('' if idx == 0 else ',') + ','.join(
+            '%s:%s' % (json.dumps(blob_hash), json.dumps(urls[blob_hash])) for blob_hash in batch
+        )
+
+    yield '},"sizes":{'
+    if sizes is not None:
+        yield ','.join(
+            '%s:%s' % (json.dumps(blob_hash), json.dumps(sizes[blob_hash])) for blob_hash in hash_list
+        )
+        yield '}}'
+        return
+
+    comma = ''
+    for idx in range(0, len(hash_list), RESPONSE_BATCH_SIZE):
+        batch = hash_list[idx:idx+RESPONSE_BATCH_SIZE]
+        sizes = (
+            db.session.query(S3Blob.hash, S3Blob.size)
+            .filter(
+                sa.and_(
+                    S3Blob.owner == owner,
+                    S3Blob.hash.in_(batch)
+                )
+            )
+            .all()
+        )
+        if sizes:
+            yield comma + ','.join(
+                '%s:%s' % (json.dumps(blob_hash), json.dumps(size)) for blob_hash, size in sizes
+            )
+            comma = ','
+    yield '}}'
+
+INSTALL_BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'packages': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'owner': {
+                        'type': 'string'
+                    },
+                    'name': {
+                        'type': 'string'
+                    },
+                    'hash': {
+                        'type': 'string'
+                    },
+                    'version': {
+                        'type': 'string'
+                    },
+                    'tag': {
+                        'type': 'string'
+                    },
+                    'subpath': {
+                        'type': 'string'
+                    }
+                },
+                'required': ['owner', 'name'],
+                'additionalProperties': False
+            }
+        },
+        'limit': {
+            'type': 'integer',
+            'minimum': 1
+        }
+    },
+    'required': ['packages']
+}
+
+def _resolve_install(item, limit):
+    """
+    Looks up the instance for one package of `install_batch`, and the first page of its blobs.
+    """
+    owner = item['owner']
+    package_name = item['name']
+    subpath = item.get('subpath')
+
+    package = _get_package(g.auth, owner, package_name)
+    query = Instance.query.options(undefer('contents'))
+
+    if 'hash' in item:
+        hash_prefix = item['hash'].lower()
+        if not HASH_PREFIX_RE.fullmatch(hash_prefix):
+            raise ApiException(requests.codes.bad_request, "Invalid hash: %r" % item['hash'])
+        instances = (
+            query
+            .filter(sa.and_(
+                Instance.package_id == package.id,
+                Instance.hash.like(hash_prefix + '%')
+            ))
+            .limit(2)
+            .all()
+        )
+        if len(instances) != 1:
+            raise ApiException(
+                requests.codes.not_found,
+                ("Ambiguous hash: %s" if instances else "Invalid hash: %s") % hash_prefix
+            )
+        instance = instances[0]
+    elif 'version' in item:
+        package_version = normalize_version(item['version'])
+        instance = (
+            query
+            .join(Instance.versions)
+            .filter_by(package=package, version=package_version)
+            .one_or_none()
+        )
+        if instance is None:
+            raise ApiException(
+                requests.codes.not_found,
+                "Version %s does not exist" % package_version
+            )
+    else:
+        package_tag = item.get('tag', LATEST_TAG)
+        instance = (
+            query
+            .join(Instance.tags)
+            .filter_by(package=package, tag=package_tag)
+            .one_or_none()
+        )
+        if instance is None:
+            raise ApiException(
+                requests.codes.not_found,
+                "Tag %r does not exist" % package_tag
+            )
 
     subnode = instance.contents
     for component in subpath.split('/') if subpath else []:
@@ -851,38 +1428,20 @@ def package_get(owner, package_name, package_hash):
         except (AttributeError, KeyError):
             raise ApiException(requests.codes.not_found, "Invalid subpath: %r" % component)
 
-    all_hashes = set(find_object_hashes(subnode))
-
-    blobs = (
-        S3Blob.query
-        .filter(
-            sa.and_(
-                S3Blob.owner == owner,
-                S3Blob.hash.in_(all_hashes)
-            )
-        )
-        .all()
-    ) if all_hashes else []
+    hash_list = sorted(set(find_object_hashes(subnode)))
+    next_cursor = hash_list[limit - 1] if limit < len(hash_list) else None
+    hash_list = hash_list[:limit]
 
-    urls = {
-        blob_hash: _generate_presigned_url(S3_GET_OBJECT, owner, blob_hash)
-        for blob_hash in all_hashes
-    }
-
-    # Insert an event.
-    event = Event(
+    record_event(
+        Event.Type.INSTALL,
         user=g.auth.user,
-        type=Event.Type.INSTALL,
         package_owner=owner,
         package_name=package_name,
-        package_hash=package_hash,
+        package_hash=instance.hash,
         extra=dict(
             subpath=subpath
         )
     )
-    db.session.add(event)
-
-    db.session.commit()
 
     _mp_track(
         type="install",
@@ -891,15 +1450,50 @@ def package_get(owner, package_name, package_hash):
         subpath=subpath,
     )
 
-    return dict(
-        contents=instance.contents,
-        urls=urls,
-        sizes={blob.hash: blob.size for blob in blobs},
-        created_by=instance.created_by,
-        created_at=instance.created_at.timestamp(),
-        updated_by=instance.updated_by,
-        updated_at=instance.updated_at.timestamp(),
-    )
+    return instance, hash_list, next_cursor
+
+@app.route('/api/install_batch/', methods=['POST'])
+@api(require_login=False, schema=INSTALL_BATCH_SCHEMA)
+@as_json
+def install_batch():
+    """
+    Resolves the hashes of several packages (e.g., from a quilt.yml) in one request,
+    and returns what `package_get` returns for each of them: the contents and the first page
+    of the blobs. The rest of the pages come from `package_get`.
+
+    Errors for individual packages are returned in the list instead of failing the request.
+    """
+    data = request.get_json()
+    items = data['packages']
+    limit = data.get('limit', INSTALL_BATCH_PAGE_SIZE)
+
+    if len(items) > MAX_INSTALL_BATCH_SIZE:
+        raise ApiException(requests.codes.bad_request,
+                           "Too many packages (max is %d)" % MAX_INSTALL_BATCH_SIZE)
+
+    results = []
+    for item in items:
+        try:
+            results.append((item['owner'], _resolve_install(item, limit)))
+        except ApiException as ex:
+            results.append((item['owner'], ex))
+
+    def _generate():
+        yield '{"packages":['
+        for idx, (owner, result) in enumerate(results):
+            if idx:
+                yield ','
+            if isinstance(result, ApiException):
+                yield json.dumps(dict(error=dict(status=result.status_code, message=result.message)))
+            else:
+                instance, hash_list, next_cursor = result
+                yield '{"hash":%s,"package":' % json.dumps(instance.hash)
+                yield from _generate_package_page(owner, instance, hash_list, next_cursor,
+                                                  include_contents=True)
+                yield '}'
+        yield ']}'
+
+    return _json_stream_response(_generate())
 
 def _generate_preview(node, max_depth=PREVIEW_MAX_DEPTH):
     if isinstance(node, GroupNode):
@@ -914,39 +1508,17 @@ def _generate_preview(node, max_depth=PREVIEW_MAX_DEPTH):
     else:
         return None
 
-@app.route('/api/package_preview/<owner>/<package_name>/<package_hash>', methods=['GET'])
-@api(require_login=False)
-@as_json
-def package_preview(owner, package_name, package_hash):
-    result = (
-        db.session.query(
-            Instance,
-            sa.func.bool_or(Access.user == PUBLIC).label('is_public'),
-            sa.func.bool_or(Access.user == TEAM).label('is_team')
-        )
-        .filter_by(hash=package_hash)
-        .join(Instance.package)
-        .filter_by(owner=owner, name=package_name)
-        .join(Package.access)
-        .filter(_access_filter(g.auth))
-        .group_by(Package.id, Instance.id)
-        .one_or_none()
-    )
-
-    if result is None:
-        raise ApiException(
-            requests.codes.not_found,
-            "Package hash does not exist"
-        )
-
-    (instance, is_public, is_team) = result
+def _generate_summary(owner, instance):
+    """
+    Computes the package preview for instances that don't have one saved.
+    Returns the contents preview, the total size, and the README hash and preview.
+    """
     assert isinstance(instance.contents, RootNode)
 
     readme = instance.contents.children.get(README)
     if isinstance(readme, FileNode):
         assert len(readme.hashes) == 1
         readme_hash = readme.hashes[0]
-        readme_url = _generate_presigned_url(S3_GET_OBJECT, owner, readme_hash)
         readme_blob = (
             S3Blob.query
             .filter_by(owner=owner, hash=readme_hash)
@@ -955,7 +1527,7 @@ def package_preview(owner, package_name, package_hash):
         )
         readme_preview = readme_blob.preview if readme_blob is not None else None
     else:
-        readme_url = None
+        readme_hash = None
         readme_preview = None
 
     contents_preview = _generate_preview(instance.contents)
@@ -970,17 +1542,56 @@ def package_preview(owner, package_name, package_hash):
         ))
     ).one()[0])
 
-    # Insert an event.
-    event = Event(
-        type=Event.Type.PREVIEW,
+    return contents_preview, total_size, readme_hash, readme_preview
+
+@app.route('/api/package_preview/<owner>/<package_name>/<package_hash>', methods=['GET'])
+@api(require_login=False)
+@as_json
+def package_preview(owner, package_name, package_hash):
+    result = (
+        db.session.query(
+            Instance,
+            sa.func.bool_or(Access.user == PUBLIC).label('is_public'),
+            sa.func.bool_or(Access.user == TEAM).label('is_team'),
+            S3Blob.hash,
+            S3Blob.preview
+        )
+        .filter_by(hash=package_hash)
+        .options(undefer('preview'))
+        .join(Instance.package)
+        .filter_by(owner=owner, name=package_name)
+        .join(Package.access)
+        .filter(_access_filter(g.auth))
+        .outerjoin(S3Blob, Instance.readme_blob_id == S3Blob.id)
+        .group_by(Package.id, Instance.id, S3Blob.id)
+        .one_or_none()
+    )
+
+    if result is None:
+        raise ApiException(
+            requests.codes.not_found,
+            "Package hash does not exist"
+        )
+
+    (instance, is_public, is_team, readme_hash, readme_preview) = result
+
+    if instance.preview is not None:
+        # Saved at push time.
+        contents_preview = instance.preview
+        total_size = instance.total_size
+    else:
+        # Pushed before the summary existed, and not backfilled yet.
+        contents_preview, total_size, readme_hash, readme_preview = _generate_summary(owner, instance)
+
+    readme_url = _generate_presigned_url(S3_GET_OBJECT, owner, readme_hash) if readme_hash else None
+
+    record_event(
+        Event.Type.PREVIEW,
         user=g.auth.user,
         package_owner=owner,
         package_name=package_name,
         package_hash=package_hash,
     )
-    db.session.add(event)
-
-    db.session.commit()
 
     _mp_track(
         type="preview",
@@ -1001,18 +1612,63 @@ def package_preview(owner, package_name, package_hash):
         total_size_uncompressed=total_size,
     )
 
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, binascii.Error):
+        values = None
+    if not isinstance(values, list):
+        raise ApiException(requests.codes.bad_request, "Invalid cursor")
+    return values
+
+def _get_page_args():
+    """
+    Returns the page size and the decoded cursor from the request.
+    Both are optional; without a limit, lists return all of their items.
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        raise ApiException(requests.codes.bad_request, "Invalid limit")
+    cursor = request.args.get('cursor')
+    return limit, _decode_cursor(cursor) if cursor is not None else None
+
+def _paginate(query, columns, row_key):
+    """
+    Sorts the query by `columns`, and returns the requested page of results, and the cursor
+    for the next one (or None). Uses keyset pagination: the cursor holds the sort key of the last
+    row, which `row_key` returns as a list of JSON values.
+    """
+    limit, cursor = _get_page_args()
+    query = query.order_by(*columns)
+    if cursor is not None:
+        if len(cursor) != len(columns):
+            raise ApiException(requests.codes.bad_request, "Invalid cursor")
+        query = query.filter(sa.tuple_(*columns) > tuple(cursor))
+    if limit is None:
+        return query.all(), None
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], _encode_cursor(row_key(rows[limit - 1]))
+    return rows, None
+
 @app.route('/api/package/<owner>/<package_name>/', methods=['GET'])
 @api(require_login=False)
 @as_json
 def package_list(owner, package_name):
     package = _get_package(g.auth, owner, package_name)
-    instances = (
-        Instance.query
-        .filter_by(package=package)
+    instances, next_cursor = _paginate(
+        Instance.query.filter_by(package=package),
+        [Instance.id],
+        lambda instance: [instance.id]
     )
 
     return dict(
-        hashes=[instance.hash for instance in instances]
+        hashes=[instance.hash for instance in instances],
+        next_cursor=next_cursor
     )
 
 @app.route('/api/package/<owner>/<package_name>/', methods=['DELETE'])
@@ -1027,16 +1683,14 @@ def package_delete(owner, package_name):
 
     db.session.delete(package)
 
-    # Insert an event.
-    event = Event(
+    db.session.commit()
+
+    record_event(
+        Event.Type.DELETE,
         user=g.auth.user,
-        type=Event.Type.DELETE,
         package_owner=owner,
         package_name=package_name,
     )
-    db.session.add(event)
-
-    db.session.commit()
 
     return dict()
 
@@ -1103,12 +1757,13 @@ def list_user_packages(owner):
 def logs_list(owner, package_name):
     package = _get_package(g.auth, owner, package_name)
 
-    logs = (
+    logs, next_cursor = _paginate(
         db.session.query(Log, Instance)
         .filter_by(package=package)
-        .join(Log.instance)
+        .join(Log.instance),
         # Sort chronologically, but rely on IDs in case of duplicate created times.
-        .order_by(Log.created, Log.id)
+        [Log.created, Log.id],
+        lambda row: [row.Log.created.isoformat(), row.Log.id]
     )
 
     return dict(
@@ -1116,7 +1771,39 @@ def logs_list(owner, package_name):
             hash=instance.hash,
             created=log.created.timestamp(),
             author=log.author
-        ) for log, instance in logs]
+        ) for log, instance in logs],
+        next_cursor=next_cursor
+    )
+
+@app.route('/api/hash/<owner>/<package_name>/<hash_prefix>', methods=['GET'])
+@api(require_login=False)
+@as_json
+def hash_match(owner, package_name, hash_prefix):
+    """
+    Returns the hashes of the package's instances that start with `hash_prefix`,
+    so clients can resolve short hashes without downloading the whole log.
+    """
+    hash_prefix = hash_prefix.lower()
+    if not HASH_PREFIX_RE.fullmatch(hash_prefix):
+        raise ApiException(requests.codes.bad_request, "Invalid hash prefix")
+
+    package = _get_package(g.auth, owner, package_name)
+
+    # Uses the idx_instance_hash_prefix index.
+    hashes = [
+        instance_hash for instance_hash, in (
+            db.session.query(Instance.hash)
+            .filter(sa.and_(
+                Instance.package_id == package.id,
+                Instance.hash.like(hash_prefix + '%')
+            ))
+            .order_by(Instance.hash)
+            .limit(MAX_HASH_MATCHES)
+        )
+    ]
+
+    return dict(
+        hashes=hashes
     )
 
 VERSION_SCHEMA = {
@@ -1228,7 +1915,19 @@ def version_list(owner, package_name):
         .all()
     )
 
+    # Versions have to be sorted in Python, so paginate them here.
     sorted_versions = sorted(versions, key=lambda row: row.Version.sort_key())
+    limit, cursor = _get_page_args()
+    if cursor is not None:
+        if len(cursor) != 1 or not isinstance(cursor[0], str):
+            raise ApiException(requests.codes.bad_request, "Invalid cursor")
+        last_version = PackagingVersion(normalize_version(cursor[0]))
+        sorted_versions = [row for row in sorted_versions if row.Version.sort_key() > last_version]
+
+    next_cursor = None
+    if limit is not None and len(sorted_versions) > limit:
+        sorted_versions = sorted_versions[:limit]
+        next_cursor = _encode_cursor([sorted_versions[-1].Version.version])
 
     return dict(
         versions=[
@@ -1236,7 +1935,8 @@ def version_list(owner, package_name):
                 version=version.user_version,
                 hash=instance.hash
             ) for version, instance in sorted_versions
-        ]
+        ],
+        next_cursor=next_cursor
     )
 
 TAG_SCHEMA = {
@@ -1291,6 +1991,9 @@ def tag_put(owner, package_name, package_tag):
     else:
         tag.instance = instance
 
+    if package_tag == LATEST_TAG:
+        _update_search(instance.package, instance)
+
     db.session.commit()
 
     return dict()
@@ -1361,6 +2064,10 @@ def tag_delete(owner, package_name, package_tag):
         )
 
     db.session.delete(tag)
+
+    if package_tag == LATEST_TAG:
+        _update_search(tag.package, None)
+
     db.session.commit()
 
     return dict()
@@ -1371,12 +2078,12 @@ def tag_delete(owner, package_name, package_tag):
 def tag_list(owner, package_name):
     package = _get_package(g.auth, owner, package_name)
 
-    tags = (
+    tags, next_cursor = _paginate(
         db.session.query(Tag, Instance)
         .filter_by(package=package)
-        .order_by(Tag.tag)
-        .join(Tag.instance)
-        .all()
+        .join(Tag.instance),
+        [Tag.tag],
+        lambda row: [row.Tag.tag]
     )
 
     return dict(
@@ -1385,7 +2092,8 @@ def tag_list(owner, package_name):
                 tag=tag.tag,
                 hash=instance.hash
             ) for tag, instance in tags
-        ]
+        ],
+        next_cursor=next_cursor
     )
 
 @app.route('/api/access/<owner>/<package_name>/<user>', methods=['PUT'])
@@ -1591,11 +2299,56 @@ def recent_packages():
         ]
     )
 
+def _search_tsv(owner, name, readme_tsv):
+    """
+    Returns the SQL expression for the search vector of a package.
+    README previews are downloaded after the push, so `readme_tsv` may be NULL.
+    """
+    return reduce(sa.sql.operators.custom_op('||'), [
+        # Give higher weight to owner and name than to README.
+        sa.func.setweight(sa.func.to_tsvector(FTS_LANGUAGE, owner), 'A'),
+        sa.func.setweight(sa.func.to_tsvector(FTS_LANGUAGE, name), 'A'),
+        sa.func.coalesce(readme_tsv, '')
+    ])
+
+def _update_search(package, instance):
+    """
+    Updates the search document of a package to use its new "latest" instance,
+    or deletes it if `instance` is None.
+    """
+    if instance is None:
+        if package.search is not None:
+            db.session.delete(package.search)
+        return
+
+    def _readme_column(column):
+        return (
+            sa.select([column])
+            .where(S3Blob.id == Instance.readme_blob_id)
+            .where(Instance.id == instance.id)
+            .as_scalar()
+        )
+
+    search = package.search
+    if search is None:
+        search = PackageSearch(package=package)
+        db.session.add(search)
+
+    search.instance = instance
+    search.owner_name = ('%s/%s' % (package.owner, package.name)).lower()
+    search.tsv = _search_tsv(package.owner, package.name, _readme_column(S3Blob.preview_tsv))
+    search.readme = _readme_column(sa.func.substr(S3Blob.preview, 1, README_SNIPPET_LEN))
+
 @app.route('/api/search/', methods=['GET'])
 @api(require_login=False)
 @as_json
 def search():
     query = request.args.get('q', '')
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    if not 0 < limit <= MAX_SEARCH_PAGE_SIZE or offset < 0:
+        raise ApiException(requests.codes.bad_request, "Invalid limit or offset")
 
     keywords = query.split()
 
@@ -1603,87 +2356,38 @@ def search():
         # Let's not overload the DB with crazy queries.
         raise ApiException(requests.codes.bad_request, "Too many search terms (max is 10)")
 
-    # Get the list of visible packages and their permissions.
+    tsquery = sa.func.plainto_tsquery(FTS_LANGUAGE, query)
+
+    # Basic substring matching for package owner and name; uses the trigram index.
+    basic_filter_list = [
+        PackageSearch.owner_name.like(
+            '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', keyword.lower()),
+            escape='\\'
+        )
+        for keyword in keywords
+    ]
 
-    instances = (
+    results = (
         db.session.query(
-            Instance.id,
             Package.owner,
             Package.name,
             sa.func.bool_or(Access.user == PUBLIC).label('is_public'),
             sa.func.bool_or(Access.user == TEAM).label('is_team'),
-            sa.func.plainto_tsquery(FTS_LANGUAGE, query).label('query')  # Just save the query as a variable
+            PackageSearch.readme,
+            sa.func.ts_rank_cd(PackageSearch.tsv, tsquery, RANK_NORMALIZATION).label('rank')
         )
-        .join(Instance.package)
+        .join(Package.search)
         .join(Package.access)
         .filter(_access_filter(g.auth))
-        .join(Instance.tags)
-        .filter(Tag.tag == LATEST_TAG)
-        .group_by(Package.id, Instance.id)  # Redundant, but we need Instance.id and Package.*
-        .subquery('i')
-    )
-
-    # Get the README contents and full-text search index.
-
-    README_SNIPPET_LEN = 1024
-    readmes = (
-        db.session.query(
-            Instance.id,
-            S3Blob.preview_tsv,
-            sa.func.substr(S3Blob.preview, 1, README_SNIPPET_LEN).label('readme'),
-        )
-        .join(Instance.readme_blob)
-        .subquery('r')
-    )
-
-    # Filter and sort the results.
-
-    def _tsvector_concat(*args):
-        return reduce(sa.sql.operators.custom_op('||'), args)
-
-    # Use the "rank / (rank + 1)" normalization; makes it look sort of like percentage.
-    RANK_NORMALIZATION = 32
-
-    # Basic substring matching for package owner and name.
-    basic_filter_list = [
-        sa.func.strpos(
-            sa.func.lower(sa.func.concat(instances.c.owner, '/', instances.c.name)),
-            sa.func.lower(keyword)
-        ) > 0
-        for keyword in keywords
-    ]
-
-    results = (
-        db.session.query(
-            instances.c.owner,
-            instances.c.name,
-            instances.c.is_public,
-            instances.c.is_team,
-            readmes.c.readme,
-            sa.func.ts_rank_cd(
-                _tsvector_concat(
-                    # Give higher weight to owner and name than to README.
-                    sa.func.setweight(sa.func.to_tsvector(FTS_LANGUAGE, instances.c.owner), 'A'),
-                    sa.func.setweight(sa.func.to_tsvector(FTS_LANGUAGE, instances.c.name), 'A'),
-                    sa.func.coalesce(readmes.c.preview_tsv, '')
-                ),
-                instances.c.query,
-                RANK_NORMALIZATION
-            ).label('rank')
-        )
-        .outerjoin(readmes, instances.c.id == readmes.c.id)
         .filter(sa.or_(
-            # Need to use the original preview_tsv (not concatenated with anything) to take advantage of the index.
-            readmes.c.preview_tsv.op('@@')(instances.c.query),
-            # Match the owner and name; full table scan, but it's just Package.
-            _tsvector_concat(
-                sa.func.to_tsvector(FTS_LANGUAGE, instances.c.owner),
-                sa.func.to_tsvector(FTS_LANGUAGE, instances.c.name)
-            ).op('@@')(instances.c.query),
-            # Substring matching.
+            PackageSearch.tsv.op('@@')(tsquery),
             sa.and_(*basic_filter_list)
         ) if query else True)  # Disable the filter if there was no query string.
-        .order_by(sa.desc('rank'), instances.c.owner, instances.c.name)
+        .group_by(Package.id, PackageSearch.package_id)
+        .order_by(sa.desc('rank'), Package.owner, Package.name)
+        .offset(offset)
+        .limit(limit + 1)
+        .all()
     )
 
     return dict(
@@ -1695,8 +2399,9 @@ def search():
                 is_team=is_team,
                 readme_preview=readme,
                 rank=rank,
-            ) for owner, name, is_public, is_team, readme, rank in results
-        ]
+            ) for owner, name, is_public, is_team, readme, rank in results[:limit]
+        ],
+        next_offset=offset + limit if len(results) > limit else None
     )
 
 @app.route('/api/profile', methods=['GET'])
@@ -1938,10 +2643,7 @@ def list_users_detailed():
         )
     package_counts = dict(package_counts_query)
 
-    events = (
-        db.session.query(Event.user, Event.type, sa.func.count(Event.type))
-        .group_by(Event.user, Event.type)
-        )
+    events = db.session.query(UserEventCount.user, UserEventCount.type, UserEventCount.count)
 
     event_results = defaultdict(int)
     for event_user, event_type, event_count in events:
@@ -2139,9 +2841,10 @@ def delete_user():
 @api(require_admin=True)
 @as_json
 def audit_package(owner, package_name):
-    events = (
-        Event.query
-        .filter_by(package_owner=owner, package_name=package_name)
+    events, next_cursor = _paginate(
+        Event.query.filter_by(package_owner=owner, package_name=package_name),
+        [Event.created, Event.id],
+        lambda event: [event.created.isoformat(), event.id]
     )
 
     return dict(
@@ -2153,16 +2856,18 @@ def audit_package(owner, package_name):
             package_name=event.package_name,
             package_hash=event.package_hash,
             extra=event.extra,
-        ) for event in events]
+        ) for event in events],
+        next_cursor=next_cursor
     )
 
 @app.route('/api/audit/<user>/')
 @api(require_admin=True)
 @as_json
 def audit_user(user):
-    events = (
-        Event.query
-        .filter_by(user=user)
+    events, next_cursor = _paginate(
+        Event.query.filter_by(user=user),
+        [Event.created, Event.id],
+        lambda event: [event.created.isoformat(), event.id]
     )
 
     return dict(
@@ -2174,18 +2879,21 @@ def audit_user(user):
             package_name=event.package_name,
             package_hash=event.package_hash,
             extra=event.extra,
-        ) for event in events]
+        ) for event in events],
+        next_cursor=next_cursor
     )
 
 @app.route('/api/admin/package_summary')
 @api(require_admin=True)
 @as_json
 def package_summary():
-    events = (
-        db.session.query(Event.package_owner, Event.package_name, Event.type, 
-                         sa.func.count(Event.type), sa.func.max(Event.created))
-        .group_by(Event.package_owner, Event.package_name, Event.type)
-        )
+    events = db.session.query(
+        PackageEventCount.package_owner,
+        PackageEventCount.package_name,
+        PackageEventCount.type,
+        PackageEventCount.count,
+        PackageEventCount.latest
+    )
 
     event_results = defaultdict(lambda: {'count':0})
     packages = set()
@@ -2205,6 +2913,15 @@ def package_summary():
 
     return {'packages' : results}
 
+@app.route('/api/admin/auth_cache_stats')
+@api(require_admin=True)
+@as_json
+def auth_cache_stats():
+    """
+    Hit rate of this process's auth token cache.
+    """
+    return token_cache.stats()
+
 @app.route('/api/users/reset_password', methods=['POST'])
 @api(enabled=ENABLE_USER_ENDPOINTS, require_admin=True, schema=USERNAME_SCHEMA)
 @as_json
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+Backfills the instance.preview and instance.total_size columns.
+"""
+
+import sys
+
+from sqlalchemy.orm import undefer
+
+from quilt_server import db
+from quilt_server.models import Instance
+from quilt_server.views import _generate_preview
+
+BATCH_SIZE = 100
+
+def main(argv):
+    result = db.engine.execute('''
+        UPDATE instance SET total_size = (
+            SELECT coalesce(sum(s3_blob.size), 0)
+            FROM instance_blob JOIN s3_blob ON instance_blob.blob_id = s3_blob.id
+            WHERE instance_blob.instance_id = instance.id
+        )
+        WHERE total_size IS NULL
+    ''')
+    print("Updated sizes of %d instances." % result.rowcount)
+
+    count = 0
+    while True:
+        instances = (
+            Instance.query
+            .filter(Instance.preview.is_(None))
+            .options(undefer('contents'))
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not instances:
+            break
+        for instance in instances:
+            instance.preview = _generate_preview(instance.contents)
+        db.session.commit()
+        count += len(instances)
+
+    print("Updated previews of %d instances." % count)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
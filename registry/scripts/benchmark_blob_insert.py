@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Measures how fast package_put adds blobs to a new instance: one ORM object per row,
+vs. the bulk inserts. Needs a local Postgres; everything is rolled back at the end.
+
+Usage: benchmark_blob_insert.py [number of blobs]
+"""
+
+import hashlib
+import sys
+import time
+
+from quilt_server import db
+from quilt_server.core import RootNode
+from quilt_server.models import Instance, Package, S3Blob
+from quilt_server.views import _add_instance_blobs
+
+OWNER = 'benchmark'
+
+def _orm(instance, hashes, sizes):
+    blobs = (
+        S3Blob.query
+        .with_for_update()
+        .filter(S3Blob.owner == OWNER, S3Blob.hash.in_(hashes))
+        .all()
+    )
+    blob_by_hash = {blob.hash: blob for blob in blobs}
+    for blob_hash in hashes:
+        blob = blob_by_hash.get(blob_hash)
+        if blob is None:
+            blob = S3Blob(owner=OWNER, hash=blob_hash, size=sizes[blob_hash])
+        instance.blobs.append(blob)
+    db.session.flush()
+
+def _bulk(instance, hashes, sizes):
+    _add_instance_blobs(instance, OWNER, hashes, sizes)
+
+def _run(name, func, count):
+    hashes = [hashlib.sha256(('%s%d' % (name, i)).encode()).hexdigest() for i in range(count)]
+    sizes = {blob_hash: idx for idx, blob_hash in enumerate(hashes)}
+    package = Package(owner=OWNER, name=name)
+    db.session.add(package)
+
+    # First push creates the blobs; the second one only links the existing ones.
+    for push in ("new", "existing"):
+        instance = Instance(
+            package=package,
+            contents=RootNode(dict()),
+            hash=hashlib.sha256(push.encode()).hexdigest(),
+            created_by=OWNER,
+            updated_by=OWNER
+        )
+        db.session.add(instance)
+        db.session.flush()
+
+        start = time.time()
+        func(instance, hashes, sizes)
+        elapsed = time.time() - start
+        print("%-6s %-10s %8d blobs in %6.2fs: %10.0f blobs/s" % (name, push, count, elapsed, count / elapsed))
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+
+    try:
+        _run("orm", _orm, count)
+        _run("bulk", _bulk, count)
+    finally:
+        db.session.rollback()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Compares parsing a large synthetic package_put body the old way (jsonschema validation,
+a second parse to build the nodes, and separate tree walks) and with PackageDecoder.
+
+Usage: benchmark_package_put.py [number of files]
+"""
+
+import hashlib
+import json
+import sys
+import time
+
+from jsonschema import Draft4Validator
+
+from quilt_server.core import decode_node, find_object_hashes, hash_contents
+from quilt_server.schemas import PACKAGE_SCHEMA, PackageDecoder
+
+def _make_body(count):
+    groups = {}
+    for i in range(count):
+        group = groups.setdefault('group%d' % (i // 1000), dict(type='GROUP', children={}))
+        group['children']['file%d' % i] = dict(
+            type='FILE',
+            hashes=[hashlib.sha256(str(i).encode()).hexdigest()],
+            metadata=dict(q_path='data/file%d.csv' % i)
+        )
+    return json.dumps(dict(
+        description="",
+        contents=dict(type='ROOT', children=groups)
+    ))
+
+def _old(data):
+    Draft4Validator(PACKAGE_SCHEMA).validate(json.loads(data))
+    body = json.loads(data, object_hook=decode_node)
+    hash_contents(body['contents'])
+    return set(find_object_hashes(body['contents']))
+
+def _new(data):
+    decoder = PackageDecoder()
+    body = decoder.decode(data)
+    hash_contents(body['contents'])
+    return decoder.object_hashes
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    data = _make_body(count)
+    print("Body: %d files, %.1f MB" % (count, len(data) / 1024 / 1024))
+
+    results = []
+    for name, func in [("old", _old), ("single parse", _new)]:
+        start = time.time()
+        results.append(func(data))
+        print("%-15s %6.2fs" % (name, time.time() - start))
+
+    assert results[0] == results[1]
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
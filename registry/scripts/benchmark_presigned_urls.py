@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""
+Measures how fast the registry signs S3 URLs, with and without the URL cache.
+
+Usage: benchmark_presigned_urls.py [number of hashes]
+"""
+
+import hashlib
+import sys
+import time
+
+from quilt_server.views import (_generate_presigned_urls, presigned_url_cache,
+                                S3_GET_OBJECT, S3_HEAD_OBJECT, S3_PUT_OBJECT)
+
+def _run(name, method, hashes):
+    start = time.time()
+    _generate_presigned_urls(method, 'benchmark', hashes)
+    elapsed = time.time() - start
+    print("%-20s %8d URLs in %6.2fs: %10.0f URLs/s" % (name, len(hashes), elapsed, len(hashes) / elapsed))
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    hashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(count)]
+
+    presigned_url_cache.clear()
+
+    # Install: one GET URL per hash.
+    _run("get (cold)", S3_GET_OBJECT, hashes)
+    _run("get (cached)", S3_GET_OBJECT, hashes)
+
+    # Push dry run: HEAD and PUT URLs per hash.
+    _run("head (cold)", S3_HEAD_OBJECT, hashes)
+    _run("put (cold)", S3_PUT_OBJECT, hashes)
+    _run("head (cached)", S3_HEAD_OBJECT, hashes)
+    _run("put (cached)", S3_PUT_OBJECT, hashes)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
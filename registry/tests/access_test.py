@@ -10,11 +10,13 @@ import time
 from unittest.mock import patch
 import urllib
 
+from botocore.exceptions import ClientError
 import pytest
 import requests
 
 from quilt_server.const import PaymentPlan, PUBLIC, TEAM
 from quilt_server.core import encode_node, hash_contents, GroupNode, RootNode, FileNode
+from quilt_server.views import _readme_preview_task
 
 from .utils import mock_customer, QuiltTestCase
 
@@ -819,6 +821,52 @@ class AccessTestCase(QuiltTestCase):
         assert packages[0]['is_team'] is False
         assert packages[0]['readme_preview'] == readme_contents[0:1024]
 
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testSearchReadmeTask(self):
+        readme_contents = 'Penguins of Antarctica'
+        blob_hash = hashlib.sha256(readme_contents.encode()).hexdigest()
+        contents = RootNode(dict(
+            README=FileNode([blob_hash], dict())
+        ))
+
+        # Hold on to the README task until the package is tagged.
+        with patch('quilt_server.views._readme_preview_task.spool') as spool:
+            self.put_package(self.user, 'pkg', contents, is_public=True, tag_latest=True)
+        spool.assert_called_once_with(owner=self.user, blob_hash=blob_hash)
+
+        def _search(query):
+            resp = self.app.get('/api/search/?q=%s' % query)
+            assert resp.status_code == requests.codes.ok
+            return json.loads(resp.data.decode('utf8'))['packages']
+
+        # The package can be found before the preview is ready, just not by its README.
+        packages = _search('pkg')
+        assert len(packages) == 1
+        assert packages[0]['readme_preview'] is None
+        assert _search('penguin') == []
+
+        self._mock_object(self.user, blob_hash, readme_contents.encode())
+        _readme_preview_task.func(spool.call_args[1])
+
+        packages = _search('penguin')
+        assert len(packages) == 1
+        assert packages[0]['readme_preview'] == readme_contents
+
+    def testReadmeTaskErrors(self):
+        blob_hash = hash_contents(RootNode(dict()))  # Any hash will do.
+        args = dict(owner=self.user, blob_hash=blob_hash)
+
+        # The README is missing: nothing to retry.
+        self.s3_stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+        _readme_preview_task.func(args)
+
+        # S3 is having problems: the spooler should try again later.
+        self.s3_stubber.add_client_error('get_object', service_error_code='SlowDown', http_status_code=503)
+        with self.assertRaises(ClientError):
+            _readme_preview_task.func(args)
+
+        self.s3_stubber.assert_no_pending_responses()
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testFullTextSearch(self):
         packages = {
@@ -872,3 +920,68 @@ class AccessTestCase(QuiltTestCase):
         # Package name takes precedence over README
         _test_query("clinton", {}, ["test_user/clinton_email", "test_user/nothing"])
         _test_query("wine", {}, ["test_user/wine", "test_user/nothing"])
+
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testSearchPages(self):
+        for i in range(5):
+            self.put_package(self.user, 'pkg%d' % i, RootNode(children=dict()), is_public=True, tag_latest=True)
+
+        names = []
+        offset = 0
+        while offset is not None:
+            resp = self.app.get('/api/search/?%s' % urllib.parse.urlencode(dict(q='pkg', limit=2, offset=offset)))
+            assert resp.status_code == requests.codes.ok
+            data = json.loads(resp.data.decode('utf8'))
+            assert len(data['packages']) <= 2
+            names += [pkg['name'] for pkg in data['packages']]
+            offset = data['next_offset']
+
+        assert names == ['pkg0', 'pkg1', 'pkg2', 'pkg3', 'pkg4']
+
+        resp = self.app.get('/api/search/?limit=0')
+        assert resp.status_code == requests.codes.bad_request
+
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testSearchLatestTag(self):
+        self.put_package(self.user, 'pkg', RootNode(children=dict()), is_public=True)
+
+        def _search():
+            resp = self.app.get('/api/search/?q=pkg')
+            assert resp.status_code == requests.codes.ok
+            data = json.loads(resp.data.decode('utf8'))
+            return ['%(owner)s/%(name)s' % pkg for pkg in data['packages']]
+
+        # Only packages with a "latest" tag can be found.
+        assert _search() == []
+
+        resp = self.app.put(
+            '/api/tag/%s/pkg/latest' % self.user,
+            data=json.dumps(dict(hash=hash_contents(RootNode(children=dict())))),
+            content_type='application/json',
+            headers={
+                'Authorization': self.user
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert _search() == ['test_user/pkg']
+
+        resp = self.app.delete(
+            '/api/tag/%s/pkg/latest' % self.user,
+            headers={
+                'Authorization': self.user
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert _search() == []
+
+        # Deleting the package deletes its search document.
+        self.put_package(self.user, 'pkg', RootNode(children=dict()), is_public=True, tag_latest=True)
+        assert _search() == ['test_user/pkg']
+        resp = self.app.delete(
+            '/api/package/%s/pkg/' % self.user,
+            headers={
+                'Authorization': self.user
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert _search() == []
@@ -94,6 +94,27 @@ class AdminTestCase(QuiltTestCase):
         data = json.loads(resp.data.decode('utf8')).get('events')
         assert len(data) == 4
 
+    def testAuditUserPages(self):
+        events = []
+        url = '/api/audit/{usr}/?limit=2'.format(usr=self.user)
+        while True:
+            resp = self.app.get(
+                url,
+                headers={
+                    'Authorization': self.admin
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            data = json.loads(resp.data.decode('utf8'))
+            assert len(data['events']) <= 2
+            events += data['events']
+            if data['next_cursor'] is None:
+                break
+            url = '/api/audit/{usr}/?limit=2&cursor={cursor}'.format(usr=self.user, cursor=data['next_cursor'])
+
+        assert len(events) == 3
+        assert [event['created'] for event in events] == sorted(event['created'] for event in events)
+
     def testAuditPackage(self):
         resp = self.app.get(
             '/api/audit/{usr}/{pkg}/'.format(
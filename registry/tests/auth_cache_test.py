@@ -0,0 +1,135 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Auth token cache tests
+"""
+
+import json
+from unittest.mock import patch
+
+import requests
+import responses
+
+from quilt_server import app
+from quilt_server.auth_cache import INVALID, TokenCache
+from quilt_server.cache import LocalCache
+from .utils import QuiltTestCase
+
+
+class AuthCacheTestCase(QuiltTestCase):
+    """
+    Test caching of auth token validation.
+    """
+    def _auth_calls(self):
+        user_url = app.config['OAUTH']['user_api']
+        return [call for call in self.requests_mock.calls if call.request.url == user_url]
+
+    def testCachedToken(self):
+        for _ in range(3):
+            resp = self.app.get(
+                '/api/package/test_user/',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+
+        # Only the first request goes to the auth service.
+        assert len(self._auth_calls()) == 1
+
+        # Different tokens are cached separately.
+        resp = self.app.get(
+            '/api/package/test_user/',
+            headers={
+                'Authorization': 'share_with'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert len(self._auth_calls()) == 2
+
+        resp = self.app.get(
+            '/api/admin/auth_cache_stats',
+            headers={
+                'Authorization': 'admin'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        stats = json.loads(resp.data.decode('utf8'))
+        assert stats['local_hits'] == 2
+        assert stats['misses'] == 3
+
+    def testInvalidToken(self):
+        # Make the auth service reject everything.
+        self.requests_mock.reset()
+        self.requests_mock.add(responses.GET, app.config['OAUTH']['user_api'], status=401)
+
+        for _ in range(2):
+            resp = self.app.get(
+                '/api/package/test_user/',
+                headers={
+                    'Authorization': 'bad_token'
+                }
+            )
+            assert resp.status_code == requests.codes.unauthorized
+
+        # The rejection got cached.
+        assert len(self._auth_calls()) == 1
+
+    def testServerErrorNotCached(self):
+        self.requests_mock.reset()
+        self.requests_mock.add(responses.GET, app.config['OAUTH']['user_api'], status=500)
+
+        for _ in range(2):
+            resp = self.app.get(
+                '/api/package/test_user/',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.server_error
+
+        assert len(self._auth_calls()) == 2
+
+    def testExpiration(self):
+        cache = TokenCache(ttl=60, negative_ttl=10, max_size=10)
+        user_info = dict(user='test_user', email='test_user@example.com', is_admin=False)
+
+        with patch('time.time', return_value=1000):
+            cache.set('token', user_info)
+            cache.set('bad_token', INVALID)
+
+        with patch('time.time', return_value=1009):
+            assert cache.get('token') == user_info
+            assert cache.get('bad_token') == INVALID
+
+        with patch('time.time', return_value=1011):
+            assert cache.get('token') == user_info
+            assert cache.get('bad_token') is None
+
+        with patch('time.time', return_value=1061):
+            assert cache.get('token') is None
+
+    def testLRU(self):
+        cache = TokenCache(ttl=60, negative_ttl=10, max_size=2)
+        for token in ['a', 'b', 'c']:
+            cache.set(token, dict(user=token))
+            cache.get('a')  # Keep 'a' fresh.
+
+        assert cache.get('a') == dict(user='a')
+        assert cache.get('b') is None
+        assert cache.get('c') == dict(user='c')
+
+    def testSharedBackend(self):
+        shared = LocalCache(max_size=10)  # Stands in for Redis.
+        cache1 = TokenCache(ttl=60, negative_ttl=10, max_size=10, shared=shared)
+        cache2 = TokenCache(ttl=60, negative_ttl=10, max_size=10, shared=shared)
+
+        cache1.set('token', dict(user='test_user'))
+        assert cache2.get('token') == dict(user='test_user')
+        assert cache2.get('token') == dict(user='test_user')
+
+        stats = cache2.stats()
+        assert stats['shared_hits'] == 1
+        assert stats['local_hits'] == 1
+        assert stats['misses'] == 0
+        assert stats['hit_rate'] == 1.0
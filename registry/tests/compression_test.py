@@ -0,0 +1,111 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Response compression tests
+"""
+
+import gzip
+import json
+from unittest.mock import patch
+
+import requests
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+
+from quilt_server import app
+from quilt_server.core import RootNode, FileNode
+from quilt_server.middleware import ResponseCompressionMiddleware
+from .utils import QuiltTestCase
+
+
+def _client(response):
+    return Client(ResponseCompressionMiddleware(response, min_size=100), BaseResponse)
+
+
+class CompressionTestCase(QuiltTestCase):
+    """
+    Test that responses get compressed according to Accept-Encoding.
+    """
+    CONTENTS = RootNode(dict(
+        file=FileNode(
+            hashes=['d146942c9a051553f77d1e00672f2829565c590be972a1330de726a8db223589']
+        )
+    ))
+
+    def testCompressedApi(self):
+        for i in range(10):
+            self.put_package('test_user', 'package%d' % i, self.CONTENTS)
+
+        with patch.object(app.wsgi_app, 'min_size', 0):
+            resp = self.app.get(
+                '/api/package/test_user/',
+                headers={
+                    'Authorization': 'test_user',
+                    'Accept-Encoding': 'gzip, deflate'
+                }
+            )
+        assert resp.status_code == requests.codes.ok
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in resp.headers.get_all('Vary')
+        assert int(resp.headers['Content-Length']) == len(resp.data)
+
+        data = json.loads(gzip.decompress(resp.data).decode('utf8'))
+        assert len(data['packages']) == 10
+
+    def testSmallResponse(self):
+        client = _client(Response('{}', content_type='application/json'))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.data == b'{}'
+
+    def testStreamingResponse(self):
+        chunks = ['[%d,' % i * 100 for i in range(10)]
+        client = _client(Response(iter(chunks), content_type='application/json'))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in resp.headers
+        assert gzip.decompress(resp.data) == ''.join(chunks).encode()
+
+    def testWriteCallable(self):
+        def _legacy_app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'application/json')])
+            write(b'[' + b'1,' * 100)
+            return [b'2]']
+
+        client = _client(_legacy_app)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(resp.data) == b'[' + b'1,' * 100 + b'2]'
+
+    def testLazyStartResponse(self):
+        def _lazy_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            yield b'[' + b'1,' * 100
+            yield b'2]'
+
+        client = _client(_lazy_app)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(resp.data) == b'[' + b'1,' * 100 + b'2]'
+
+    def testNotCompressed(self):
+        body = 'x' * 1000
+
+        # Client doesn't accept any supported encodings.
+        client = _client(Response(body, content_type='text/plain'))
+        for accept_encoding in [None, 'identity', 'compress', 'gzip;q=0']:
+            headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+            resp = client.get('/', headers=headers)
+            assert 'Content-Encoding' not in resp.headers
+            assert resp.data == body.encode()
+
+        # Not a compressible type.
+        client = _client(Response(body, content_type='image/png'))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in resp.headers
+
+        # Already compressed.
+        client = _client(Response(body, content_type='text/plain', headers={'Content-Encoding': 'br'}))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'br'
+        assert resp.data == body.encode()
@@ -0,0 +1,107 @@
+# Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
+
+"""
+Event recording tests
+"""
+
+from unittest.mock import patch
+
+import requests
+
+from quilt_server.core import hash_contents, FileNode, RootNode
+from quilt_server.events import _flush_timer, flush_events
+from quilt_server.models import Event, PackageEventCount, UserEventCount
+from .utils import QuiltTestCase
+
+
+class EventsTestCase(QuiltTestCase):
+    """
+    Test that events get written in batches.
+    """
+    CONTENTS = RootNode(dict(
+        file=FileNode(
+            hashes=['d146942c9a051553f77d1e00672f2829565c590be972a1330de726a8db223589']
+        )
+    ))
+
+    def _install(self):
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s' % hash_contents(self.CONTENTS),
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+    def testEventsWritten(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+        self._install()
+
+        events = Event.query.order_by(Event.id).all()
+        assert [event.type for event in events] == [Event.Type.PUSH, Event.Type.INSTALL]
+        assert events[1].user == 'test_user'
+        assert events[1].package_owner == 'test_user'
+        assert events[1].package_name == 'foo'
+        assert events[1].package_hash == hash_contents(self.CONTENTS)
+        assert events[1].created >= events[0].created
+
+    @patch('quilt_server.events.EVENT_BATCH_SIZE', 3)
+    @patch('quilt_server.events.EVENT_FLUSH_INTERVAL', 3600)
+    def testBatches(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+        self._install()
+        assert Event.query.count() == 0
+
+        # The third event fills the batch.
+        self._install()
+        assert Event.query.count() == 3
+
+        self._install()
+        assert Event.query.count() == 3
+
+        flush_events()
+        assert Event.query.count() == 4
+
+    @patch('quilt_server.events.EVENT_BATCH_SIZE', 10)
+    @patch('quilt_server.events.EVENT_FLUSH_INTERVAL', 3600)
+    def testFlushTimer(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+        self._install()
+        assert Event.query.count() == 0
+
+        # No more requests come in, but the timer writes the events anyway.
+        _flush_timer(0)
+        assert Event.query.count() == 2
+
+        # Nothing to write.
+        _flush_timer(0)
+        assert Event.query.count() == 2
+
+    @patch('quilt_server.events.EVENT_BATCH_SIZE', 10)
+    @patch('quilt_server.events.EVENT_FLUSH_INTERVAL', 3600)
+    def testCounts(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+        self._install()
+        self._install()
+        flush_events()
+        self._install()
+        flush_events()
+
+        user_counts = {
+            (row.user, row.type): row.count for row in UserEventCount.query
+        }
+        assert user_counts == {
+            ('test_user', Event.Type.PUSH): 1,
+            ('test_user', Event.Type.INSTALL): 3,
+        }
+
+        package_counts = {
+            (row.package_owner, row.package_name, row.type): row.count for row in PackageEventCount.query
+        }
+        assert package_counts == {
+            ('test_user', 'foo', Event.Type.PUSH): 1,
+            ('test_user', 'foo', Event.Type.INSTALL): 3,
+        }
+
+        latest_install = PackageEventCount.query.filter_by(type=Event.Type.INSTALL).one().latest
+        assert latest_install == Event.query.filter_by(type=Event.Type.INSTALL).order_by(Event.id.desc()).first().created
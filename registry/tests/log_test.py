@@ -7,6 +7,7 @@ Log tests
 import json
 import requests
 from unittest.mock import patch
+import urllib
 
 from quilt_server.const import PaymentPlan, PUBLIC
 from quilt_server.core import hash_contents, GroupNode, RootNode
@@ -59,6 +60,82 @@ class LogTestCase(QuiltTestCase):
             assert log['author'] == self.user
             assert log['hash'] == hash_contents(contents)
 
+    def testLogPages(self):
+        hashes = []
+        params = dict(limit=2)
+        while True:
+            resp = self.app.get(
+                '/api/log/{usr}/{pkg}/?{params}'.format(
+                    usr=self.user,
+                    pkg=self.pkg,
+                    params=urllib.parse.urlencode(params)
+                ),
+                headers={
+                    'Authorization': self.user
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+
+            data = json.loads(resp.data.decode('utf8'))
+            assert len(data['logs']) <= 2
+            hashes += [log['hash'] for log in data['logs']]
+            if data['next_cursor'] is None:
+                break
+            params['cursor'] = data['next_cursor']
+
+        assert hashes == [hash_contents(contents) for contents in self.contents_list]
+
+        resp = self.app.get(
+            '/api/log/{usr}/{pkg}/?cursor=blah'.format(
+                usr=self.user,
+                pkg=self.pkg
+            ),
+            headers={
+                'Authorization': self.user
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
+    def testHashMatch(self):
+        hashes = [hash_contents(contents) for contents in self.contents_list]
+
+        def _match(prefix, user=self.user):
+            return self.app.get(
+                '/api/hash/{usr}/{pkg}/{prefix}'.format(
+                    usr=self.user,
+                    pkg=self.pkg,
+                    prefix=prefix
+                ),
+                headers={
+                    'Authorization': user
+                }
+            )
+
+        for pkg_hash in hashes:
+            for prefix in [pkg_hash[:6], pkg_hash[:6].upper(), pkg_hash]:
+                resp = _match(prefix)
+                assert resp.status_code == requests.codes.ok
+                assert json.loads(resp.data.decode('utf8'))['hashes'] == [pkg_hash]
+
+            # Short prefixes can be ambiguous (two of the hashes start with 'f');
+            # all matches get returned.
+            resp = _match(pkg_hash[0])
+            assert resp.status_code == requests.codes.ok
+            assert json.loads(resp.data.decode('utf8'))['hashes'] == sorted(
+                h for h in hashes if h.startswith(pkg_hash[0])
+            )
+
+        resp = _match('000000')
+        assert resp.status_code == requests.codes.ok
+        assert json.loads(resp.data.decode('utf8'))['hashes'] == []
+
+        # Not a hex string.
+        resp = _match('abc_xyz')
+        assert resp.status_code == requests.codes.bad_request
+
+        resp = _match(hashes[0][:6], user='share_with')
+        assert resp.status_code == requests.codes.not_found
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testAccess(self):
         sharewith = "share_with"
@@ -4,17 +4,23 @@
 Test push and install endpoints.
 """
 
+from datetime import datetime, timedelta, timezone
+import gzip
 import json
+import time
 from unittest.mock import patch
 import urllib
 
+from botocore.credentials import RefreshableCredentials
 import requests
+import sqlalchemy as sa
 
 from quilt_server import app, db
 from quilt_server.const import PaymentPlan
 from quilt_server.core import (
     decode_node,
     encode_node,
+    find_object_hashes,
     hash_contents,
     GroupNode,
     TableNode,
@@ -22,7 +28,10 @@ from quilt_server.core import (
     RootNode,
     PackageFormat,
 )
-from quilt_server.models import InstanceBlobAssoc, S3Blob
+from quilt_server.models import Event, Instance, InstanceBlobAssoc, PushSession, S3Blob
+from quilt_server.presign import S3UrlSigner
+from quilt_server.views import (_delete_expired_push_sessions, _generate_presigned_urls, s3_session,
+                                PACKAGE_URL_EXPIRATION, S3_GET_OBJECT, S3_PUT_OBJECT)
 
 from .utils import mock_customer, QuiltTestCase
 
@@ -312,6 +321,37 @@ class PushInstallTestCase(QuiltTestCase):
         data = json.loads(resp.data.decode('utf8'))
         assert 'message' in data
 
+    def testInvalidContents(self):
+        file_node = dict(type='FILE', hashes=[self.HASH1])
+        invalid_bodies = [
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(type='FILE', hashes=['abc'])))),
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(type='BLAH')))),
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(file_node, extra=1)))),
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(type='TABLE', hashes=[])))),
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(type='ROOT', children={})))),
+            dict(description="", contents=dict(type='ROOT', children=dict(foo=dict(file_node, metadata=file_node)))),
+            dict(description="", contents=dict(type='GROUP', children={})),
+            dict(description="", contents=dict(type='ROOT', children={}), sizes={self.HASH1: 'big'}),
+            dict(description="", contents=dict(type='ROOT', children={}), is_public='yes'),
+            dict(description="", contents=dict(type='ROOT', children={}), blah=True),
+            dict(contents=dict(type='ROOT', children={})),
+            [],
+        ]
+
+        for body in invalid_bodies:
+            resp = self.app.put(
+                '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+                data=json.dumps(body),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.bad_request, body
+
+            data = json.loads(resp.data.decode('utf8'))
+            assert 'message' in data
+
     def testInvalidHash(self):
         resp = self.app.put(
             '/api/package/test_user/foo/%s' % self.HASH1,
@@ -418,6 +458,27 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.not_found
 
+    @patch('quilt_server.views.RESPONSE_BATCH_SIZE', 2)
+    def testInstallGzip(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            headers={
+                'Authorization': 'test_user',
+                'Accept-Encoding': 'gzip'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert resp.headers['Content-Encoding'] == 'gzip'
+
+        data = json.loads(gzip.decompress(resp.data).decode('utf8'), object_hook=decode_node)
+        assert data['contents'] == self.CONTENTS
+        assert data['created_by'] == data['updated_by'] == 'test_user'
+        # Old clients don't send sizes.
+        assert data['sizes'] == {self.HASH1: None, self.HASH2: None, self.HASH3: None}
+        assert set(data['urls']) == {self.HASH1, self.HASH2, self.HASH3}
+
     def testGetBlob(self):
         resp = self.app.get(
             '/api/blob/test_user/%s' % self.HASH1,
@@ -582,6 +643,280 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.bad_request
 
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testDryRunExisting(self):
+        # HASH3 gets uploaded as part of CONTENTS_2.
+        self.put_package('test_user', 'bar', self.CONTENTS_2, is_public=True)
+
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['existing'] == [self.HASH3]
+        # URLs are still there, for clients that want to re-upload.
+        assert set(data['upload_urls']) == {self.HASH1, self.HASH2, self.HASH3}
+
+        # Blobs are per-owner.
+        resp = self.app.put(
+            '/api/package/other_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'other_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert json.loads(resp.data.decode('utf8'))['existing'] == []
+
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    @patch('quilt_server.views.MULTIPART_UPLOAD_THRESHOLD', 1000)
+    def testDryRunMultipart(self):
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS,
+                sizes={self.HASH1: 999, self.HASH2: 1000, self.HASH3: 10},
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        urls = json.loads(resp.data.decode('utf8'))['upload_urls']
+
+        # Only the big object gets uploaded in parts; nothing is started in S3 yet.
+        assert 'multipart' not in urls[self.HASH1]
+        assert urls[self.HASH2]['multipart'] is True
+        assert 'multipart' not in urls[self.HASH3]
+
+    @patch('quilt_server.views.MULTIPART_UPLOAD_PART_SIZE', 100)
+    def testMultipartUpload(self):
+        self.s3_stubber.add_response('create_multipart_upload', dict(
+            Bucket=app.config['PACKAGE_BUCKET_NAME'],
+            Key='objs/test_user/%s' % self.HASH2,
+            UploadId='upload123'
+        ), dict(
+            Bucket=app.config['PACKAGE_BUCKET_NAME'],
+            Key='objs/test_user/%s' % self.HASH2,
+            ContentEncoding='gzip'
+        ))
+
+        resp = self.app.post(
+            '/api/multipart_upload/test_user/%s' % self.HASH2,
+            data=json.dumps(dict(size=1000)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        self.s3_stubber.assert_no_pending_responses()
+
+        multipart = json.loads(resp.data.decode('utf8'))
+        assert multipart['part_size'] == 100
+        # Enough parts for the worst-case gzip'ed size.
+        assert len(multipart['parts']) == 21
+
+        for part_number, part_url in enumerate(multipart['parts'], 1):
+            url = urllib.parse.urlparse(part_url)
+            assert url.path == '/%s/objs/test_user/%s' % (app.config['PACKAGE_BUCKET_NAME'], self.HASH2)
+            query = urllib.parse.parse_qs(url.query)
+            assert query['partNumber'] == [str(part_number)]
+            assert query['uploadId'] == ['upload123']
+
+        for method in ('complete', 'abort'):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(multipart[method]).query)
+            assert query['uploadId'] == ['upload123']
+
+        # Only the owner can upload to their namespace.
+        resp = self.app.post(
+            '/api/multipart_upload/test_user/%s' % self.HASH2,
+            data=json.dumps(dict(size=1000)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'other_user'
+            }
+        )
+        assert resp.status_code == requests.codes.forbidden
+
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testPushSession(self):
+        sizes = {self.HASH1: 1, self.HASH2: 2, self.HASH3: 3}
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS,
+                sizes=sizes,
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        token = json.loads(resp.data.decode('utf8'))['push_session']
+
+        # Repeating the dry run returns the same session.
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS,
+                sizes=sizes,
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert json.loads(resp.data.decode('utf8'))['push_session'] == token
+        assert PushSession.query.count() == 1
+
+        def _push(package_hash=self.CONTENTS_HASH):
+            return self.app.put(
+                '/api/package/test_user/foo/%s' % package_hash,
+                data=json.dumps(dict(
+                    push_session=token
+                )),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+
+        # The session is bound to the hash.
+        resp = _push(self.CONTENTS_2_HASH)
+        assert resp.status_code == requests.codes.gone
+
+        # It expires.
+        with patch('quilt_server.views.PUSH_SESSION_EXPIRATION', 0):
+            resp = _push()
+            assert resp.status_code == requests.codes.gone
+
+        resp = _push()
+        assert resp.status_code == requests.codes.ok
+
+        # The contents and sizes come from the dry run.
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        data = json.loads(resp.data.decode('utf8'), object_hook=decode_node)
+        assert data['contents'] == self.CONTENTS
+        assert {blob.hash: blob.size for blob in S3Blob.query} == sizes
+
+        # It can only be used once.
+        resp = _push()
+        assert resp.status_code == requests.codes.gone
+
+        # Can't send both.
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                push_session=token,
+                description="",
+                contents=self.CONTENTS
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
+    def testDeleteExpiredPushSessions(self):
+        for token, age in [('old', 3 * 60 * 60), ('new', 60)]:
+            db.session.add(PushSession(
+                token=token,
+                created=sa.func.now() - timedelta(seconds=age),
+                owner='test_user',
+                package_name='foo',
+                hash=self.CONTENTS_HASH,
+                is_public=False,
+                is_team=False,
+                contents={},
+                sizes={}
+            ))
+        db.session.commit()
+
+        with patch('quilt_server.views.PUSH_SESSION_EXPIRATION', 2 * 60 * 60):
+            _delete_expired_push_sessions(None)
+
+        assert [push_session.token for push_session in PushSession.query] == ['new']
+
+    def testPresignedUrlCache(self):
+        hashes = [self.HASH1, self.HASH2]
+        with patch.object(S3UrlSigner, 'sign', autospec=True, side_effect=S3UrlSigner.sign) as sign:
+            with patch('time.time', return_value=1000):
+                urls = _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes)
+            assert sign.call_count == 2
+
+            # Reused while they're still valid for at least half of the expiration time...
+            with patch('time.time', return_value=1000 + PACKAGE_URL_EXPIRATION // 2 - 1):
+                assert _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes) == urls
+                _generate_presigned_urls(S3_PUT_OBJECT, 'test_user', hashes)
+                _generate_presigned_urls(S3_GET_OBJECT, 'other_user', hashes)
+            assert sign.call_count == 6
+
+            # ... but not after that.
+            with patch('time.time', return_value=1000 + PACKAGE_URL_EXPIRATION // 2):
+                _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes)
+            assert sign.call_count == 8
+
+    def testPresignedUrlCredentialExpiry(self):
+        now = int(time.time())
+        credentials = RefreshableCredentials(
+            access_key='key', secret_key='secret', token='token',
+            expiry_time=datetime.fromtimestamp(now + 3600, timezone.utc),
+            refresh_using=None, method='test'
+        )
+        hashes = [self.HASH1]
+        with patch.object(s3_session, 'get_credentials', return_value=credentials), \
+             patch.object(S3UrlSigner, 'sign', autospec=True, side_effect=S3UrlSigner.sign) as sign:
+            with patch('time.time', return_value=now):
+                url = _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes)[self.HASH1]
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            assert query['X-Amz-Security-Token'] == ['token']
+
+            # The URL only works until the credentials expire, so it's reused for half of that.
+            with patch('time.time', return_value=now + 1800 - 1):
+                _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes)
+            assert sign.call_count == 1
+            with patch('time.time', return_value=now + 1800):
+                _generate_presigned_urls(S3_GET_OBJECT, 'test_user', hashes)
+            assert sign.call_count == 2
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testInstallSubpath(self):
         """
@@ -664,6 +999,158 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.not_found
 
+    def testInstallPages(self):
+        self.put_package('test_user', 'foo', self.CONTENTS)
+
+        def _get(**params):
+            resp = self.app.get(
+                '/api/package/test_user/foo/%s?%s' % (self.CONTENTS_HASH, urllib.parse.urlencode(params)),
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            return json.loads(resp.data.decode('utf8'), object_hook=decode_node)
+
+        sorted_hashes = sorted([self.HASH1, self.HASH2, self.HASH3])
+
+        # The first page has the contents.
+        data = _get(limit=2)
+        assert data['contents'] == self.CONTENTS
+        assert set(data['urls']) == set(data['sizes']) == set(sorted_hashes[:2])
+        assert data['next_cursor'] == sorted_hashes[1]
+
+        # The rest don't, and don't even load them from the database.
+        statements = []
+
+        def _record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', _record_statement)
+        try:
+            data = _get(limit=2, cursor=data['next_cursor'])
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', _record_statement)
+        assert 'contents' not in data
+        assert set(data['urls']) == set(data['sizes']) == set(sorted_hashes[2:])
+        assert data['next_cursor'] is None
+        assert statements and not any('instance.contents' in statement for statement in statements)
+
+        # A page that isn't the last one.
+        data = _get(limit=1, cursor=sorted_hashes[0])
+        assert list(data['urls']) == [sorted_hashes[1]]
+        assert data['next_cursor'] == sorted_hashes[1]
+
+        # Pages of a subpath only have its hashes.
+        data = _get(subpath='foo', limit=1)
+        assert list(data['urls']) == [min(self.HASH1, self.HASH2)]
+        data = _get(subpath='foo', limit=1, cursor=data['next_cursor'])
+        assert list(data['urls']) == [max(self.HASH1, self.HASH2)]
+        assert data['next_cursor'] is None
+
+        # Only the first page gets logged.
+        events = Event.query.filter_by(type=Event.Type.INSTALL).all()
+        assert len(events) == 2
+
+        # Bad requests.
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s?limit=0' % self.CONTENTS_HASH,
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s?%s' % (
+                self.CONTENTS_HASH, urllib.parse.urlencode(dict(subpath='zzz', limit=1, cursor='a'))
+            ),
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.not_found
+
+    def testInstallBatch(self):
+        self.put_package('test_user', 'foo', self.CONTENTS, tag_latest=True)
+        self.put_package('test_user', 'bar', self.CONTENTS_2)
+
+        resp = self.app.post(
+            '/api/install_batch/',
+            data=json.dumps(dict(
+                packages=[
+                    dict(owner='test_user', name='foo'),
+                    dict(owner='test_user', name='bar', hash=self.CONTENTS_2_HASH[:6]),
+                    dict(owner='test_user', name='foo', tag='latest', subpath='group1/group2'),
+                    dict(owner='test_user', name='bar'),
+                    dict(owner='test_user', name='bar', hash='000000'),
+                    dict(owner='test_user', name='foo', subpath='zzz'),
+                    dict(owner='test_user', name='baz'),
+                ],
+                limit=2
+            )),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        results = json.loads(resp.data.decode('utf8'), object_hook=decode_node)['packages']
+        assert len(results) == 7
+
+        sorted_hashes = sorted([self.HASH1, self.HASH2, self.HASH3])
+
+        # Same as the first page of package_get.
+        assert results[0]['hash'] == self.CONTENTS_HASH
+        data = results[0]['package']
+        assert data['contents'] == self.CONTENTS
+        assert set(data['urls']) == set(data['sizes']) == set(sorted_hashes[:2])
+        assert data['next_cursor'] == sorted_hashes[1]
+
+        # Short hashes get resolved.
+        assert results[1]['hash'] == self.CONTENTS_2_HASH
+        assert results[1]['package']['contents'] == self.CONTENTS_2
+
+        assert results[2]['hash'] == self.CONTENTS_HASH
+        assert list(results[2]['package']['urls']) == [self.HASH1]
+        assert results[2]['package']['next_cursor'] is None
+
+        # Errors only affect their own packages.
+        assert results[3]['error']['status'] == requests.codes.not_found
+        assert results[3]['error']['message'] == "Tag 'latest' does not exist"
+        assert results[4]['error']['message'] == "Invalid hash: 000000"
+        assert results[5]['error']['message'] == "Invalid subpath: 'zzz'"
+        assert results[6]['error']['message'] == "Package test_user/baz does not exist"
+
+        events = Event.query.filter_by(type=Event.Type.INSTALL).all()
+        assert len(events) == 3
+
+        # Bad requests.
+        resp = self.app.post(
+            '/api/install_batch/',
+            data=json.dumps(dict(
+                packages=[dict(owner='test_user')]
+            )),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
+        with patch('quilt_server.views.MAX_INSTALL_BATCH_SIZE', 1):
+            resp = self.app.post(
+                '/api/install_batch/',
+                data=json.dumps(dict(
+                    packages=[dict(owner='test_user', name='foo')] * 2
+                )),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.bad_request
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testPreview(self):
         huge_contents_hash = hash_contents(self.HUGE_CONTENTS)
@@ -734,6 +1221,59 @@ class PushInstallTestCase(QuiltTestCase):
             ]],
         ]
 
+    def testPreviewSummary(self):
+        contents = RootNode(dict(
+            README=FileNode(
+                hashes=[self.HASH1]
+            ),
+            foo=FileNode(
+                hashes=[self.HASH2]
+            )
+        ))
+        contents_hash = hash_contents(contents)
+        readme_contents = 'Hello, World!'
+        self._mock_object('test_user', self.HASH1, readme_contents.encode())
+
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % contents_hash,
+            data=json.dumps(dict(
+                description="",
+                contents=contents,
+                sizes={self.HASH1: 13, self.HASH2: 100}
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        instance = Instance.query.filter_by(hash=contents_hash).one()
+        assert instance.preview == [['README', None], ['foo', None]]
+        assert instance.total_size == 113
+
+        def _get_preview():
+            resp = self.app.get(
+                '/api/package_preview/test_user/foo/%s' % contents_hash,
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            data = json.loads(resp.data.decode('utf8'))
+            del data['readme_url']  # Signed URLs get regenerated.
+            return data
+
+        data = _get_preview()
+        assert data['preview'] == [['README', None], ['foo', None]]
+        assert data['total_size_uncompressed'] == 113
+        assert data['readme_preview'] == readme_contents
+
+        # Packages pushed before the summary existed get the same result.
+        db.engine.execute('UPDATE instance SET preview = NULL, total_size = NULL')
+
+        assert _get_preview() == data
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testReadmeDownload(self):
         readme_contents = '123'
@@ -767,8 +1307,10 @@ class PushInstallTestCase(QuiltTestCase):
         self.put_package('test_user', 'foo2', contents3, is_public=True)
 
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    @patch('quilt_server.views.BLOB_INSERT_BATCH_SIZE', 2)
     def testInstanceBlob(self):
         # Verify that all blobs are accounted for in the instance<->blob table.
+        # Blobs get inserted in batches that mix new and existing ones.
 
         # Push the first instance with three blobs.
         resp = self.app.put(
@@ -812,6 +1354,9 @@ class PushInstallTestCase(QuiltTestCase):
         assert len(blobs) == 3
         assert len(instance_blobs) == 4
 
+        instance = Instance.query.filter_by(hash=self.CONTENTS_2_HASH).one()
+        assert {blob.hash for blob in instance.blobs} == set(find_object_hashes(self.CONTENTS_2))
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testTeamAccessFails(self):
         # Verify that --team fails in the public cloud.
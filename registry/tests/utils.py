@@ -22,7 +22,7 @@ import sqlalchemy_utils
 import quilt_server
 from quilt_server.const import PaymentPlan
 from quilt_server.core import encode_node, hash_contents
-from quilt_server.views import s3_client, MAX_PREVIEW_SIZE
+from quilt_server.views import s3_client, presigned_url_cache, token_cache, MAX_PREVIEW_SIZE
 
 class MockMixpanelConsumer(object):
     """
@@ -57,6 +57,9 @@ class QuiltTestCase(TestCase):
         self.s3_stubber = Stubber(s3_client)
         self.s3_stubber.activate()
 
+        token_cache.clear()
+        presigned_url_cache.clear()
+
         random_name = ''.join(random.sample(string.ascii_lowercase, 10))
         self.db_url = 'postgresql://postgres@localhost/test_%s' % random_name
 
@@ -7,6 +7,7 @@ Version tests
 import json
 import requests
 from unittest.mock import patch
+import urllib
 
 from quilt_server.core import hash_contents, GroupNode, RootNode
 from .utils import QuiltTestCase
@@ -143,6 +144,34 @@ class VersionTestCase(QuiltTestCase):
             )
         ]
 
+    def testListVersionsPages(self):
+        for version in ['1.0', '2.0pre1', '2.0', '10.0']:
+            resp = self._add_version(version, self.hashes[0])
+            assert resp.status_code == requests.codes.ok
+
+        versions = []
+        params = dict(limit=3)
+        while True:
+            resp = self.app.get(
+                '/api/version/{usr}/{pkg}/?{params}'.format(
+                    usr=self.user,
+                    pkg=self.pkg,
+                    params=urllib.parse.urlencode(params)
+                ),
+                headers={
+                    'Authorization': self.user
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+
+            data = json.loads(resp.data.decode('utf8'))
+            versions.append([version['version'] for version in data['versions']])
+            if data['next_cursor'] is None:
+                break
+            params['cursor'] = data['next_cursor']
+
+        assert versions == [['1.0', '2.0pre1', '2.0'], ['10.0']]
+
     def testInvalidVersion(self):
         resp = self._add_version('foo', self.hashes[0])
         assert resp.status_code == requests.codes.bad_request